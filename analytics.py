@@ -0,0 +1,252 @@
+import sys
+import json
+import math
+import heapq
+import argparse
+from decimal import Decimal, ROUND_HALF_UP
+
+from money import Money
+
+# Installed from requirements.txt; vectorizes the column passes
+try:
+    import numpy as np
+except ImportError:  # pure-Python fallback below
+    np = None
+
+# Bulk balance parsing and portfolio analytics.
+#
+# Back-office jobs total and rank every balance in a worksheet. Instead of
+# calling _parse_balance_str once per cell, parse_balance_column cleans and
+# converts a whole column in a few vectorized passes (NumPy when it is
+# installed, one str.translate pass per value otherwise) and returns the
+# balances as integer cents. Both paths round half-cents like Money
+# (ROUND_HALF_UP), without going through floats. The statistics below
+# work on that column and are computed from one get_all_values()
+# download per worksheet:
+#
+#     python analytics.py --sheet client --top 10 --bins 10
+
+# Worksheet title -> (key column, balance column), 0-based, header row first
+BALANCE_COLUMNS = {
+    "client": (0, 4),
+    "account": (0, 2),
+}
+
+# Spaces (including non-breaking) are dropped, a decimal comma becomes a dot
+_CLEAN = str.maketrans({"\xa0": None, " ": None, ",": "."})
+
+
+def _cents_or_none(text):
+    try:
+        return Money.parse(text).cents
+    except ValueError:
+        return None
+
+
+def _np_cents(text):
+    """
+    Integer cents of plain decimal strings ('-1234.565'), vectorized: the
+    whole part and the first three fraction digits are converted as
+    integers and the third digit rounds half up (away from zero), as
+    Money does. Returns (cents, plain) where plain marks the strings of
+    that form; the others are left to _cents_or_none.
+    """
+    unsigned = np.char.lstrip(text, "+-")
+    negative = np.char.startswith(text, "-")
+    parts = np.char.partition(unsigned, ".")
+    whole, frac = parts[..., 0], parts[..., 2]
+    plain = (np.char.str_len(text) - np.char.str_len(unsigned) <= 1) & \
+        np.char.isdecimal(np.char.add(whole, frac)) & (np.char.str_len(whole) <= 15)
+    whole = np.where(plain & (np.char.str_len(whole) > 0), whole, "0").astype(np.int64)
+    digits = np.where(plain, np.char.ljust(frac, 3, "0"), "000").astype("U3").astype(np.int64)
+    cents = whole * 100 + digits // 10 + (digits % 10 >= 5)
+    return np.where(negative, -cents, cents), plain
+
+
+def parse_balance_column(values):
+    """
+    Parse a column of balance cells ('3 649,30', '557,22', 150.79, ...)
+    into integer cents.
+
+    Args:
+        values: Iterable of cell values
+
+    Returns:
+        (cents, invalid): cents is a NumPy int64 array (a list of ints
+        without NumPy) with 0 for cells that are not amounts, as
+        _parse_balance_str does; invalid is the number of such cells
+    """
+    if np is None:
+        cents, invalid = [], 0
+        for value in values:
+            amount = _cents_or_none(str(value).translate(_CLEAN))
+            if amount is None:
+                invalid += 1
+                amount = 0
+            cents.append(amount)
+        return cents, invalid
+    text = np.asarray([str(v) for v in values], dtype=str)
+    if not text.size:
+        return np.zeros(0, dtype=np.int64), 0
+    for old, new in (("\xa0", ""), (" ", ""), (",", ".")):
+        text = np.char.replace(text, old, new)
+    cents, plain = _np_cents(text)
+    invalid = 0
+    # Exponents, blanks and text: one by one, 0 marks the invalid ones
+    for i in np.flatnonzero(~plain).tolist():
+        amount = _cents_or_none(str(text[i]))
+        if amount is None:
+            invalid += 1
+            amount = 0
+        cents[i] = amount
+    return cents, invalid
+
+
+def _rank(count, pct):
+    # Nearest-rank index, as bench_atm.percentile
+    return max(1, math.ceil(pct / 100.0 * count)) - 1
+
+
+def summarize(cents, percentiles=(50, 90, 99)):
+    """
+    Totals and distribution of a balance column.
+
+    Returns:
+        Dict with count, total, mean, min, max and p<N> keys, in euros
+    """
+    count = len(cents)
+    if not count:
+        return {"count": 0, "total": 0.0, "mean": None, "min": None, "max": None,
+                **{f"p{pct}": None for pct in percentiles}}
+    if np is not None:
+        ordered = np.sort(np.asarray(cents, dtype=np.int64))
+        total = int(ordered.sum())
+    else:
+        ordered = sorted(cents)
+        total = sum(ordered)
+    stats = {
+        "count": count,
+        "total": total / 100,
+        "mean": int((Decimal(total) / count).quantize(Decimal(1), rounding=ROUND_HALF_UP)) / 100,
+        "min": int(ordered[0]) / 100,
+        "max": int(ordered[-1]) / 100,
+    }
+    for pct in percentiles:
+        stats[f"p{pct}"] = int(ordered[_rank(count, pct)]) / 100
+    return stats
+
+
+def top_n(keys, cents, n=10):
+    """
+    The n largest balances.
+
+    Returns:
+        List of (key, balance in euros), largest first
+    """
+    if n <= 0 or not len(cents):
+        return []
+    if np is not None:
+        values = np.asarray(cents, dtype=np.int64)
+        picked = np.arange(len(values))
+        if n < len(values):
+            # Only balances at least the n-th largest need sorting; every
+            # tie at that boundary is kept so the first rows win below
+            threshold = np.partition(values, len(values) - n)[len(values) - n]
+            picked = np.flatnonzero(values >= threshold)
+        # Largest first, ties in row order: the fallback's (cents, -i) key
+        picked = picked[np.argsort(-values[picked], kind="stable")][:n].tolist()
+        return [(keys[i], int(values[i]) / 100) for i in picked]
+    picked = heapq.nlargest(n, range(len(cents)), key=lambda i: (cents[i], -i))
+    return [(keys[i], cents[i] / 100) for i in picked]
+
+
+def histogram(cents, bins=10):
+    """
+    Equal-width histogram of the balances between the smallest and largest.
+
+    Returns:
+        List of (low, high, count) in euros, both bounds inclusive
+    """
+    if not len(cents) or bins <= 0:
+        return []
+    low, high = int(min(cents)), int(max(cents))
+    bins = min(bins, high - low + 1)
+    width = max(1, math.ceil((high - low + 1) / bins))
+    if np is not None:
+        counts = np.bincount((np.asarray(cents, dtype=np.int64) - low) // width, minlength=bins).tolist()
+    else:
+        counts = [0] * bins
+        for value in cents:
+            counts[(value - low) // width] += 1
+    return [((low + i * width) / 100, min(high, low + (i + 1) * width - 1) / 100, counts[i])
+            for i in range(bins)]
+
+
+def analyze_rows(rows, key_column, balance_column, top=10, bins=10):
+    """
+    Analytics for the rows of one worksheet (header row included).
+
+    Returns:
+        Dict with "summary", "invalid", "top" and "histogram" keys
+    """
+    rows = rows[1:]
+    keys = [row[key_column] if len(row) > key_column else "" for row in rows]
+    cents, invalid = parse_balance_column(row[balance_column] if len(row) > balance_column else ""
+                                          for row in rows)
+    return {
+        "summary": summarize(cents),
+        "invalid": invalid,
+        "top": top_n(keys, cents, top),
+        "histogram": histogram(cents, bins),
+    }
+
+
+def analyze(spreadsheet, sheets=tuple(BALANCE_COLUMNS), top=10, bins=10):
+    """
+    Portfolio analytics over a snapshot of the spreadsheet, downloading
+    each worksheet once.
+
+    Returns:
+        Dict of worksheet title -> analyze_rows() result
+    """
+    report = {}
+    for title in sheets:
+        key_column, balance_column = BALANCE_COLUMNS[title]
+        rows = spreadsheet.worksheet(title).get_all_values()
+        report[title] = analyze_rows(rows, key_column, balance_column, top=top, bins=bins)
+    return report
+
+
+def format_report(report):
+    lines = []
+    for title, result in report.items():
+        s = result["summary"]
+        lines.append(f"{title}: {s['count']} balances, total €{s['total']:,.2f}, {result['invalid']} invalid")
+        if s["count"]:
+            lines.append(f"  mean €{s['mean']:,.2f}  min €{s['min']:,.2f}  max €{s['max']:,.2f}  "
+                         f"p50 €{s['p50']:,.2f}  p90 €{s['p90']:,.2f}  p99 €{s['p99']:,.2f}")
+        for key, balance in result["top"]:
+            lines.append(f"  {key:<20}€{balance:>14,.2f}")
+        for low, high, count in result["histogram"]:
+            lines.append(f"  €{low:>12,.2f} - €{high:>12,.2f}  {count}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Balance totals, percentiles, top-N and histograms")
+    parser.add_argument("--sheet", choices=tuple(BALANCE_COLUMNS), action="append",
+                        help="worksheet to analyze (default: all)")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--bins", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    from cardHolder import SheetsConnection
+    report = analyze(SheetsConnection.get().SHEET, sheets=args.sheet or tuple(BALANCE_COLUMNS),
+                     top=args.top, bins=args.bins)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,510 @@
+import io
+import os
+import sys
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import operation
+from money import Money
+
+# Multi-session ATM server.
+#
+# One asyncio process serves many terminal sessions over TCP instead of one
+# run.py process per connection, so gspread, the credentials and any
+# snapshot of the sheet are loaded once. Each connection gets an ATMSession:
+# a state machine fed one input line at a time that reproduces the prompts
+# of run.main() / run.authenticate(). Backend calls run in a thread pool via
+# asyncio.to_thread so a slow Sheets request only delays its own session.
+#
+# Start it with:  python run.py --serve 127.0.0.1:7001
+# and point the gateway at it with ATM_SERVER_ADDR=127.0.0.1:7001.
+
+
+# The run.py module whose prompts the sessions reuse. When run.py itself is
+# the entry point (python run.py --serve) it registers its __main__ module
+# here, so it is not imported (and its backends initialized) a second time.
+_ui = None
+
+
+def _run_module():
+    global _ui
+    if _ui is None:
+        import run
+        _ui = run
+    return _ui
+
+
+# Buffer receiving the prints of the _captured() call running in this
+# context; other threads and tasks keep writing to the real stdout
+_output = contextvars.ContextVar("atm_session_output", default=None)
+
+
+class _RoutedStdout:
+    """sys.stdout replacement sending writes to the current context's buffer, if any."""
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        return (_output.get() or self._stream).write(text)
+
+    def flush(self):
+        (_output.get() or self._stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _captured(fn, *args):
+    """
+    Return what a print-based helper from run.py/cardHolder.py writes.
+
+    Only prints made in this context are captured: swapping sys.stdout
+    itself (redirect_stdout) would also capture the [ERROR] lines of
+    backend calls other sessions are running in worker threads.
+    """
+    if not isinstance(sys.stdout, _RoutedStdout):
+        sys.stdout = _RoutedStdout(sys.stdout)
+    buffer = io.StringIO()
+    token = _output.set(buffer)
+    try:
+        fn(*args)
+    finally:
+        _output.reset(token)
+    return buffer.getvalue()
+
+
+class ATMSession:
+    """
+    State machine for one ATM session.
+
+    start() returns the greeting; feed(line) consumes one line of input and
+    returns the text to send back. When closed is True the connection
+    should be ended.
+
+    Args:
+        api: API instance (or None)
+        repo: ClientRepository instance (or None)
+        banner: Text shown before the card prompt
+    """
+    CARD, PIN, MENU, AMOUNT, PIN_CURRENT, PIN_NEW, PIN_CONFIRM, \
+        TRANSFER_AMOUNT, TRANSFER_DEST, TRANSFER_CONFIRM, CLOSED = range(11)
+
+    def __init__(self, api, repo, banner=""):
+        self.api = api
+        self.repo = repo
+        self.banner = banner
+        self.state = self.CARD
+        self.source = None
+        self.obj = None
+        self.candidate = None
+        self.pin_attempts = 0
+        self.action = None
+        self.new_pin = None
+        self.transfer = {}
+        self.operation = None
+        self._out = []
+
+    @property
+    def closed(self):
+        return self.state == self.CLOSED
+
+    def say(self, *parts, end="\n"):
+        self._out.append(" ".join(str(p) for p in parts) + end)
+
+    def _flush(self):
+        text, self._out = "".join(self._out), []
+        return text
+
+    def start(self):
+        if self.api is None and self.repo is None:
+            self.say("[ERROR] Backend unavailable. Please check Google credentials or Sheets.")
+            self.state = self.CLOSED
+            return self.banner + self._flush()
+        self.say("Insert Your Card: ", end="")
+        return self.banner + self._flush()
+
+    async def feed(self, line):
+        """Handle one line of input and return the response text."""
+        handler = self._handlers()[self.state]
+        line = line.strip()
+        # Backend calls are tagged like run.main's: login, then the menu action
+        if self.state in (self.CARD, self.PIN):
+            self.operation = "login"
+        elif self.state == self.MENU:
+            self.operation = _run_module().MENU_OPERATIONS.get(line, "other")
+        with operation(self.operation):
+            await handler(line)
+        return self._flush()
+
+    def close(self, message="Goodbye!"):
+        if message:
+            self.say(message)
+        self.state = self.CLOSED
+
+    def _handlers(self):
+        return {
+            self.CARD: self._on_card,
+            self.PIN: self._on_pin,
+            self.MENU: self._on_menu,
+            self.AMOUNT: self._on_amount,
+            self.PIN_CURRENT: self._on_pin_current,
+            self.PIN_NEW: self._on_pin_new,
+            self.PIN_CONFIRM: self._on_pin_confirm,
+            self.TRANSFER_AMOUNT: self._on_transfer_amount,
+            self.TRANSFER_DEST: self._on_transfer_dest,
+            self.TRANSFER_CONFIRM: self._on_transfer_confirm,
+            self.CLOSED: self._on_closed,
+        }
+
+    # Login
+
+    async def _on_card(self, card_num):
+        if not card_num:
+            self.say("Please insert your card.")
+            self.say("Insert Your Card: ", end="")
+            return
+        if self.api is not None:
+            try:
+                cards = await asyncio.to_thread(self.api.getATMCards, card_num)
+            except Exception:
+                self.say("Unable to process your card. Please try again or contact support.")
+                cards = []
+            if cards:
+                self.candidate = ("api", cards[0])
+                return self._ask_pin()
+        if self.repo is not None:
+            try:
+                rec = await asyncio.to_thread(self.repo.get_record, card_num)
+            except Exception as e:
+                self.say(f"[WARN] Sheet lookup failed: {e}")
+                rec = False
+            if rec is None:
+                self.say("Card not found. Please try again.")
+                self.say("Insert Your Card: ", end="")
+                return
+            if rec:
+                self.candidate = ("repo", rec)
+                return self._ask_pin()
+        self.say("Card not found.")
+        self.close()
+
+    def _ask_pin(self):
+        self.pin_attempts = 0
+        self.state = self.PIN
+        self.say("PIN: ", end="")
+
+    async def _on_pin(self, pin):
+        source, obj = self.candidate
+        if source == "api":
+            from cardHolder import UnitOfWork
+            ok = await asyncio.to_thread(lambda: UnitOfWork.run(obj.verify_pin, pin, best_effort=True))
+        else:
+            ok = str(obj.pin) == str(pin)
+        if ok:
+            self.source, self.obj = self.candidate
+            self.candidate = None
+            return self._welcome()
+        self.pin_attempts += 1
+        remaining_attempts = 3 - self.pin_attempts
+        self.say("Incorrect PIN.")
+        if remaining_attempts > 0:
+            self.say(f"You have {remaining_attempts} attempt(s) remaining for your PIN to enter")
+            if source == "api":
+                self.say(f"Failed tries: {obj.getFailedTries()}")
+            self.say("PIN: ", end="")
+            return
+        self.say("Too many failed PIN attempts. Your card has been locked for security.")
+        self.say("Please contact your bank administration to unlock your card.")
+        self.close()
+
+    def _welcome(self):
+        from cardHolder import show_welcome_message
+        if self.source == "repo":
+            self._out.append(_captured(show_welcome_message, self.obj))
+        else:
+            self.say(f"\nWelcome back! Card ending in {self.obj.getCardNumber()[-4:]}")
+            self.say(f"Balance: €{self.obj.check_balance():,.2f}\n")
+        self._menu()
+
+    # Menu
+
+    def _menu(self):
+        self.state = self.MENU
+        self._out.append(_captured(_run_module().print_menu))
+        self.say("> ", end="")
+
+    def _balance(self):
+        if self.source == "api":
+            return self.obj.check_balance()
+        return self.obj.balance
+
+    async def _on_menu(self, choice):
+        if choice in ("6", "quit", "exit"):
+            return self.close()
+        if choice == "1":
+            bal = self._balance()
+            self.say("Could not retrieve balance." if bal is None else f"Current balance: €{bal:,.2f}")
+        elif choice in ("2", "3"):
+            self.action = "withdraw" if choice == "2" else "deposit"
+            self.state = self.AMOUNT
+            self.say("Amount to withdraw: €" if choice == "2" else "Amount to deposit: €", end="")
+            return
+        elif choice == "4":
+            self.pin_attempts = 0
+            if self.source == "api":
+                self.state = self.PIN_NEW
+                self.say("Enter new PIN: ", end="")
+            else:
+                self.state = self.PIN_CURRENT
+                self.say("Enter current PIN: ", end="")
+            return
+        elif choice == "5":
+            # As in run.main, API cards transfer from their client record
+            rec = self.obj if self.source == "repo" else None
+            if self.source == "api" and self.repo is not None:
+                try:
+                    rec = await asyncio.to_thread(self.repo.get_record, self.obj.getCardNumber())
+                except Exception as e:
+                    self.say(f"[WARN] Sheet lookup failed: {e}")
+            if self.repo is None or not rec:
+                self.say("Transfers are not available for this card.")
+            else:
+                self.transfer = {"source": rec}
+                self.state = self.TRANSFER_AMOUNT
+                self.say("\n" + "=" * 40)
+                self.say("      MONEY TRANSFER")
+                self.say("=" * 40)
+                self.say("Amount to transfer: €", end="")
+                return
+        else:
+            self.say("Invalid option. Please choose 1-6.")
+        self._menu()
+
+    async def _on_amount(self, text):
+        try:
+            amt = _run_module()._parse_amount(text)
+        except ValueError as e:
+            self.say(f"Invalid amount. {e}")
+            return self._menu()
+        if amt <= 0:
+            self.say("Amount must be positive")
+            return self._menu()
+        withdraw = self.action == "withdraw"
+        if self.source == "api":
+            from cardHolder import UnitOfWork
+            ok = await asyncio.to_thread(UnitOfWork.run, self.obj.withdraw if withdraw else self.obj.deposit, amt)
+        elif withdraw and amt > self.obj.balance:
+            self.say("Withdrawal failed (insufficient funds).")
+            return self._menu()
+        else:
+            change = -amt if withdraw else amt
+            # Versioned write: self.obj.balance may be re-read before the change is applied
+            ok = await asyncio.to_thread(self.repo.update_balance, self.obj.cardNum,
+                                         self.obj.balance + change, self.obj)
+            if ok:
+                self.obj.balance += change
+        if ok and withdraw:
+            self.say(f"✓ Withdrawn €{amt:,.2f}. New balance: €{self._balance():,.2f}")
+        elif ok:
+            self.say(f"✓ Deposited €{amt:,.2f}. New balance: €{self._balance():,.2f}")
+        elif withdraw and self.source == "api":
+            self.say("Withdrawal failed (insufficient funds or server error).")
+        elif withdraw:
+            self.say("Withdrawal failed (server error).")
+        else:
+            self.say("Deposit failed (server error).")
+        self._menu()
+
+    # PIN change
+
+    async def _on_pin_current(self, current):
+        if str(self.obj.pin) == str(current):
+            self.state = self.PIN_NEW
+            self.say("Enter new PIN: ", end="")
+            return
+        self.pin_attempts += 1
+        remaining_attempts = 3 - self.pin_attempts
+        self.say("Incorrect current PIN.")
+        if remaining_attempts > 0:
+            self.say(f"You have {remaining_attempts} attempt(s) remaining.")
+            self.say("Enter current PIN: ", end="")
+            return
+        self.say("Too many incorrect attempts. Returning to main menu.")
+        self._menu()
+
+    async def _on_pin_new(self, new_pin):
+        self.new_pin = new_pin
+        self.state = self.PIN_CONFIRM
+        self.say("Confirm new PIN: ", end="")
+
+    async def _on_pin_confirm(self, confirm):
+        new_pin, self.new_pin = self.new_pin, None
+        if not new_pin or not confirm:
+            self.say("PIN cannot be empty")
+        elif new_pin != confirm:
+            self.say("PIN mismatch. Try again.")
+        elif not new_pin.isdigit():
+            self.say("PIN must be numeric")
+        elif len(new_pin) < 4:
+            self.say("PIN must be at least 4 digits")
+        elif self.source == "api":
+            from cardHolder import UnitOfWork
+            ok = await asyncio.to_thread(UnitOfWork.run, self.obj.change_pin, new_pin)
+            self.say("✓ PIN changed successfully." if ok else "Failed to change PIN.")
+        else:
+            ok = await asyncio.to_thread(self.repo.update_pin, self.obj.cardNum, new_pin)
+            if ok:
+                self.obj.pin = new_pin
+            self.say("✓ PIN changed successfully." if ok else "Failed to change PIN.")
+        self._menu()
+
+    # Transfer (same prompts and checks as cardHolder.transfer_money)
+
+    async def _on_transfer_amount(self, text):
+        try:
+            amount = Money.parse(text)
+        except ValueError:
+            self.say("Invalid amount.")
+            return self._menu()
+        if amount <= 0:
+            self.say("Amount must be positive.")
+            return self._menu()
+        if amount > self.transfer["source"].balance:
+            self.say("Insufficient funds!")
+            return self._menu()
+        self.transfer["amount"] = amount
+        self.state = self.TRANSFER_DEST
+        self.say("\nEnter recipient card number:")
+        self.say("→ ", end="")
+
+    async def _on_transfer_dest(self, dest_card):
+        if dest_card == self.transfer["source"].cardNum:
+            self.say("You cannot transfer to yourself!")
+            return self._menu()
+        dest_rec = await asyncio.to_thread(self.repo.get_record, dest_card)
+        if not dest_rec:
+            self.say("Recipient card not found!")
+            return self._menu()
+        self.transfer["dest"] = dest_rec
+        self.state = self.TRANSFER_CONFIRM
+        self.say(f"\nSend €{self.transfer['amount']:,.2f} to:")
+        self.say(f"   {dest_rec.firstName} {dest_rec.lastName}")
+        self.say(f"   Card: {dest_rec.cardNum}")
+        self.say("\nConfirm? (y/n): ", end="")
+
+    async def _on_transfer_confirm(self, confirm):
+        source, amount, dest_rec = self.transfer["source"], self.transfer["amount"], self.transfer["dest"]
+        self.transfer = {}
+        if confirm.lower() != 'y':
+            self.say("Transfer cancelled.")
+            return self._menu()
+        transferred = await asyncio.to_thread(self.repo.transfer, source, dest_rec, amount)
+        if transferred:
+            source.balance -= amount
+            dest_rec.balance += amount
+            self.say(f"\n✓ SUCCESS! Transferred €{amount:,.2f}")
+            self.say(f"To: {dest_rec.firstName} {dest_rec.lastName}")
+            self.say(f"Your new balance: €{source.balance:,.2f}")
+        else:
+            self.say("Transfer failed. Please try again.")
+        self._menu()
+
+    async def _on_closed(self, line):
+        return None
+
+
+class ATMServer:
+    """
+    TCP server running one ATMSession per connection. Input is read a line
+    at a time; output is written as UTF-8 text.
+
+    Args:
+        api: Shared API instance (or None)
+        repo: Shared ClientRepository instance (or None)
+        idle_timeout: Seconds without input before a session is closed
+        max_sessions: Connections served at once; extra ones are refused
+    """
+    def __init__(self, api, repo, idle_timeout=300.0, max_sessions=500):
+        self.api = api
+        self.repo = repo
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sessions = 0
+        self.banner = _captured(_run_module().print_banner)
+
+    async def handle(self, reader, writer):
+        if self.sessions >= self.max_sessions:
+            writer.write("The ATM is busy. Please try again shortly.\n".encode("utf-8"))
+            await writer.drain()
+            writer.close()
+            return
+        self.sessions += 1
+        session = ATMSession(self.api, self.repo, self.banner)
+        try:
+            writer.write(session.start().encode("utf-8"))
+            await writer.drain()
+            while not session.closed:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    session.close("\nSession timed out. Goodbye!")
+                    writer.write(session._flush().encode("utf-8"))
+                    break
+                if not line:
+                    break
+                writer.write((await session.feed(line.decode("utf-8", errors="replace"))).encode("utf-8"))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.sessions -= 1
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def start(self, host="127.0.0.1", port=7001):
+        return await asyncio.start_server(self.handle, host, port)
+
+
+def parse_address(address, default_port=7001):
+    host, _, port = (address or "").rpartition(":")
+    if not host:
+        host, port = (address or "127.0.0.1"), ""
+    return host, int(port or default_port)
+
+
+async def serve(address="127.0.0.1:7001", api=None, repo=None, workers=32):
+    """Run the server until cancelled."""
+    # Backend calls block, so give the thread pool room for many sessions
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    host, port = parse_address(address)
+    server = await ATMServer(api, repo).start(host, port)
+    print(f"ATM server listening on {host}:{port}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main(address=None, backends=None, ui=None):
+    """
+    Serve sessions with the given (api, repo) pair, or with the backends
+    run.py sets up when it is imported.
+    """
+    global _ui
+    if ui is not None:
+        _ui = ui
+    if backends is None:
+        run = _run_module()
+        run._ensure_backends()
+        backends = (run.api, run.repo)
+    address = address or os.environ.get("ATM_SERVER_ADDR", "127.0.0.1:7001")
+    try:
+        asyncio.run(serve(address, *backends, workers=int(os.environ.get("ATM_SERVER_WORKERS", "32"))))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,295 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+from sheets_emulator import SheetsEmulator, install
+
+# End-to-end latency benchmark for the ATM flows.
+#
+# Runs authenticate, withdraw, deposit, PIN change and transfer through the
+# same objects run.py uses (run.api / run.repo, transfer_money, ATMCard),
+# with the Google Sheets backend replaced by sheets_emulator. For each
+# operation it reports p50/p95/p99 latency, backend round trips and bytes,
+# and can write the results as JSON to compare commits:
+#
+#     python bench_atm.py --iterations 100 --latency 0.08 --output bench.json
+
+OPERATIONS = ("authenticate", "withdraw", "deposit", "pin_change", "transfer")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None if empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def build_dataset(clients=200, seed=0):
+    """
+    Synthetic spreadsheet contents. Cards in the 'client' tab start with 45
+    (served by SimpleClientRepo); cards in 'atmCards' start with 53 (served
+    by API and ATMCard), so both login paths in run.authenticate are used.
+
+    Returns:
+        (sheets, client_cards, atm_cards)
+    """
+    rng = random.Random(seed)
+    client = [['cardNum', 'pin', 'firstName', 'lastName', 'balance']]
+    holders = [['id', 'firstname', 'lastname', 'phone']]
+    accounts = [['accountID', 'holderID', 'balance']]
+    cards = [['accountID', 'cardNum', 'pin', 'failedTries']]
+    client_cards, atm_cards = [], []
+    for i in range(1, clients + 1):
+        balance = f"{rng.randint(1000, 100000) / 100:.2f}"
+        client_card = f"45{i:014d}"
+        atm_card = f"53{i:014d}"
+        client.append([client_card, f"{1000 + i % 9000}", f"First{i}", f"Last{i}", balance])
+        holders.append([str(i), f"First{i}", f"Last{i}", f"555-{i:04d}"])
+        accounts.append([str(100 + i), str(i), balance])
+        cards.append([str(100 + i), atm_card, f"{1000 + i % 9000}", "0"])
+        client_cards.append((client_card, f"{1000 + i % 9000}"))
+        atm_cards.append((atm_card, f"{1000 + i % 9000}"))
+    sheets = {"client": client, "accountHolder": holders, "account": accounts, "atmCards": cards}
+    return sheets, client_cards, atm_cards
+
+
+def _scripted(answers):
+    """Feed answers to input() and run.get_pin() in order."""
+    answers = iter(answers)
+    return lambda *args, **kwargs: next(answers)
+
+
+class Benchmark:
+    """
+    Drives the ATM operations against an emulated backend.
+
+    Args:
+        emulator: SheetsEmulator holding the "client_database" spreadsheet
+        client_cards: (card, pin) pairs from the 'client' tab
+        atm_cards: (card, pin) pairs from the 'atmCards' tab
+        flow: "repo" (SimpleClientRepo / ClientRecord) or "api" (API / ATMCard)
+        seed: Seed for picking cards
+    """
+    def __init__(self, emulator, client_cards, atm_cards, flow="repo", seed=0):
+        self.emulator = emulator
+        self.cards = client_cards if flow == "repo" else atm_cards
+        self.client_cards = client_cards
+        self.flow = flow
+        self.rng = random.Random(seed)
+        self.samples = {op: [] for op in OPERATIONS}
+        # Current PIN of each card whose PIN the pin_change runs changed
+        self.pins = {}
+        import run
+        self.run = run
+
+    def login(self, card, pin):
+        """run.authenticate with the card and PIN typed in."""
+        with patch("builtins.input", _scripted([card])), patch.object(self.run, "get_pin", _scripted([pin])):
+            return self.run.authenticate(self.run.api)
+
+    @staticmethod
+    def _other_pin(pin):
+        # A different valid PIN to switch to and back from
+        return "1111" if pin != "1111" else "2222"
+
+    def perform(self, op, auth, pin):
+        """
+        Run a menu action for a logged-in session the way run.main() does.
+        pin_change alternates each card between its PIN and another one,
+        so every run writes.
+
+        Returns:
+            True/False for success, or None if the flow has no such action
+        """
+        from cardHolder import UnitOfWork
+        run = self.run
+        source, obj = auth
+        if op == "withdraw":
+            if source == "api":
+                return UnitOfWork.run(obj.withdraw, 1)
+            return run.repo.update_balance(obj.cardNum, obj.balance - 1, expected=obj)
+        if op == "deposit":
+            if source == "api":
+                return UnitOfWork.run(obj.deposit, 1)
+            return run.repo.update_balance(obj.cardNum, obj.balance + 1, expected=obj)
+        if op == "pin_change":
+            card = obj.getCardNumber() if source == "api" else obj.cardNum
+            original = next(p for c, p in self.cards if c == card)
+            new_pin = self._other_pin(original) if pin == original else original
+            if source == "api":
+                ok = UnitOfWork.run(obj.change_pin, new_pin)
+            else:
+                ok = run.repo.update_pin(obj.cardNum, new_pin)
+            if ok:
+                self.pins[card] = new_pin
+            return ok
+        if op == "transfer":
+            # transfer_money works on ClientRecords, so only the repo flow has it
+            if source != "repo":
+                return None
+            dest = self.rng.choice([c for c, _ in self.client_cards if c != obj.cardNum])
+            balance = obj.balance
+            with patch("builtins.input", _scripted(["1", dest, "y"])):
+                run.transfer_money(obj, run.repo)
+            return obj.balance != balance
+        raise ValueError(f"unknown operation {op}")
+
+    def measure(self, op):
+        """
+        Run one operation and record a sample. For menu actions the login
+        that precedes them is not part of the measurement.
+        """
+        card, pin = self.rng.choice(self.cards)
+        pin = self.pins.get(card, pin)
+        with redirect_stdout(io.StringIO()):
+            if op == "authenticate":
+                before = self.emulator.stats()
+                started = time.perf_counter()
+                ok = self.login(card, pin) is not None
+            else:
+                auth = self.login(card, pin)
+                before = self.emulator.stats()
+                started = time.perf_counter()
+                ok = self.perform(op, auth, pin) if auth else False
+            elapsed = time.perf_counter() - started
+        if ok is None:
+            return None
+        after = self.emulator.stats()
+        sample = {
+            "ok": bool(ok),
+            "seconds": elapsed,
+            "round_trips": after["round_trips"] - before["round_trips"],
+            "bytes": (after["bytes_sent"] + after["bytes_received"]
+                      - before["bytes_sent"] - before["bytes_received"]),
+        }
+        self.samples[op].append(sample)
+        return sample
+
+    def run_all(self, iterations=50, warmup=2, operations=OPERATIONS):
+        for op in operations:
+            for _ in range(warmup):
+                self.measure(op)
+            self.samples[op] = []
+            for _ in range(iterations):
+                if self.measure(op) is None:
+                    break
+        return self.report()
+
+    def report(self):
+        results = {}
+        for op, samples in self.samples.items():
+            if not samples:
+                continue
+            seconds = [s["seconds"] * 1000 for s in samples]
+            results[op] = {
+                "count": len(samples),
+                "failures": sum(1 for s in samples if not s["ok"]),
+                "p50_ms": percentile(seconds, 50),
+                "p95_ms": percentile(seconds, 95),
+                "p99_ms": percentile(seconds, 99),
+                "mean_ms": sum(seconds) / len(seconds),
+                "round_trips": sum(s["round_trips"] for s in samples) / len(samples),
+                "bytes": sum(s["bytes"] for s in samples) / len(samples),
+            }
+        return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_benchmark(iterations=50, warmup=2, clients=200, flow="repo", latency=0.0, jitter=0.0,
+                  quota_error_rate=0.0, transient_error_rate=0.0, seed=0, operations=OPERATIONS):
+    """
+    Build an emulated backend, point run.py at it and benchmark the operations.
+
+    Returns:
+        Dict with "config", "environment" and "results" keys (JSON-serializable)
+    """
+    from cardHolder import SheetsConnection
+    sheets, client_cards, atm_cards = build_dataset(clients, seed)
+    emulator = SheetsEmulator(latency=latency, jitter=jitter, quota_error_rate=quota_error_rate,
+                              transient_error_rate=transient_error_rate, seed=seed)
+    emulator.load("client_database", sheets)
+    workdir = tempfile.mkdtemp(prefix="atm-bench-")
+    SheetsConnection.reset()
+    install(emulator)
+    with patch.dict(os.environ, {"ATM_JOURNAL_PATH": os.path.join(workdir, "transfers.journal"),
+                                 "ATM_BACKEND": "sheets"}):
+        os.environ.pop("ATM_WRITE_BEHIND_JOURNAL", None)
+        with redirect_stdout(io.StringIO()):
+            import run
+            from cardHolder import API, SimpleClientRepo
+            # run.py may already have been imported against another backend
+            run.api = API()
+            run.repo = SimpleClientRepo(journal_path=os.environ["ATM_JOURNAL_PATH"])
+        bench = Benchmark(emulator, client_cards, atm_cards, flow=flow, seed=seed)
+        results = bench.run_all(iterations=iterations, warmup=warmup, operations=operations)
+    return {
+        "config": {
+            "iterations": iterations, "warmup": warmup, "clients": clients, "flow": flow,
+            "latency": latency, "jitter": jitter, "quota_error_rate": quota_error_rate,
+            "transient_error_rate": transient_error_rate, "seed": seed,
+        },
+        "environment": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+
+
+def print_report(report):
+    print(f"{'operation':<14}{'n':>5}{'fail':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'trips':>8}{'bytes':>10}")
+    for op, r in report["results"].items():
+        print(f"{op:<14}{r['count']:>5}{r['failures']:>6}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['round_trips']:>8.1f}{r['bytes']:>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ATM operations against an emulated Sheets backend")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--clients", type=int, default=200, help="rows per worksheet")
+    parser.add_argument("--flow", choices=("repo", "api"), default="repo")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per backend call")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--quota-error-rate", type=float, default=0.0)
+    parser.add_argument("--transient-error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--operations", default=",".join(OPERATIONS))
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(iterations=args.iterations, warmup=args.warmup, clients=args.clients,
+                           flow=args.flow, latency=args.latency, jitter=args.jitter,
+                           quota_error_rate=args.quota_error_rate,
+                           transient_error_rate=args.transient_error_rate, seed=args.seed,
+                           operations=[op.strip() for op in args.operations.split(",") if op.strip()])
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,29 @@
+import abc
 import sys
-import gspread
-from google.oauth2.service_account import Credentials
+import time
+import threading
+import functools
+import contextvars
+from journal import Journal, JournalFlusher
+from instrumentation import METRICS
+from locks import LOCKS, LockTimeout
+from money import Money
+from scheduler import RequestScheduler, call_kind
+
+# gspread and google-auth take most of the import time of this module, so
+# they are loaded on first use: by SheetsConnection when it authorizes, or
+# through module attribute access (cardHolder.gspread / cardHolder.Credentials)
+def _load_google():
+    global gspread, Credentials
+    import gspread
+    import gspread.utils
+    from google.oauth2.service_account import Credentials
+
+def __getattr__(name):
+    if name in ("gspread", "Credentials"):
+        _load_google()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # General functions will be used repeatedly
 
@@ -23,7 +46,7 @@ def transfer_money(source_obj, repo):
     
     # Get and validate amount
     try:
-        amount = float(input("Amount to transfer: €").strip().replace(',', ''))
+        amount = Money.parse(input("Amount to transfer: €").strip())
         if amount <= 0:
             print("Amount must be positive.")
             return
@@ -56,11 +79,21 @@ def transfer_money(source_obj, repo):
         print("Transfer cancelled.")
         return
 
-    # Perform transfer
-    if (repo.update_balance(source_obj.cardNum, source_obj.balance - amount) and
-        repo.update_balance(dest_rec.cardNum, dest_rec.balance + amount)):
+    # Perform transfer: repos with transfer() write both balances in one request
+    if hasattr(repo, "transfer"):
+        transferred = repo.transfer(source_obj, dest_rec, amount)
+    else:
+        # Both cards stay locked until the second write is done
+        try:
+            with LOCKS.hold(_lock_key("client", source_obj.cardNum), _lock_key("client", dest_rec.cardNum)):
+                transferred = (repo.update_balance(source_obj.cardNum, source_obj.balance - amount) and
+                               repo.update_balance(dest_rec.cardNum, dest_rec.balance + amount))
+        except LockTimeout as e:
+            print(f"[ERROR] {e}")
+            transferred = False
+    if transferred:
         
-        # Update local objects
+        # Update local objects (transfer() may have refreshed their balances first)
         source_obj.balance -= amount
         dest_rec.balance += amount
         
@@ -70,6 +103,69 @@ def transfer_money(source_obj, repo):
     else:
         print("Transfer failed. Please try again.")
 
+def _join_key(value):
+    """Normalise an ID cell so '100', ' 100' and 100 join together."""
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return str(value).strip()
+
+def _lock_key(sheet, key):
+    """LOCKS key of a worksheet row, e.g. 'account:100'."""
+    return f"{sheet}:{_join_key(key)}"
+
+def _serialized(keys):
+    """
+    Run a mutation method while holding the LOCKS of the rows it writes,
+    so sessions working on the same card or account take turns.
+
+    Args:
+        keys: Function of the method's arguments (self included) returning
+            the (sheet, key) pairs to lock
+
+    A lock that is not free within LOCKS.timeout fails the call: it
+    returns False, as the methods do for other errors. Inside a
+    UnitOfWork the lock only covers recording the change; commit() locks
+    the rows again while it writes them.
+    """
+    def decorate(method):
+        @functools.wraps(method)
+        def locked(*args, **kwargs):
+            try:
+                with LOCKS.hold(*(_lock_key(sheet, key) for sheet, key in keys(*args, **kwargs))):
+                    return method(*args, **kwargs)
+            except LockTimeout as e:
+                print(f"[ERROR] {e}")
+                return False
+        return locked
+    return decorate
+
+def hash_join(left_rows, right_rows, left_key, right_key):
+    """
+    Join two lists of sheet rows on a key column in linear time.
+
+    Builds a dict over right_rows keyed by right_key, then probes it once per
+    left row. Left rows without a match are dropped (inner join).
+
+    Args:
+        left_rows: Rows to emit in order (e.g. atmCards or accountHolder rows)
+        right_rows: Rows to index (e.g. account rows)
+        left_key: Column index of the join key in left_rows
+        right_key: Column index of the join key in right_rows
+
+    Returns:
+        Generator of (left_row, right_row) tuples
+    """
+    index = {}
+    for row in right_rows:
+        if len(row) > right_key:
+            index.setdefault(_join_key(row[right_key]), []).append(row)
+    for row in left_rows:
+        if len(row) <= left_key:
+            continue
+        for match in index.get(_join_key(row[left_key]), ()):
+            yield row, match
+
 def show_welcome_message(client):
     print("\n" + "═" * 50)
     print("       WELCOME TO YOUR ACCOUNT")
@@ -92,56 +188,970 @@ def _parse_balance_str(val):
         Float value of the balance, or 0.0 if parsing fails
     """
     try:
-        if isinstance(val, (int, float)):
-            return float(val)
-        s = str(val).replace('\xa0', '').replace(' ', '')
-        s = s.replace(',', '.')
-        return float(s)
+        return float(Money.parse(val))
     except (ValueError, TypeError):
         return 0.0
 
+def _scheduled(name, key, fn, worksheet, args):
+    """
+    Make one backend call: through the RequestScheduler when one is
+    enabled, and recorded in METRICS either way.
+    """
+    def request():
+        with METRICS.timed(name, worksheet, args) as timing:
+            timing["result"] = fn()
+        return timing["result"]
+    scheduler = RequestScheduler.active()
+    if scheduler is None:
+        return request()
+    return scheduler.submit(call_kind(name), key, request)
+
+class WorksheetCache:
+    """
+    Wraps an opened spreadsheet and caches worksheet handles by title, so
+    resolving a tab by name costs one metadata request per process instead
+    of one per call. Everything else is delegated to the spreadsheet.
+
+    Handles are dropped when the tab is deleted or renamed through this
+    cache, and when a call on a handle fails because the tab no longer
+    exists under that title (e.g. it was renamed or deleted elsewhere).
+    """
+    def __init__(self, spreadsheet):
+        self._spreadsheet = spreadsheet
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def worksheet(self, title):
+        with self._lock:
+            handle = self._handles.get(title)
+        if handle is not None:
+            return handle
+        worksheet = _scheduled("worksheet", (id(self), "worksheet", title),
+                               lambda: self._spreadsheet.worksheet(title), title, (title,))
+        handle = _CachedWorksheet(self, title, worksheet)
+        with self._lock:
+            return self._handles.setdefault(title, handle)
+
+    def invalidate(self, title=None):
+        """Forget one cached handle, or all of them when title is None."""
+        with self._lock:
+            if title is None:
+                self._handles.clear()
+            else:
+                self._handles.pop(title, None)
+
+    def del_worksheet(self, worksheet):
+        title = worksheet.title
+        if isinstance(worksheet, _CachedWorksheet):
+            worksheet = worksheet._worksheet
+        result = self._spreadsheet.del_worksheet(worksheet)
+        self.invalidate(title)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._spreadsheet, name)
+
+class _CachedWorksheet:
+    """
+    Worksheet handle handed out by WorksheetCache. Every call through it
+    is recorded in instrumentation.METRICS.
+    """
+    # Sheets answers 400 "Unable to parse range" for a stale tab title
+    # and 404 for a deleted tab
+    STALE_STATUS = (400, 404)
+
+    def __init__(self, cache, title, worksheet):
+        self._cache = cache
+        self._title = title
+        self._worksheet = worksheet
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                key = (id(self._cache), self._title, name, repr(args), repr(sorted(kwargs.items())))
+                result = _scheduled(name, key, lambda: attr(*args, **kwargs), self._title, args)
+            except Exception as e:
+                # gspread.exceptions.APIError carries the HTTP response
+                if getattr(getattr(e, "response", None), "status_code", None) in self.STALE_STATUS:
+                    self._cache.invalidate(self._title)
+                raise
+            if name == "update_title":
+                self._cache.invalidate(self._title)
+            return result
+        return call
+
+def _rowcol_to_a1(row, col):
+    """Same as gspread.utils.rowcol_to_a1, without importing gspread."""
+    letters = ""
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return f"{letters}{row}"
+
+def _a1_to_rowcol(label):
+    """Same as gspread.utils.a1_to_rowcol, without importing gspread."""
+    letters = label.rstrip("0123456789").upper()
+    digits = label[len(letters):]
+    if not letters or not digits or not letters.isalpha():
+        raise ValueError(f"Invalid A1 cell label: {label!r}")
+    col = 0
+    for ch in letters:
+        col = col * 26 + ord(ch) - ord("A") + 1
+    return int(digits), col
+
+# Rows fetched per request by iter_rows
+READ_PAGE_SIZE = 500
+
+def iter_rows(ws, columns, page_size=None, first_column=1):
+    """
+    Stream the rows below a worksheet's header in fixed-size A1 range pages
+    ("A2:E501", "A502:E1001", ...). A page is only requested when the
+    previous one has been consumed, so a lookup that stops at its row
+    fetches no further pages and at most one page is held in memory.
+
+    Sheets leaves trailing empty rows out of a range response, so a short
+    page only means the rows after it in the page are blank, not that the
+    data ended. Reading ends at the first page that comes back empty or,
+    when the worksheet reports its row_count, at a short page reaching
+    past the last row.
+
+    Args:
+        ws: Worksheet to read
+        columns: Number of columns to read, starting at first_column
+        page_size: Rows per request (defaults to READ_PAGE_SIZE)
+        first_column: 1-based column the pages start at
+
+    Yields:
+        (row_number, row) with the 1-based sheet row number and the row
+        padded to the requested width; blank rows are skipped
+    """
+    page_size = page_size or READ_PAGE_SIZE
+    last_column = first_column + columns - 1
+    row_count = getattr(ws, "row_count", None)
+    if not isinstance(row_count, int) or isinstance(row_count, bool):
+        row_count = None
+    start = 2
+    while True:
+        end = start + page_size - 1
+        rows = ws.get_values(f"{_rowcol_to_a1(start, first_column)}:{_rowcol_to_a1(end, last_column)}")
+        for offset, row in enumerate(rows):
+            # Sheets leaves out trailing empty cells
+            if any(str(v).strip() for v in row):
+                yield start + offset, list(row) + [""] * (columns - len(row))
+        if not rows or (len(rows) < page_size and row_count is not None and end >= row_count):
+            return
+        start = end + 1
+
+def find_rows(ws, key_column, key, columns, first_only=False):
+    """
+    Projected lookup: page through the key column alone, then fetch the
+    declared columns of the matching rows in one batch_get request.
+
+    Args:
+        ws: Worksheet to search
+        key_column: 1-based column compared with key (IDs compare as numbers)
+        key: Value to look for
+        columns: (first, last) 1-based column span returned for matches
+        first_only: Stop reading the key column at the first match
+
+    Returns:
+        List of (row_number, row) with rows covering the requested span
+    """
+    key = _join_key(key)
+    matches = []
+    for row_num, row in iter_rows(ws, 1, first_column=key_column):
+        if _join_key(row[0]) == key:
+            matches.append(row_num)
+            if first_only:
+                break
+    if not matches:
+        return []
+    first, last = columns
+    width = last - first + 1
+    ranges = [f"{_rowcol_to_a1(r, first)}:{_rowcol_to_a1(r, last)}" for r in matches]
+    found = ws.batch_get(ranges)
+    result = []
+    for row_num, values in zip(matches, found):
+        row = list(values[0]) if values else []
+        result.append((row_num, row + [""] * (width - len(row))))
+    return result
+
+def _version(value):
+    """Version stamp of a row; a blank cell (row never written with a stamp) is 0."""
+    try:
+        return int(float(str(value).strip() or 0))
+    except ValueError:
+        return 0
+
+# Attempts a versioned balance write makes before giving up
+CAS_RETRIES = 5
+
+def compare_and_set(ws, writes, cells=()):
+    """
+    Versioned write of one or more rows. Each write is (row, col, value,
+    version): value goes to col if the row's version stamp, kept in the
+    next column, still equals version, and the stamp is incremented. A
+    version of None writes whatever the stamp is, still incrementing it.
+    Further (row, col, value) cells are written in the same request.
+    Nothing is written when any stamp differs.
+
+    Sheets has no conditional update, so the stamps are read with one
+    batch_get right before a single batch_update. Every change made before
+    that read is caught; only the gap between the two requests is not.
+    Worksheets that can check the stamps atomically set ATOMIC_CAS and
+    provide their own compare_and_set (sqlite_backend.SqliteWorksheet).
+
+    Returns:
+        None once written, otherwise {row: (value, version)} with the
+        current cells of every row
+    """
+    if getattr(ws, "ATOMIC_CAS", False) is True:
+        return ws.compare_and_set(writes, cells)
+    ranges = [f"{_rowcol_to_a1(row, col)}:{_rowcol_to_a1(row, col + 1)}" for row, col, _, _ in writes]
+    current = {}
+    for (row, _, _, _), values in zip(writes, ws.batch_get(ranges)):
+        stamped = (list(values[0]) if values else []) + ["", ""]
+        current[row] = (stamped[0], _version(stamped[1]))
+    if any(version is not None and current[row][1] != version for row, _, _, version in writes):
+        return current
+    with CellBatch(ws) as batch:
+        for row, col, value in cells:
+            batch.update_cell(row, col, value)
+        for row, col, value, version in writes:
+            batch.update_cell(row, col, value)
+            batch.update_cell(row, col + 1, current[row][1] + 1)
+    return None
+
+def _locate_row(ws, key_column, key):
+    """Sheet row whose key column matches key (paged read), or None."""
+    key = _join_key(key)
+    for row_num, row in iter_rows(ws, 1, first_column=key_column):
+        if _join_key(row[0]) == key:
+            return row_num
+    return None
+
+def _read_stamped(ws, key_column, key, col, row=None):
+    """
+    (value, version) of a row's cell in col and of its version stamp in
+    col + 1, read with one request once the row is known.
+    """
+    row = row or _locate_row(ws, key_column, key)
+    if row is None:
+        raise LookupError(f"{ws.title} row {key} not found")
+    values = ws.batch_get([f"{_rowcol_to_a1(row, col)}:{_rowcol_to_a1(row, col + 1)}"])[0]
+    cells = (list(values[0]) if values else []) + ["", ""]
+    return cells[0], _version(cells[1])
+
+class CellBatch:
+    """
+    Collects the cell writes of one logical operation and sends them to a
+    worksheet in a single request.
+
+    Writes to adjacent columns of the same row are merged into one range
+    and a later write to the same cell replaces an earlier one. A batch
+    holding a single cell is sent with update_cell.
+
+    Usage:
+        with CellBatch(ws) as batch:
+            batch.update_cell(row, 2, firstname)
+            batch.update_cell(row, 3, lastname)
+    """
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self._cells = {}
+
+    def __len__(self):
+        return len(self._cells)
+
+    def update_cell(self, row, col, value):
+        self._cells[(int(row), int(col))] = value
+
+    @staticmethod
+    def ranges(cells):
+        """
+        Group {(row, col): value} into batch_update ranges.
+
+        Returns:
+            List of {"range": "B2:D2", "values": [[...]]} dicts
+        """
+        data = []
+        run = []
+        for (row, col) in sorted(cells):
+            if run and (row != run[-1][0] or col != run[-1][1] + 1):
+                data.append(CellBatch._range(run, cells))
+                run = []
+            run.append((row, col))
+        if run:
+            data.append(CellBatch._range(run, cells))
+        return data
+
+    @staticmethod
+    def _range(run, cells):
+        first, last = run[0], run[-1]
+        name = _rowcol_to_a1(*first)
+        if last != first:
+            name += ":" + _rowcol_to_a1(*last)
+        return {"range": name, "values": [[cells[cell] for cell in run]]}
+
+    def flush(self):
+        """Send the collected writes. Returns the API response, or None if empty."""
+        cells, self._cells = self._cells, {}
+        if not cells:
+            return None
+        if len(cells) == 1:
+            (row, col), value = next(iter(cells.items()))
+            return self.worksheet.update_cell(row, col, value)
+        # USER_ENTERED matches how update_cell stores values
+        return self.worksheet.batch_update(self.ranges(cells), value_input_option="USER_ENTERED")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
+
+class SheetsConnection:
+    """
+    Process-wide Google Sheets connection registry.
+
+    Holds one authorized gspread client and one opened spreadsheet per
+    (credentials file, spreadsheet name) pair, shared by API,
+    SimpleClientRepo and the model classes. The client's authorized session
+    refreshes the OAuth token on demand, so token refresh happens on this
+    single credentials object rather than once per caller. The spreadsheet
+    is wrapped in a WorksheetCache so tab lookups are resolved once.
+    """
+    SCOPE = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive.file",
+        "https://www.googleapis.com/auth/drive",
+    ]
+
+    _lock = threading.Lock()
+    _connections = {}
+
+    def __init__(self, creds_json_path="creds.json", spreadsheet_name="client_database"):
+        _load_google()
+        self.CREDS = Credentials.from_service_account_file(creds_json_path)
+        self.SCOPED_CREDS = self.CREDS.with_scopes(self.SCOPE)
+        self.CLIENT = gspread.authorize(self.SCOPED_CREDS)
+        with METRICS.timed("open", None, (spreadsheet_name,)):
+            spreadsheet = self.CLIENT.open(spreadsheet_name)
+        self.SHEET = WorksheetCache(spreadsheet)
+
+    @classmethod
+    def get(cls, creds_json_path="creds.json", spreadsheet_name="client_database"):
+        """
+        Return the shared connection, authorizing on first use.
+        Failed attempts are not cached, so the next call retries.
+        """
+        key = (creds_json_path, spreadsheet_name)
+        with cls._lock:
+            conn = cls._connections.get(key)
+            if conn is None:
+                conn = cls(creds_json_path, spreadsheet_name)
+                cls._connections[key] = conn
+            return conn
+
+    @classmethod
+    def use_spreadsheet(cls, spreadsheet, creds_json_path="creds.json", spreadsheet_name="client_database"):
+        """
+        Register a non-Google backend exposing the same worksheet surface
+        (e.g. sqlite_backend.SqliteSpreadsheet). Every API(), repo and model
+        asking for this connection then reads and writes through it.
+        """
+        conn = cls.__new__(cls)
+        conn.CREDS = conn.SCOPED_CREDS = conn.CLIENT = None
+        conn.SHEET = WorksheetCache(spreadsheet)
+        with cls._lock:
+            cls._connections[(creds_json_path, spreadsheet_name)] = conn
+        return conn
+
+    @classmethod
+    def reset(cls):
+        """Drop all shared connections (e.g. after rotating credentials)."""
+        with cls._lock:
+            cls._connections.clear()
+
+class WriteBehind:
+    """
+    Opt-in write-behind durability mode.
+
+    Mutations are appended to a local fsync'ed Journal and acknowledged
+    straight away; a JournalFlusher thread then applies them to the
+    spreadsheet in batches (one CellBatch per worksheet) and, on start,
+    replays entries a crashed process never flushed.
+
+    One process owns a journal at a time (Journal.claim()): enabling
+    write-behind on a journal another live process uses raises
+    JournalBusy, so every pending entry at start belongs to a dead
+    process and is replayed straight away. Where flock() is missing
+    (Windows) the claim is not enforced and only entries older than
+    30 seconds are replayed.
+
+    Values are absolute, so balance writes also journal the version stamp
+    they were based on. The flusher checks it against the sheet: an entry
+    whose balance is already stored (a replay) is skipped, and one whose
+    row was changed by another process in the meantime is not written
+    but recorded as aborted (reason "stale") for reconciliation.
+
+    Each write is a tuple (sheet, key_col, key, {col: value}) and targets
+    the row whose key_col cell equals key, e.g.
+    ("client", 1, card_num, {5: balance}).
+
+    Balances are written with compare_and_set() so they carry a version
+    stamp, and the API lookups overlay the writes still queued, so a
+    session loading an account before the flush sees (and checks against)
+    the journaled balance rather than the sheet's.
+
+    Enable it once per process with WriteBehind.enable(journal_path); the
+    repo and model classes pick up the active instance.
+    """
+    _active = None
+    _lock = threading.Lock()
+
+    def __init__(self, journal_path, spreadsheet=None, interval=0.5, max_batch=200):
+        self.journal = Journal(journal_path)
+        claimed = self.journal.claim()
+        self.spreadsheet = spreadsheet
+        # Makes the version check and the journaling of compare_and_set atomic
+        self._cas_lock = threading.Lock()
+        self.flusher = JournalFlusher(self.journal, self._apply, op="write",
+                                      interval=interval, max_batch=max_batch,
+                                      replay_min_age=0.0 if claimed else 30.0)
+        self.flusher.start()
+
+    @classmethod
+    def enable(cls, journal_path, **kwargs):
+        with cls._lock:
+            if cls._active is None:
+                cls._active = cls(journal_path, **kwargs)
+            return cls._active
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    @classmethod
+    def disable(cls, timeout=None):
+        """Flush queued writes (up to timeout) and switch the mode off."""
+        with cls._lock:
+            active, cls._active = cls._active, None
+        if active is not None:
+            try:
+                return active.flusher.stop(timeout)
+            finally:
+                active.journal.release()
+        return True
+
+    def write(self, writes, checks=None):
+        """
+        Journal a list of writes as one entry and queue it for flushing.
+
+        checks maps (sheet, key) to (col, version): the version stamp in
+        col that the row's write was based on, checked again when the
+        entry is applied (see _apply).
+        """
+        checks = {(sheet, str(key).strip()): check for (sheet, key), check in (checks or {}).items()}
+        data = []
+        for sheet, key_col, key, cells in writes:
+            write = {"sheet": sheet, "key_col": key_col, "key": str(key).strip(),
+                     "cells": [[col, value] for col, value in cells.items()]}
+            if (sheet, write["key"]) in checks:
+                write["check"] = list(checks[(sheet, write["key"])])
+            data.append(write)
+        entry_id = self.journal.begin("write", writes=data)
+        self.flusher.submit({"id": entry_id, "writes": data})
+
+    def pending_cells(self, sheet):
+        """Yield (key, col, value) for unflushed writes to a worksheet, oldest first."""
+        for record in self.flusher.queued():
+            for write in record["writes"]:
+                if write["sheet"] == sheet:
+                    for col, value in write["cells"]:
+                        yield write["key"], col, value
+
+    def pending_rows(self, sheet):
+        """Unflushed cells of a worksheet: {(key_col, key): {col: value}} with the newest values."""
+        rows = {}
+        for record in self.flusher.queued():
+            for write in record["writes"]:
+                if write["sheet"] == sheet:
+                    cells = rows.setdefault((write["key_col"], _join_key(write["key"])), {})
+                    cells.update((col, value) for col, value in write["cells"])
+        return rows
+
+    def current(self, sheet, key_col, key, col, stored):
+        """
+        (value, version) of a row's cell in col and of its stamp in col + 1
+        as they will be once the queued writes are applied; stored is used
+        as in compare_and_set().
+        """
+        pending = self.pending_rows(sheet).get((key_col, _join_key(key)), {})
+        if col + 1 in pending:
+            return pending.get(col, ""), _version(pending[col + 1])
+        value, version = stored(sheet, key_col, key, col)
+        return pending.get(col, value), version
+
+    def compare_and_set(self, writes, checks, stored):
+        """
+        Journal writes (as write() does) only if every checked row still
+        has the expected version stamp, counting the writes that are
+        queued but not flushed yet. The stamps are written incremented
+        in the same journal entry.
+
+        Args:
+            writes: List of (sheet, key_col, key, {col: value})
+            checks: List of (sheet, key_col, key, col, version): the stamp
+                of the row, kept in col + 1, must equal version
+            stored: Function (sheet, key_col, key, col) returning the
+                (value, version) on the sheet, for rows with no queued stamp
+
+        Returns:
+            None once journaled, otherwise {(sheet, key): (value, version)}
+            with the current cells of every checked row
+        """
+        with self._cas_lock:
+            current = {(sheet, str(key).strip()): self.current(sheet, key_col, key, col, stored)
+                       for sheet, key_col, key, col, _ in checks}
+            if any(current[(sheet, str(key).strip())][1] != version for sheet, _, key, _, version in checks):
+                return current
+            stamps = {(sheet, str(key).strip()): (col + 1, version) for sheet, _, key, col, version in checks}
+            entry = []
+            for sheet, key_col, key, cells in writes:
+                cells = dict(cells)
+                stamp = stamps.get((sheet, str(key).strip()))
+                if stamp is not None:
+                    cells[stamp[0]] = stamp[1] + 1
+                entry.append((sheet, key_col, key, cells))
+            self.write(entry, checks=stamps)
+            return None
+
+    def _apply(self, records):
+        # Rows and the stamps of checked writes are read first (one
+        # col_values per key column, one batch_get per worksheet), then the
+        # entries are checked in order, each against the stamps the entries
+        # before it leave, and written with one CellBatch per worksheet.
+        # Returns the ids of stale entries, which the flusher aborts
+        spreadsheet = self.spreadsheet or SheetsConnection.get().SHEET
+        by_sheet = {}
+        for record in records:
+            for write in record["writes"]:
+                by_sheet.setdefault(write["sheet"], []).append(write)
+        sheets, rows, stamps = {}, {}, {}
+        for title, writes in by_sheet.items():
+            ws = sheets[title] = spreadsheet.worksheet(title)
+            for key_col in {w["key_col"] for w in writes}:
+                found = rows[(title, key_col)] = {}
+                for row_num, value in enumerate(ws.col_values(key_col), start=1):
+                    if row_num > 1:
+                        found.setdefault(str(value).strip(), row_num)
+            checked = sorted({(found_row, w["check"][0]) for w in writes if w.get("check")
+                              for found_row in [rows[(title, w["key_col"])].get(w["key"])] if found_row})
+            if checked:
+                ranges = [f"{_rowcol_to_a1(row, col - 1)}:{_rowcol_to_a1(row, col)}" for row, col in checked]
+                for (row, col), values in zip(checked, ws.batch_get(ranges)):
+                    cells = (list(values[0]) if values else []) + ["", ""]
+                    stamps[(title, row, col)] = (cells[0], _version(cells[1]))
+        batches = {title: [] for title in sheets}
+        stale = []
+        for record in records:
+            located, outcome = [], {}
+            for write in record["writes"]:
+                title = write["sheet"]
+                row = rows[(title, write["key_col"])].get(write["key"])
+                if row is None:
+                    print(f"[WARN] Dropping journaled write for missing {title} row {write['key']}")
+                    continue
+                located.append((title, row, write))
+                if write.get("check"):
+                    outcome[id(write)] = self._check(write, stamps[(title, row, write["check"][0])])
+            if "stale" in outcome.values():
+                print(f"[WARN] Not applying journaled write {record['id']}: changed on the sheet since")
+                stale.append(record["id"])
+                continue
+            for title, row, write in located:
+                if outcome.get(id(write)) == "applied":
+                    continue
+                batches[title].append((row, write))
+                if write.get("check"):
+                    col = write["check"][0]
+                    cells = dict(write["cells"])
+                    stamps[(title, row, col)] = (cells.get(col - 1, ""), _version(cells[col]))
+        for title, writes in batches.items():
+            with CellBatch(sheets[title]) as batch:
+                for row, write in writes:
+                    for col, value in write["cells"]:
+                        batch.update_cell(row, col, value)
+        return stale
+
+    @staticmethod
+    def _check(write, stored):
+        # "ok" when the row still has the stamp the write was based on,
+        # "applied" when it already holds the write (a replay), else "stale"
+        col, version = write["check"]
+        value, stamp = stored
+        if stamp == version:
+            return "ok"
+        cells = dict(write["cells"])
+        if stamp == _version(cells.get(col)) and col - 1 in cells:
+            try:
+                if Money.parse(value) == Money.parse(cells[col - 1]):
+                    return "applied"
+            except (ValueError, TypeError):
+                pass
+        return "stale"
+
+class UnitOfWork:
+    """
+    Change tracking for the ATMCard / Account / AccountHolder writes of
+    one session operation.
+
+    Inside a unit of work the model setters only record the cells whose
+    value actually changes (writing a value the cell already holds is
+    skipped, and so is a change that is later undone); commit() then
+    writes all of them with one CellBatch per worksheet, or as a single
+    journal entry when WriteBehind is active. Rows the API already located
+    are written directly; other rows are found with one read of the key
+    column per worksheet. Increments use the balance loaded with the model
+    instead of re-reading the row.
+
+    The active unit of work is held in a context variable, so sessions on
+    different threads or asyncio tasks each have their own.
+
+    Usage:
+        with UnitOfWork() as uow:
+            card.withdraw(20)
+            card.setPin("4321")
+            ok = uow.commit()
+
+    Changes that were not committed when the block exits are discarded
+    and the model attributes they touched are restored.
+    """
+    _current = contextvars.ContextVar("atm_unit_of_work", default=None)
+
+    def __init__(self):
+        # (sheet, key) -> {"key_col", "key", "row", "cells": {col: [before, value]}}
+        self._changes = {}
+        # (model, attribute, value) to restore when the changes are discarded
+        self._undo = []
+        self._token = None
+
+    @classmethod
+    def current(cls):
+        return cls._current.get()
+
+    @classmethod
+    def run(cls, fn, *args, best_effort=False):
+        """
+        Call fn(*args) in a new unit of work and commit its changes.
+
+        Pass best_effort=True when fn's answer stands even if its writes
+        are lost, e.g. verify_pin: a failed commit of the failed-tries
+        counter is reported but does not reject a correct PIN.
+
+        Returns:
+            fn's result, or False if the changes could not be written
+            (unless best_effort)
+        """
+        with cls() as uow:
+            result = fn(*args)
+            if not uow.commit() and not best_effort:
+                return False
+            return result
+
+    def record(self, model, attr, sheet, key_col, key, row, col, before, value, version=None):
+        """
+        Note that model.attr is changing and its cell (col of the row whose
+        key_col holds key) goes from before to value. Returns False for a
+        write that changes nothing.
+
+        Pass the row's version stamp (kept in col + 1) for an amount cell:
+        it is then written with compare_and_set and, if the row changed
+        since it was loaded, the difference is applied to the stored
+        amount; model.attr and model.version get the stored values.
+        """
+        if str(before) == str(value):
+            return False
+        change = self._changes.setdefault((sheet, str(key).strip()), {
+            "key_col": key_col, "key": str(key).strip(), "row": row, "cells": {}})
+        change["cells"].setdefault(col, [before, value])[1] = value
+        if version is not None and "version" not in change:
+            change.update(version=version, versioned=(col, model, attr))
+        self._undo.append((model, attr, getattr(model, attr)))
+        return True
+
+    def pending(self, sheet, key, col, default):
+        """Value recorded for a cell in this unit of work, or default."""
+        change = self._changes.get((sheet, str(key).strip()))
+        if change is not None and col in change["cells"]:
+            return change["cells"][col][1]
+        return default
+
+    def changes(self):
+        """
+        The writes that would be committed.
+
+        Returns:
+            List of (sheet, key_col, key, row, {col: value}); row is None
+            when the row has not been located yet
+        """
+        writes = []
+        for (sheet, _), change in self._changes.items():
+            cells = {col: value for col, (before, value) in change["cells"].items()
+                     if str(before) != str(value)}
+            if cells:
+                writes.append((sheet, change["key_col"], change["key"], change["row"], cells))
+        return writes
+
+    def commit(self):
+        """
+        Write the recorded changes in one batched flush.
+
+        Returns:
+            True if they were written (or there was nothing to write),
+            False otherwise; the model attributes are then restored
+
+        The rows written are locked (LOCKS) for the duration of the flush.
+        Version stamps are checked before any cell is written, so a
+        conflict leaves nothing half-written. Worksheets written before a
+        later one fails are not undone; the amounts they stored are kept
+        on the models.
+        """
+        writes = self.changes()
+        try:
+            if writes:
+                with LOCKS.hold(*(_lock_key(w[0], w[2]) for w in writes)):
+                    write_behind = WriteBehind.active()
+                    if write_behind is not None:
+                        self._journal(write_behind)
+                    else:
+                        self._flush(writes)
+        except Exception as e:
+            print(f"[ERROR] Failed to save changes: {e}")
+            self.rollback()
+            return False
+        self._changes.clear()
+        self._undo.clear()
+        return True
+
+    def _flush(self, writes):
+        # Rows are located before anything is written. Worksheets holding a
+        # versioned cell go first, each as one compare_and_set request that
+        # also carries the worksheet's other cells, so a version conflict
+        # that cannot be resolved aborts the commit before any write
+        a = API()
+        by_sheet = {}
+        for write in writes:
+            by_sheet.setdefault(write[0], []).append(write)
+        located = {}
+        for sheet, sheet_writes in by_sheet.items():
+            ws = a.SHEET.worksheet(sheet)
+            rows = self._locate(ws, [w for w in sheet_writes if w[3] is None])
+            located[sheet] = (ws, [(row or rows[(key_col, _join_key(key))], self._changes[(sheet, key)])
+                                   for _, key_col, key, row, _ in sheet_writes])
+        ordered = sorted(located, key=lambda sheet: not any("versioned" in c for _, c in located[sheet][1]))
+        for sheet in ordered:
+            ws, changes = located[sheet]
+            if any("versioned" in change for _, change in changes):
+                self._compare_and_set(ws, changes)
+                continue
+            with CellBatch(ws) as batch:
+                for row, change in changes:
+                    for col, (before, value) in change["cells"].items():
+                        if str(before) != str(value):
+                            batch.update_cell(row, col, value)
+
+    def _compare_and_set(self, ws, changes):
+        # changes: [(row, change)] of one worksheet
+        for _ in range(CAS_RETRIES):
+            versioned, cells = [], []
+            for row, change in changes:
+                col = change.get("versioned", (None,))[0]
+                for c, (before, value) in change["cells"].items():
+                    if c == col:
+                        versioned.append((row, c, value, change["version"]))
+                    elif str(before) != str(value):
+                        cells.append((row, c, value))
+            current = compare_and_set(ws, versioned, cells)
+            if current is None:
+                for _, change in changes:
+                    if "versioned" in change:
+                        self._stored(change)
+                return
+            for row, change in changes:
+                if "versioned" in change and current[row][1] != change["version"]:
+                    self._rebase(change, *current[row])
+        raise RuntimeError(f"{ws.title} rows changed by other sessions {CAS_RETRIES} times in a row")
+
+    def _journal(self, write_behind):
+        # One journal entry, written only if the versioned rows (counting
+        # the writes still queued) have not changed since they were loaded
+        a = API()
+
+        def stored(sheet, key_col, key, col):
+            row = self._changes[(sheet, str(key).strip())]["row"]
+            return _read_stamped(a.SHEET.worksheet(sheet), key_col, key, col, row)
+        for _ in range(CAS_RETRIES):
+            writes = self.changes()
+            versioned = [(w[0], self._changes[(w[0], w[2])]) for w in writes if "versioned" in self._changes[(w[0], w[2])]]
+            checks = [(sheet, change["key_col"], change["key"], change["versioned"][0], change["version"])
+                      for sheet, change in versioned]
+            current = write_behind.compare_and_set([(sheet, key_col, key, cells)
+                                                    for sheet, key_col, key, _, cells in writes], checks, stored)
+            if current is None:
+                for _, change in versioned:
+                    self._stored(change)
+                return
+            for key, (value, version) in current.items():
+                if version != self._changes[key]["version"]:
+                    self._rebase(self._changes[key], value, version)
+        raise RuntimeError(f"Rows changed by other sessions {CAS_RETRIES} times in a row")
+
+    def _stored(self, change):
+        # A versioned cell was written: update the model, which a later
+        # failure must not restore to the old amount
+        col, model, attr = change["versioned"]
+        setattr(model, attr, Money.parse(change["cells"][col][1]))
+        model.version = change["version"] + 1
+        self._undo = [u for u in self._undo if not (u[0] is model and u[1] == attr)]
+
+    def _rebase(self, change, stored, version):
+        # Changed by another session: apply the difference to the stored amount
+        col = change["versioned"][0]
+        before, value = change["cells"][col]
+        amount = Money.parse(value) - Money.parse(before)
+        stored = _money_or_zero(stored)
+        if amount < 0 and stored + amount < 0:
+            raise ValueError("insufficient funds")
+        change["cells"][col] = [float(stored), float(stored + amount)]
+        change["version"] = version
+
+    @staticmethod
+    def _locate(ws, writes):
+        # One paged read of each key column, stopping once every key is found
+        rows = {}
+        for key_col in {w[1] for w in writes}:
+            wanted = {_join_key(w[2]) for w in writes if w[1] == key_col}
+            for row_num, row in iter_rows(ws, 1, first_column=key_col):
+                key = _join_key(row[0])
+                if key in wanted:
+                    rows[(key_col, key)] = row_num
+                    wanted.discard(key)
+                    if not wanted:
+                        break
+            if wanted:
+                raise LookupError(f"{ws.title} row {sorted(map(str, wanted))[0]} not found")
+        return rows
+
+    def rollback(self):
+        """Discard the recorded changes and restore the model attributes."""
+        for model, attr, value in reversed(self._undo):
+            setattr(model, attr, value)
+        self._changes.clear()
+        self._undo.clear()
+
+    def __enter__(self):
+        self._token = self._current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._current.reset(self._token)
+        self.rollback()
+        return False
+
 class ClientRecord:
     """
     Simple container for a row in the 'client' worksheet:
-    [cardNum, pin, firstName, lastName, balance]
+    [cardNum, pin, firstName, lastName, balance, version]
+
+    version is the row's version stamp when the record was read; versioned
+    balance writes (update_balance with expected=, transfer) check it.
     """
-    def __init__(self, card_num, pin, first_name, last_name, balance):
+    def __init__(self, card_num, pin, first_name, last_name, balance, version=0):
         self.cardNum = str(card_num).strip()
         self.pin = str(pin).strip()
         self.firstName = first_name
         self.lastName = last_name
-        self.balance = _parse_balance_str(balance)
+        self.balance = _money_or_zero(balance)
+        self.version = _version(version)
+
+def _money_or_zero(value):
+    # Unparseable balances count as 0
+    try:
+        return Money.parse(value)
+    except (ValueError, TypeError):
+        return Money(0)
 
-class SimpleClientRepo:
+class ClientSnapshot:
     """
-    Minimal repository for a single worksheet named 'client' with columns:
-    cardNum | pin | firstName | lastName | balance
+    In-memory copy of the 'client' worksheet indexed by cardNum.
+    Each entry keeps the sheet row number next to the row values so
+    writes can target the row directly instead of searching for it.
     """
-    def __init__(self, creds_json_path="creds.json", spreadsheet_name="client_database"):
-        # Try to init Google client; raise if unavailable
-        self.SCOPE = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive.file",
-            "https://www.googleapis.com/auth/drive",
-        ]
-        self.CREDS = Credentials.from_service_account_file(creds_json_path)
-        self.SCOPED = self.CREDS.with_scopes(self.SCOPE)
-        self.CLIENT = gspread.authorize(self.SCOPED)
-        self.SHEET = self.CLIENT.open(spreadsheet_name)
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self.loaded_at = None
+        self._index = {}
 
-    def _ws(self):
-        return self.SHEET.worksheet("client")
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        if self.ttl is None:
+            return False
+        return (time.monotonic() - self.loaded_at) >= self.ttl
 
+    def load(self, rows):
+        """
+        Rebuild the index from a full worksheet download (header included).
+
+        Args:
+            rows: List of rows as returned by get_all_values()
+        """
+        index = {}
+        # Sheet rows are 1-based and row 1 is the header
+        for row_num, row in enumerate(rows[1:], start=2):
+            if not row:
+                continue
+            key = str(row[0]).strip()
+            if key and key not in index:
+                index[key] = (row_num, list(row))
+        self._index = index
+        self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def get(self, card_num):
+        """Return (row_number, row) for a card, or None if it is not indexed."""
+        return self._index.get(str(card_num).strip())
+
+    def set_cell(self, card_num, col, value):
+        """Apply a write to the cached row (col is 1-based, like update_cell)."""
+        entry = self.get(card_num)
+        if not entry:
+            return
+        row = entry[1]
+        while len(row) < col:
+            row.append("")
+        row[col - 1] = value
+
+class ClientRepository(abc.ABC):
+    """
+    Interface shared by the client-record backends: SimpleClientRepo
+    (Google Sheets 'client' worksheet) and sqlite_backend.SqliteClientRepo.
+    run.py and transfer_money only rely on these methods.
+    """
+    @abc.abstractmethod
     def get_record(self, card_num):
-        rows = self._ws().get_all_values()
-        if not rows:
-            return None
-        header = rows[0]
-        # Expecting header: ['cardNum', 'pin', 'firstName', 'lastName', 'balance']
-        for row in rows[1:]:
-            if str(row[0]).strip() == str(card_num).strip():
-                return ClientRecord(row[0], row[1], row[2], row[3], row[4])
-        return None
+        """Return the ClientRecord for a card, or None if it does not exist."""
+        raise NotImplementedError
 
     def verify(self, card_num, pin):
         rec = self.get_record(card_num)
@@ -149,29 +1159,224 @@ class SimpleClientRepo:
             return False
         return str(rec.pin) == str(pin)
 
-    def update_balance(self, card_num, new_balance):
+    @abc.abstractmethod
+    def update_balance(self, card_num, new_balance, expected=None):
+        """
+        Store a balance. Returns True if successful.
+
+        Without expected the balance is written as given (its version
+        stamp is still incremented). With expected,
+        the ClientRecord new_balance was computed from, the write is
+        versioned: the difference from expected.balance is applied to the
+        balance currently stored (see _versioned_write).
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_pin(self, card_num, new_pin):
+        """Store a new PIN. Returns True if successful."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def transfer(self, source, dest, amount):
+        """
+        Debit source and credit dest together, as versioned writes (see
+        _versioned_write). Returns True if successful.
+        """
+        raise NotImplementedError
+
+    def _versioned_write(self, changes, cas):
+        """
+        Add amounts to record balances with compare-and-swap: when another
+        session changed a row since it was read, the current balance and
+        version are taken and the write is retried.
+
+        On success each record holds the new version and the balance the
+        amount was added to: the one it was read with or, after a conflict,
+        the re-read one. Callers apply the amount locally as before.
+
+        Args:
+            changes: List of (record, amount)
+            cas: Function taking [(record, new_balance)] that writes every
+                balance only if each row still has the record's version and
+                returns None, or {cardNum: (balance, version)} with the
+                stored values when a row has moved on
+
+        Returns:
+            True once written; False when a debit no longer fits the
+            current balance or the rows kept changing
+        """
+        for _ in range(CAS_RETRIES):
+            targets = [(rec, rec.balance + amount) for rec, amount in changes]
+            if any(amount < 0 and balance < 0 for (_, amount), (_, balance) in zip(changes, targets)):
+                print("[ERROR] Insufficient funds")
+                return False
+            current = cas(targets)
+            if current is None:
+                for rec, _ in targets:
+                    rec.version += 1
+                return True
+            for rec, _ in changes:
+                balance, version = current[str(rec.cardNum).strip()]
+                rec.balance, rec.version = _money_or_zero(balance), version
+        print(f"[ERROR] Balance changed by other sessions {CAS_RETRIES} times in a row")
+        return False
+
+class SimpleClientRepo(ClientRepository):
+    """
+    Minimal repository for a single worksheet named 'client' with columns:
+    cardNum | pin | firstName | lastName | balance | version
+
+    version is bumped by every balance write and checked by the versioned
+    ones (update_balance with expected=, transfer), so two sessions on the
+    same card cannot overwrite each other's balance; a blank cell counts
+    as 0.
+
+    Pass snapshot_ttl (seconds) to enable snapshot mode: the worksheet is
+    downloaded once into a ClientSnapshot and lookups are served from memory
+    until the TTL expires. Use snapshot_ttl=0 to refresh on every lookup or a
+    negative/None value to disable it (the default).
+
+    Pass write_behind=True (after WriteBehind.enable()) to acknowledge writes
+    once they are journaled locally and let the background flusher apply
+    them. Snapshot mode is switched on with it, since reads must see writes
+    that have not reached the sheet yet.
+
+    Pass journal_path to record transfers in a local Journal. Transfers left
+    half-applied by a crash are completed (or dropped, if nothing was
+    written) the next time a repo is created with the same journal.
+    """
+    # Pending journal entries younger than this may belong to a live session
+    RECOVERY_MIN_AGE = 60.0
+
+    # Columns (first, last) fetched for a card's row once the cardNum
+    # column has located it
+    RECORD_COLUMNS = (1, 6)
+    PIN_COLUMNS = (2, 2)
+
+    def __init__(self, creds_json_path="creds.json", spreadsheet_name="client_database", snapshot_ttl=None, journal_path=None, write_behind=False):
+        # Reuse the shared Google client; raise if unavailable
+        self.SCOPE = SheetsConnection.SCOPE
+        conn = SheetsConnection.get(creds_json_path, spreadsheet_name)
+        self.CREDS = conn.CREDS
+        self.SCOPED = conn.SCOPED_CREDS
+        self.CLIENT = conn.CLIENT
+        self.SHEET = conn.SHEET
+        self.snapshot = None
+        if snapshot_ttl is not None and snapshot_ttl >= 0:
+            self.snapshot = ClientSnapshot(ttl=snapshot_ttl)
+        self.write_behind = None
+        if write_behind:
+            self.write_behind = WriteBehind.active()
+            if self.write_behind is None:
+                raise ValueError("write_behind requires WriteBehind.enable() first")
+            if self.snapshot is None:
+                self.snapshot = ClientSnapshot()
+        self.journal = Journal(journal_path) if journal_path else None
+        # Makes the version check and write of the write-behind path atomic
+        self._cas_lock = threading.Lock()
+        if self.journal is not None:
+            try:
+                self.recover()
+            except Exception as e:
+                print(f"[WARN] Transfer recovery failed: {e}")
+
+    def _ws(self):
+        return self.SHEET.worksheet("client")
+
+    def _snapshot(self):
+        """Return the snapshot, reloading it first if it has expired."""
+        if self.snapshot.is_stale():
+            self.snapshot.load(self._ws().get_all_values())
+            if self.write_behind is not None:
+                # The sheet does not have these yet
+                for card_num, col, value in self.write_behind.pending_cells("client"):
+                    self.snapshot.set_cell(card_num, col, value)
+        return self.snapshot
+
+    def refresh(self):
+        """Force a reload of the snapshot on the next lookup."""
+        if self.snapshot is not None:
+            self.snapshot.invalidate()
+
+    def _find_row(self, ws, card_num):
+        """Return the sheet row number of a card, or None if not found."""
+        if self.snapshot is not None:
+            entry = self._snapshot().get(card_num)
+            if entry:
+                return entry[0]
+        cell = ws.find(str(card_num).strip())
+        return cell.row if cell else None
+
+    def _find_rows(self, ws, card_nums):
+        """
+        Locate several cards with at most one read of the cardNum column.
+
+        Returns:
+            Dict of cardNum -> sheet row number for the cards that exist
+        """
+        wanted = [str(c).strip() for c in card_nums]
+        rows = {}
+        if self.snapshot is not None:
+            snapshot = self._snapshot()
+            for card in wanted:
+                entry = snapshot.get(card)
+                if entry:
+                    rows[card] = entry[0]
+        missing = set(wanted) - set(rows)
+        if missing:
+            for row_num, value in enumerate(ws.col_values(1), start=1):
+                value = str(value).strip()
+                if row_num > 1 and value in missing and value not in rows:
+                    rows[value] = row_num
+        return rows
+
+    def get_record(self, card_num):
+        if self.snapshot is not None:
+            entry = self._snapshot().get(card_num)
+            if not entry:
+                return None
+            row = entry[1] + [""] * (6 - len(entry[1]))
+            return ClientRecord(row[0], row[1], row[2], row[3], row[4], row[5])
+        # Expecting header: ['cardNum', 'pin', 'firstName', 'lastName', 'balance', 'version']
+        for _, row in find_rows(self._ws(), 1, card_num, self.RECORD_COLUMNS, first_only=True):
+            return ClientRecord(row[0], row[1], row[2], row[3], row[4], row[5])
+        return None
+
+    def verify(self, card_num, pin):
+        if self.snapshot is not None:
+            return super().verify(card_num, pin)
+        # Only the PIN cell of the card's row is fetched
+        for _, row in find_rows(self._ws(), 1, card_num, self.PIN_COLUMNS, first_only=True):
+            return str(row[0]).strip() == str(pin)
+        return False
+
+    @_serialized(lambda self, card_num, *args, **kwargs: [("client", card_num)])
+    def update_balance(self, card_num, new_balance, expected=None):
         """
         Update account balance in the database.
         
         Args:
             card_num: Card number to identify the account
             new_balance: New balance value
+            expected: ClientRecord new_balance was computed from; makes the
+                write versioned (see ClientRepository.update_balance)
         
         Returns:
             True if successful, False otherwise
         """
         try:
-            ws = self._ws()
-            cell = ws.find(str(card_num).strip())
-            if not cell:
+            cas = self._cas([card_num])
+            if cas is None:
                 return False
-            # Update column 5 (balance). Store as number.
-            ws.update_cell(cell.row, 5, float(new_balance))
-            return True
+            if expected is not None:
+                return self._versioned_write([(expected, Money.parse(new_balance) - expected.balance)], cas)
+            return self._overwrite(card_num, Money.parse(new_balance), cas)
         except Exception as e:
             print(f"[ERROR] Failed to update balance: {e}")
             return False
 
+    @_serialized(lambda self, card_num, *args: [("client", card_num)])
     def update_pin(self, card_num, new_pin):
         """
         Update PIN in the database.
@@ -184,43 +1389,278 @@ class SimpleClientRepo:
             True if successful, False otherwise
         """
         try:
+            if self.write_behind is not None:
+                return self._write_behind([(card_num, {2: str(new_pin)})])
             ws = self._ws()
-            cell = ws.find(str(card_num).strip())
-            if not cell:
+            row = self._find_row(ws, card_num)
+            if not row:
                 return False
             # Update column 2 (pin)
-            ws.update_cell(cell.row, 2, str(new_pin))
+            with CellBatch(ws) as batch:
+                batch.update_cell(row, 2, str(new_pin))
+            if self.snapshot is not None:
+                self.snapshot.set_cell(card_num, 2, str(new_pin))
             return True
         except Exception as e:
             print(f"[ERROR] Failed to update PIN: {e}")
             return False
 
+    def _overwrite(self, card_num, new_balance, cas):
+        """
+        Write a balance as given, whatever is stored, still bumping the
+        version stamp so versioned writers notice the change. A snapshot
+        that holds the card supplies the stamp (and is kept in step);
+        otherwise the write takes the stamp compare_and_set reads.
+        """
+        rec = ClientRecord(card_num, "", "", "", new_balance)
+        entry = self._snapshot().get(rec.cardNum) if self.snapshot is not None else None
+        rec.version = _version((entry[1] + [""] * 6)[5]) if entry else None
+        for _ in range(CAS_RETRIES):
+            current = cas([(rec, new_balance)])
+            if current is None:
+                return True
+            rec.version = current[rec.cardNum][1]
+        print(f"[ERROR] Balance changed by other sessions {CAS_RETRIES} times in a row")
+        return False
+
+    def _write_behind(self, writes, checks=None):
+        """
+        Journal writes for one or more cards as a single entry and apply
+        them to the snapshot.
+
+        Args:
+            writes: List of (card_num, {col: value})
+            checks: {card_num: (col, version)}, the version stamps the
+                writes were based on (see WriteBehind.write)
+
+        Returns:
+            False if any card is unknown, True once the writes are journaled
+        """
+        snapshot = self._snapshot()
+        if any(snapshot.get(card) is None for card, _ in writes):
+            return False
+        self.write_behind.write([("client", 1, card, cells) for card, cells in writes],
+                                checks={("client", card): check for card, check in (checks or {}).items()})
+        for card, cells in writes:
+            for col, value in cells.items():
+                snapshot.set_cell(card, col, value)
+        return True
+
+    def _cas(self, card_nums, journal=False):
+        """
+        The compare-and-swap function _versioned_write uses for these
+        cards, or None if a card does not exist. In write-behind mode the
+        snapshot holds the current versions; otherwise the sheet is checked
+        with compare_and_set, one request pair per attempt.
+        """
+        cards = [str(c).strip() for c in card_nums]
+        if self.write_behind is not None:
+            snapshot = self._snapshot()
+            if any(snapshot.get(card) is None for card in cards):
+                return None
+
+            def cas(targets):
+                with self._cas_lock:
+                    current = {}
+                    for rec, _ in targets:
+                        row = snapshot.get(rec.cardNum)[1] + [""] * 6
+                        current[rec.cardNum] = (row[4], _version(row[5]))
+                    if any(current[rec.cardNum][1] != rec.version for rec, _ in targets):
+                        return current
+                    # One journal entry covers every card of the change
+                    return None if self._write_behind([(rec.cardNum, {5: float(balance), 6: rec.version + 1})
+                                                       for rec, balance in targets],
+                                                      checks={rec.cardNum: (6, rec.version)
+                                                              for rec, _ in targets}) else current
+            return cas
+        ws = self._ws()
+        rows = self._find_rows(ws, cards)
+        if any(card not in rows for card in cards):
+            return None
+
+        def cas(targets):
+            writes = [{"card": rec.cardNum, "old": float(rec.balance), "new": float(balance)}
+                      for rec, balance in targets]
+            entry_id = None
+            if journal and self.journal is not None:
+                entry_id = self.journal.begin("transfer", writes=writes)
+            current = compare_and_set(ws, [(rows[rec.cardNum], 5, float(balance), rec.version)
+                                           for rec, balance in targets])
+            if current is not None:
+                if entry_id is not None:
+                    self.journal.abort(entry_id)
+                cards_by_row = {rows[rec.cardNum]: rec.cardNum for rec, _ in targets}
+                current = {cards_by_row[row]: cells for row, cells in current.items()}
+                if self.snapshot is not None:
+                    for card, (balance, version) in current.items():
+                        self.snapshot.set_cell(card, 5, balance)
+                        self.snapshot.set_cell(card, 6, version)
+                return current
+            if self.snapshot is not None:
+                for rec, balance in targets:
+                    if rec.version is not None:
+                        self.snapshot.set_cell(rec.cardNum, 5, float(balance))
+                        self.snapshot.set_cell(rec.cardNum, 6, rec.version + 1)
+            if entry_id is not None:
+                self.journal.commit(entry_id)
+            return None
+        return cas
+
+    @_serialized(lambda self, source, dest, *args: [("client", source.cardNum), ("client", dest.cardNum)])
+    def transfer(self, source, dest, amount):
+        """
+        Move money between two cards with a single batched write.
+
+        Both balance cells (and version stamps) are written in one request,
+        after checking that neither card changed since its record was read;
+        if one did, the current balances are taken and the transfer is
+        retried. When a journal is configured the transfer is recorded
+        first, so a crash between the journal entry and the write can be
+        repaired by recover().
+
+        Args:
+            source: Record being debited (cardNum, balance and version)
+            dest: Record being credited (cardNum, balance and version)
+            amount: Positive amount to move
+
+        Returns:
+            True if both balances were written, False otherwise
+        """
+        try:
+            cas = self._cas([source.cardNum, dest.cardNum], journal=True)
+            if cas is None:
+                return False
+            amount = Money.parse(amount)
+            return self._versioned_write([(source, -amount), (dest, amount)], cas)
+        except Exception as e:
+            print(f"[ERROR] Failed to transfer: {e}")
+            return False
+
+    def recover(self):
+        """
+        Resolve transfers the journal shows as started but never finished.
+
+        For each one the current balances are compared with the journaled
+        old/new values: if neither side was written the entry is aborted,
+        otherwise the missing side is written and the entry committed.
+        Entries whose balances match neither value, or change while the
+        missing side is written, are left pending.
+
+        Returns:
+            Dict with the ids that were 'completed', 'aborted' and 'unresolved'
+        """
+        result = {"completed": [], "aborted": [], "unresolved": []}
+        if self.journal is None:
+            return result
+        pending = self.journal.pending(op="transfer", min_age=self.RECOVERY_MIN_AGE)
+        if not pending:
+            return result
+        self.refresh()
+        ws = self._ws()
+        for entry in pending:
+            todo = []
+            applied = 0
+            for write in entry["writes"]:
+                rec = self.get_record(write["card"])
+                if rec is None:
+                    todo = None
+                    break
+                if round(rec.balance, 2) == round(write["new"], 2):
+                    applied += 1
+                elif round(rec.balance, 2) == round(write["old"], 2):
+                    todo.append((write, rec))
+                else:
+                    todo = None
+                    break
+            if todo is None:
+                result["unresolved"].append(entry["id"])
+            elif applied == 0:
+                self.journal.abort(entry["id"])
+                result["aborted"].append(entry["id"])
+            else:
+                # Versioned like the transfer itself: a card changed since
+                # it was checked leaves the entry for the next recovery
+                rows = self._find_rows(ws, [rec.cardNum for _, rec in todo])
+                if compare_and_set(ws, [(rows[rec.cardNum], 5, write["new"], rec.version)
+                                        for write, rec in todo]) is not None:
+                    result["unresolved"].append(entry["id"])
+                    continue
+                if self.snapshot is not None:
+                    for write, rec in todo:
+                        self.snapshot.set_cell(rec.cardNum, 5, write["new"])
+                        self.snapshot.set_cell(rec.cardNum, 6, rec.version + 1)
+                self.journal.commit(entry["id"])
+                result["completed"].append(entry["id"])
+        return result
+
 class API:
     """
     API class for interacting with Google Sheets database.
     Manages account holders, accounts, and ATM cards.
     """
     def __init__(self):
-        self.SCOPE=[
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive.file",
-            "https://www.googleapis.com/auth/drive",
-        ]
+        self.SCOPE = SheetsConnection.SCOPE
         try:
-            self.CREDS = Credentials.from_service_account_file("creds.json")
-            self.SCOPED_CREDS = self.CREDS.with_scopes(self.SCOPE)
-            self.GSPREAD_CLIENT = gspread.authorize(self.SCOPED_CREDS)
-            self.SHEET = self.GSPREAD_CLIENT.open("client_database")
+            # Every API() shares the process-wide client and spreadsheet
+            conn = SheetsConnection.get()
+            self.CREDS = conn.CREDS
+            self.SCOPED_CREDS = conn.SCOPED_CREDS
+            self.GSPREAD_CLIENT = conn.CLIENT
+            self.SHEET = conn.SHEET
         except Exception as e:
             print(f"[ERROR] Failed to initialize API: {e}")
             self = None
 
+    # Columns read by the single-id lookups: (worksheet, key column,
+    # (first, last) columns fetched for the matching rows), all 1-based.
+    # Only the key column is paged through; matches are fetched afterwards.
+    HOLDER_BY_ID = ("accountHolder", 1, (1, 4))
+    ACCOUNT_BY_ID = ("account", 1, (1, 4))
+    ACCOUNT_BY_HOLDER = ("account", 2, (1, 4))
+    CARD_BY_NUMBER = ("atmCards", 2, (1, 4))
+    # A card only needs its account's holderID, balance and version
+    ACCOUNT_OF_CARD = ("account", 1, (2, 4))
+
+    def _lookup(self, projection, key, first_only=False):
+        """(row_number, row) for the rows whose key column matches key, projected columns only."""
+        title, key_column, columns = projection
+        found = find_rows(self.SHEET.worksheet(title), key_column, key, columns, first_only)
+        write_behind = WriteBehind.active()
+        if write_behind is not None and found:
+            # Journaled writes the flusher has not applied yet are newer
+            # than the sheet
+            first, last = columns
+            for (write_col, write_key), cells in write_behind.pending_rows(title).items():
+                for _, row in found:
+                    if write_col == key_column:
+                        row_key = key
+                    elif first <= write_col <= last:
+                        row_key = row[write_col - first]
+                    else:
+                        continue
+                    if _join_key(row_key) == write_key:
+                        for col, value in cells.items():
+                            if first <= col <= last:
+                                row[col - first] = value
+        return found
+
+    @staticmethod
+    def _located(model, **attrs):
+        # Remember where (and at which version) a model was read, so writes
+        # need no row search and balance writes can be versioned
+        for attr, value in attrs.items():
+            setattr(model, attr, value)
+        return model
+
 
     # Get a list of all Account Holders, or just 1
     # @id - set as 0 to retrieve all account holders, or any other number to retrieve just 1
     # Returns an array of type AccountHolder
     # The length of the return will be 0 if no account holder is found
     def getAccountHolders(self, id):
+        if int(id) != 0:
+            return [self._located(AccountHolder(holder[0],holder[1],holder[2],holder[3]), _holderRow=row)
+                    for row, holder in self._lookup(self.HOLDER_BY_ID, id, first_only=True)]
         return_list_of_accountHolders = []
         list_of_accountHolders = self.SHEET.worksheet("accountHolder").get_all_values()[1:]
         for holder in list_of_accountHolders:
@@ -235,6 +1675,10 @@ class API:
     # Returns an array of type "Account"
     # The length of the returned array will be 0 if no Accounts are found
     def getAccountByID(self,id):
+        if int(id) != 0:
+            return [self._located(Account(account[0],account[1],account[2]), _accountRow=row,
+                                  version=_version(account[3]))
+                    for row, account in self._lookup(self.ACCOUNT_BY_ID, id, first_only=True)]
         return_list_of_accounts = []
         list_of_accounts = self.SHEET.worksheet("account").get_all_values()[1:]
         for account in list_of_accounts:
@@ -249,6 +1693,11 @@ class API:
     # Returns an array of type "Account"
     # The length of the returned array will be 0 if no Accounts are found
     def getAccountByHolderID(self,id):
+        if int(id) != 0:
+            # A holder can have several accounts: the whole column is read
+            return [self._located(Account(account[0],account[1],account[2]), _accountRow=row,
+                                  version=_version(account[3]))
+                    for row, account in self._lookup(self.ACCOUNT_BY_HOLDER, id)]
         return_list_of_accounts = []
         list_of_accounts = self.SHEET.worksheet("account").get_all_values()[1:]
         for account in list_of_accounts:
@@ -263,24 +1712,34 @@ class API:
     # Returns an array of type "ATMCard"
     # The length of the returned array will be 0 if no ATMCards are found
     def getATMCards(self,id):
-        return_list_of_atm_cards = []
-        list_of_accounts = []
-        if int(id)==0:
-            # You will need all accounts to pair
-            # Search once here to avoid repeated searches later
-            list_of_accounts=self.getAccountByID(0)
+        if int(id)!=0:
+            # Only the requested card needs pairing with its account; both
+            # key column reads stop at the matching row
+            for card_row, atm in self._lookup(self.CARD_BY_NUMBER, id, first_only=True):
+                for account_row, (holder_id, balance, version) in self._lookup(self.ACCOUNT_OF_CARD, atm[0], first_only=True):
+                    return [self._located(ATMCard(atm[0],holder_id,balance,atm[1],atm[2],atm[3]),
+                                          _cardRow=card_row, _accountRow=account_row, version=_version(version))]
+            return []
         list_of_cards = self.SHEET.worksheet("atmCards").get_all_values()[1:]
-        for atm in list_of_cards:
-            if int(id)==0:
-                # Find the row that corresponds to the accountID
-                for account in list_of_accounts:
-                    if int(account.getAccountID())==int(atm[0]):
-                        return_list_of_atm_cards.append(ATMCard(atm[0],account.getAccountID(),account.getAccountBalance(),atm[1],atm[2],atm[3]))
-            elif int(id)==int(atm[1]):
-                for account in self.getAccountByID(atm[0]):
-                    if int(account.getAccountID())==int(atm[0]):
-                        return_list_of_atm_cards.append(ATMCard(atm[0],account.getAccountID(),account.getAccountBalance(),atm[1],atm[2],atm[3]))
-        return return_list_of_atm_cards
+        # Read the accounts once and pair them with the cards on accountID
+        list_of_accounts = self.SHEET.worksheet("account").get_all_values()[1:]
+        return [ATMCard(atm[0],account[1],account[2],atm[1],atm[2],atm[3])
+                for atm, account in hash_join(list_of_cards, list_of_accounts, 0, 0)]
+
+    # Get account holders paired with each of their accounts
+    # @id - set as 0 to retrieve every holder, or any other number to retrieve 1
+    # Returns an array of (AccountHolder, Account) tuples
+    # Holders without an account are not included
+    def getAccountHoldersWithAccounts(self, id):
+        if int(id)!=0:
+            holders = self.getAccountHolders(id)
+            if not holders:
+                return []
+            return [(holders[0], account) for account in self.getAccountByHolderID(holders[0].getID())]
+        list_of_accountHolders = self.SHEET.worksheet("accountHolder").get_all_values()[1:]
+        list_of_accounts = self.SHEET.worksheet("account").get_all_values()[1:]
+        return [(AccountHolder(holder[0],holder[1],holder[2],holder[3]), Account(account[0],account[1],account[2]))
+                for holder, account in hash_join(list_of_accountHolders, list_of_accounts, 0, 1)]
 
 class AccountHolder:
     # Initialise the AccountHolder class
@@ -289,6 +1748,8 @@ class AccountHolder:
         self.firstname = firstname
         self.lastname = lastname
         self.phone = phone
+        # Sheet row, when loaded by the API
+        self._holderRow = None
 
     # Getters and Setters
     def getID(self):
@@ -309,19 +1770,32 @@ class AccountHolder:
     # @phone - a string
     # Returns true if database successfully updated, false if it did not
     def updateAccount(self, firstname, lastname, phone):
+        fields = {2: ("firstname", firstname), 3: ("lastname", lastname), 4: ("phone", phone)}
+        # Only the fields that change are written
+        changed = {col: (attr, value) for col, (attr, value) in fields.items()
+                   if str(getattr(self, attr)) != str(value)}
+        if not changed:
+            return True
+        uow = UnitOfWork.current()
+        if uow is not None:
+            for col, (attr, value) in changed.items():
+                uow.record(self, attr, "accountHolder", 1, self.id, self._holderRow, col, getattr(self, attr), value)
+                setattr(self, attr, value)
+            return True
         'Call api to update server'
         a = API()
         try:
-            accountHolder_cell = a.SHEET.worksheet("accountHolder").findall(self.id)
+            ws = a.SHEET.worksheet("accountHolder")
+            accountHolder_cell = ws.findall(self.id)
             ' There should be only one, but this search will ensure it is the card number column that was found'
             for idColCheck in accountHolder_cell:
                 if int(idColCheck.col)==1:
-                    a.SHEET.worksheet("accountHolder").update_cell(idColCheck.row,2,firstname)
-                    a.SHEET.worksheet("accountHolder").update_cell(idColCheck.row,3,lastname)
-                    a.SHEET.worksheet("accountHolder").update_cell(idColCheck.row,4,phone)
-                    self.firstname = firstname
-                    self.lastname = lastname
-                    self.phone = phone
+                    # One request for the changed columns
+                    with CellBatch(ws) as batch:
+                        for col, (attr, value) in changed.items():
+                            batch.update_cell(idColCheck.row, col, value)
+                    for attr, value in changed.values():
+                        setattr(self, attr, value)
                     return True
         except:
             return False
@@ -332,7 +1806,28 @@ class Account:
     def __init__(self, accountID, accountHolderID, accountBalance):
         self.accountID=accountID
         self.accountHolderID=accountHolderID
-        self.accountBalance=formatFloatFromServer(accountBalance)
+        self.accountBalance=accountBalance
+        # Sheet row and version stamp, when loaded by the API. Accounts
+        # without a version (built by hand, or listed with id 0) read the
+        # stored balance and stamp before their first balance write
+        self._accountRow = None
+        self.version = None
+
+    # The balance is parsed into Money once; accountBalance reads back as
+    # a string ("1000.50") like the value loaded from the sheet
+    @property
+    def accountBalance(self):
+        if self.balance is None:
+            return self._unparsedBalance
+        return str(self.balance)
+
+    @accountBalance.setter
+    def accountBalance(self, value):
+        try:
+            self.balance = Money.parse(value)
+        except (ValueError, TypeError):
+            self.balance = None
+            self._unparsedBalance = formatFloatFromServer(value)
 
     # Getters and Setters
     def getAccountID(self):
@@ -345,8 +1840,9 @@ class Account:
         return self.accountBalance
 
     # Update the balance on the account
-    # @amountToAdd - a float, can be negative to reduce the balance, or positive to increase it
+    # @amountToAdd - Money or a float, can be negative to reduce the balance, or positive to increase it
     # Returns true if database successfully updated, false if it did not
+    @_serialized(lambda self, *args: [("account", self.accountID)])
     def increaseBalance(self, amountToAdd):
         """
         Update the balance on the account.
@@ -357,19 +1853,107 @@ class Account:
         Returns:
             True if successful, False otherwise
         """
-        a = API()
+        uow = UnitOfWork.current()
+        if uow is not None:
+            # The unit of work writes the new balance when it commits, so
+            # the row is not re-read once the account has a version
+            try:
+                if self.version is None:
+                    self._readStamp()
+                curValue = Money.parse(uow.pending("account", self.accountID, 3, self.balance))
+                newValue = curValue + Money.parse(amountToAdd)
+                uow.record(self, "balance", "account", 1, self.accountID, self._accountRow, 3,
+                           float(curValue), float(newValue), version=self.version)
+                return True
+            except Exception as e:
+                print(f"[ERROR] Failed to update balance: {e}")
+                return False
+        write_behind = WriteBehind.active()
+        if write_behind is not None:
+            try:
+                return self._writeBehindIncrease(write_behind, Money.parse(amountToAdd))
+            except Exception as e:
+                print(f"[ERROR] Failed to update balance: {e}")
+                return False
         try:
-            account_cell = a.SHEET.worksheet("account").findall(self.accountID)
-            # Find the correct cell in column 1
-            for idColCheck in account_cell:
-                if int(idColCheck.col) == 1:
-                    curValue = formatFloatFromServer(a.SHEET.worksheet("account").row_values(idColCheck.row)[2])
-                    curValue = float(curValue) + amountToAdd
-                    a.SHEET.worksheet("account").update_cell(idColCheck.row, 3, curValue)
-                    return True
+            if self.version is None:
+                self._readStamp()
+            return self._versionedIncrease(Money.parse(amountToAdd))
+        except LookupError:
+            return False
         except Exception as e:
             print(f"[ERROR] Failed to update balance: {e}")
             return False
+
+    # Load the stored balance and version stamp of an account built
+    # without them, so its balance writes are versioned like the others
+    def _readStamp(self):
+        ws = API().SHEET.worksheet("account")
+        if self._accountRow is None:
+            self._accountRow = _locate_row(ws, 1, self.accountID)
+        stored, self.version = _read_stamped(ws, 1, self.accountID, 3, self._accountRow)
+        self.balance = _money_or_zero(stored)
+
+    # Versioned balance write: the row's version stamp must still be the
+    # one the account was loaded with; if another session has changed the
+    # balance since, the stored balance and version are taken and the
+    # write is retried. Like the other paths it leaves adding the amount
+    # to the local balance to the caller
+    # @amount - Money to add
+    # Returns true once written, false if a debit no longer fits the stored balance
+    def _versionedIncrease(self, amount):
+        a = API()
+        ws = a.SHEET.worksheet("account")
+        row = self._accountRow or _locate_row(ws, 1, self.accountID)
+        if row is None:
+            return False
+        self._accountRow = row
+        for _ in range(CAS_RETRIES):
+            newValue = self.balance + amount
+            if amount < 0 and newValue < 0:
+                print("[ERROR] Insufficient funds")
+                return False
+            current = compare_and_set(ws, [(row, 3, float(newValue), self.version)])
+            if current is None:
+                self.version += 1
+                return True
+            stored, self.version = current[row]
+            self.balance = _money_or_zero(stored)
+        print(f"[ERROR] Balance changed by other sessions {CAS_RETRIES} times in a row")
+        return False
+
+    # Write-behind balance write: journaled with a version check against
+    # the balance as it will be once the queued writes reach the sheet, so
+    # two sessions on the account before a flush do not overwrite each
+    # other. An account without a version is checked against the stamp
+    # stored when the write is made
+    # @write_behind - the active WriteBehind
+    # @amount - Money to add
+    # Returns true once journaled, false if a debit no longer fits the stored balance
+    def _writeBehindIncrease(self, write_behind, amount):
+        def stored(sheet, key_col, key, col):
+            ws = API().SHEET.worksheet(sheet)
+            if self._accountRow is None:
+                self._accountRow = _locate_row(ws, key_col, key)
+            return _read_stamped(ws, key_col, key, col, self._accountRow)
+        balance, version = self.balance, self.version
+        if version is None:
+            stored_balance, version = write_behind.current("account", 1, self.accountID, 3, stored)
+            balance = _money_or_zero(stored_balance)
+        for _ in range(CAS_RETRIES):
+            newValue = balance + amount
+            if amount < 0 and newValue < 0:
+                print("[ERROR] Insufficient funds")
+                return False
+            current = write_behind.compare_and_set([("account", 1, self.accountID, {3: float(newValue)})],
+                                                   [("account", 1, self.accountID, 3, version)], stored)
+            if current is None:
+                if self.version is not None:
+                    self.balance, self.version = balance, version + 1
+                return True
+            stored_balance, version = current[("account", str(self.accountID).strip())]
+            balance = _money_or_zero(stored_balance)
+        print(f"[ERROR] Balance changed by other sessions {CAS_RETRIES} times in a row")
         return False
 
 class ATMCard(Account):
@@ -379,6 +1963,8 @@ class ATMCard(Account):
         self.cardNumber = cardNumber
         self.pin = pin
         self.failedTries = failedTries
+        # atmCards row, when loaded by the API
+        self._cardRow = None
 
     # Getters and Setters
     def getCardNumber(self):
@@ -390,6 +1976,7 @@ class ATMCard(Account):
     # Update the pin in the database relating to an instance of an ATMCard
     # @newPin - an int
     # Returns true if database successfully updated, false if it did not
+    @_serialized(lambda self, *args: [("atmCards", self.cardNumber)])
     def setPin(self, newPin):
         """
         Update the PIN in the database.
@@ -406,13 +1993,22 @@ class ATMCard(Account):
         if len(str(newPin)) < 4:
             print("[ERROR] PIN must be at least 4 digits")
             return False
-            
+        if str(newPin) == str(self.pin):
+            return True
+        uow = UnitOfWork.current()
+        if uow is not None:
+            uow.record(self, "pin", "atmCards", 2, self.cardNumber, self._cardRow, 3, self.pin, newPin)
+            self.pin = newPin
+            return True
+
         a = API()
         try:
-            card_cell = a.SHEET.worksheet("atmCards").findall(self.cardNumber)
+            ws = a.SHEET.worksheet("atmCards")
+            card_cell = ws.findall(self.cardNumber)
             for idColCheck in card_cell:
                 if int(idColCheck.col) == 2:
-                    a.SHEET.worksheet("atmCards").update_cell(idColCheck.row, 3, newPin)
+                    with CellBatch(ws) as batch:
+                        batch.update_cell(idColCheck.row, 3, newPin)
                     self.pin = newPin
                     return True
         except Exception as e:
@@ -425,6 +2021,7 @@ class ATMCard(Account):
     
     # Update the number of failed tries in the database by 1
     # Returns true if database successfully updated, false if it did not
+    @_serialized(lambda self: [("atmCards", self.cardNumber)])
     def increaseFailedTries(self):
         """
         Increment failed PIN attempts by 1.
@@ -432,12 +2029,24 @@ class ATMCard(Account):
         Returns:
             True if successful, False otherwise
         """
+        uow = UnitOfWork.current()
+        if uow is not None:
+            try:
+                uow.record(self, "failedTries", "atmCards", 2, self.cardNumber, self._cardRow, 4,
+                           int(self.failedTries), int(self.failedTries) + 1)
+                self.failedTries = int(self.failedTries) + 1
+                return True
+            except Exception as e:
+                print(f"[ERROR] Failed to update failed tries: {e}")
+                return False
         a = API()
         try:
-            card_cell = a.SHEET.worksheet("atmCards").findall(self.cardNumber)
+            ws = a.SHEET.worksheet("atmCards")
+            card_cell = ws.findall(self.cardNumber)
             for idColCheck in card_cell:
                 if int(idColCheck.col) == 2:
-                    a.SHEET.worksheet("atmCards").update_cell(idColCheck.row, 4, int(self.failedTries) + 1)
+                    with CellBatch(ws) as batch:
+                        batch.update_cell(idColCheck.row, 4, int(self.failedTries) + 1)
                     self.failedTries = int(self.failedTries) + 1
                     return True
         except Exception as e:
@@ -447,6 +2056,7 @@ class ATMCard(Account):
     
     # Update the number of failedTries in the database, resets the number to 0
     # Returns true if database successfully updated, false if it did not
+    @_serialized(lambda self: [("atmCards", self.cardNumber)])
     def resetFailedTries(self):
         """
         Reset failed PIN attempts to 0.
@@ -454,12 +2064,22 @@ class ATMCard(Account):
         Returns:
             True if successful, False otherwise
         """
+        # Most logins find the counter at 0 already: nothing to write
+        if str(self.failedTries).strip() in ("0", "0.0"):
+            return True
+        uow = UnitOfWork.current()
+        if uow is not None:
+            uow.record(self, "failedTries", "atmCards", 2, self.cardNumber, self._cardRow, 4, self.failedTries, 0)
+            self.failedTries = 0
+            return True
         a = API()
         try:
-            card_cell = a.SHEET.worksheet("atmCards").findall(self.cardNumber)
+            ws = a.SHEET.worksheet("atmCards")
+            card_cell = ws.findall(self.cardNumber)
             for idColCheck in card_cell:
                 if int(idColCheck.col) == 2:
-                    a.SHEET.worksheet("atmCards").update_cell(idColCheck.row, 4, 0)
+                    with CellBatch(ws) as batch:
+                        batch.update_cell(idColCheck.row, 4, 0)
                     self.failedTries = 0
                     return True
         except Exception as e:
@@ -492,26 +2112,30 @@ class ATMCard(Account):
     # Return the current account balance as a float
     def check_balance(self):
         try:
-            return float(formatFloatFromServer(self.accountBalance))
+            return float(self.balance)
         except Exception:
             return None
 
     # Withdraw funds from the account
-    # @amount - positive float amount to withdraw
+    # @amount - positive amount (Money or float) to withdraw
+    # The account stays locked from the funds check to the write. In a unit
+    # of work the write only happens at commit(), which locks the account
+    # again; the version stamp catches what changed in between
     # Returns True on success, False otherwise
+    @_serialized(lambda self, *args: [("account", self.accountID)])
     def withdraw(self, amount):
         """
         Withdraw funds from the account.
         
         Args:
-            amount: Positive float amount to withdraw
+            amount: Positive amount (Money, float or string) to withdraw
         
         Returns:
             True on success, False otherwise
         """
         try:
-            cur_bal = float(formatFloatFromServer(self.accountBalance))
-            amt = float(amount)
+            cur_bal = self.balance
+            amt = Money.parse(amount)
             if amt <= 0:
                 print("[ERROR] Withdrawal amount must be positive")
                 return False
@@ -521,8 +2145,8 @@ class ATMCard(Account):
             # decrease balance by amount
             success = self.increaseBalance(-amt)
             if success:
-                # update local value
-                self.accountBalance = str(cur_bal - amt)
+                # update local value (a versioned write may have re-read it)
+                self.balance -= amt
                 return True
             return False
         except (ValueError, TypeError) as e:
@@ -530,27 +2154,27 @@ class ATMCard(Account):
             return False
 
     # Deposit funds into the account
-    # @amount - positive float amount to deposit
+    # @amount - positive amount (Money or float) to deposit
     # Returns True on success, False otherwise
+    @_serialized(lambda self, *args: [("account", self.accountID)])
     def deposit(self, amount):
         """
         Deposit funds into the account.
         
         Args:
-            amount: Positive float amount to deposit
+            amount: Positive amount (Money, float or string) to deposit
         
         Returns:
             True on success, False otherwise
         """
         try:
-            amt = float(amount)
+            amt = Money.parse(amount)
             if amt <= 0:
                 print("[ERROR] Deposit amount must be positive")
                 return False
-            cur_bal = float(formatFloatFromServer(self.accountBalance))
             success = self.increaseBalance(amt)
             if success:
-                self.accountBalance = str(cur_bal + amt)
+                self.balance += amt
                 return True
             return False
         except (ValueError, TypeError) as e:
@@ -2,6 +2,8 @@
 // const Pty = require('node-pty'); // Node.js library for spawning pseudo terminals
 const fs = require('fs');        // File system module for file operations
 const path = require('path');    // Path utilities
+const os = require('os');        // Temp directory for shared rate-limit state
+const net = require('net');      // TCP connections to the multi-session ATM server
 const { spawn, spawnSync } = require('child_process'); // Use child_process instead of node-pty
 
 /**
@@ -16,6 +18,9 @@ exports.install = function () {
 
     // Use default websocket framing (text frames)
     WEBSOCKET('/', socket, ['raw']); // raw frames (no JSON encode/decode)
+
+    // Warm the worker pool (or start the ATM server) once creds.json is in place
+    credsReady.then(SERVER_ADDR ? startServer : refillPool);
 };
 
 // Resolve a usable Python 3 binary across platforms
@@ -53,6 +58,195 @@ function resolvePython() {
     return { cmd: null, args: [], tried };
 }
 
+/**
+ * Request scheduling is off unless ATM_READS_PER_MINUTE or
+ * ATM_WRITES_PER_MINUTE is set, as in run.py. When it is on, every run.py
+ * process shares one bucket directory (ATM_RATE_LIMIT_DIR, default the
+ * system temp directory) so sessions share the Google Sheets quota (see
+ * scheduler.py).
+ */
+function rateLimitEnv() {
+    if (!process.env.ATM_READS_PER_MINUTE && !process.env.ATM_WRITES_PER_MINUTE) return {};
+    return { ATM_RATE_LIMIT_DIR: process.env.ATM_RATE_LIMIT_DIR || os.tmpdir() };
+}
+
+/**
+ * Sessions on the same card or account take turns through file locks in a
+ * shared directory (see locks.py), so every run.py process gets the same
+ * ATM_LOCK_DIR. Override with ATM_LOCK_DIR. The locks need flock(), which
+ * Windows lacks; there each process only locks its own sessions.
+ */
+function lockEnv() {
+    if (process.platform === 'win32') return {};
+    return { ATM_LOCK_DIR: process.env.ATM_LOCK_DIR || path.join(os.tmpdir(), 'atm-locks') };
+}
+
+/**
+ * Warm pool of Python workers
+ * Starting run.py imports gspread and authorizes against Google before the
+ * banner appears, which takes seconds. The pool keeps ATM_POOL_SIZE workers
+ * started ahead of time; their output is buffered until a connection takes
+ * them. Workers idle for longer than ATM_POOL_MAX_IDLE_MS are replaced so
+ * they never hold stale sessions. ATM_POOL_SIZE=0 disables the pool.
+ */
+const POOL_SIZE = Math.max(0, parseInt(process.env.ATM_POOL_SIZE || '2', 10) || 0);
+const POOL_MAX_IDLE_MS = Math.max(1000, parseInt(process.env.ATM_POOL_MAX_IDLE_MS || '600000', 10) || 600000);
+const idleWorkers = [];
+let python = null;
+
+// Resolve the Python binary once instead of on every connection
+function getPython() {
+    if (!python || !python.cmd) python = resolvePython();
+    return python;
+}
+
+function spawnWorker() {
+    const py = getPython();
+    const scriptPath = path.join(__dirname, '..', 'run.py');
+    // Use unbuffered mode (-u) and force UTF-8 encoding for stdout/stderr
+    const proc = spawn(py.cmd, [...py.args, '-u', scriptPath], {
+        cwd: path.join(__dirname, '..'),
+        // ATM_SPAWNED_AT lets run.py's startup report include process start-up
+        env: { ...process.env, ...rateLimitEnv(), ...lockEnv(), ATM_SPAWNED_AT: String(Date.now()), PYTHONIOENCODING: 'utf-8' },
+        stdio: ['pipe', 'pipe', 'pipe']
+    });
+    const worker = { proc, client: null, buffer: [], idleTimer: null, exited: false };
+
+    // Always send UTF-8 strings to the browser (avoid Buffer JSON)
+    const deliver = (data) => {
+        const text = data.toString('utf8');
+        if (worker.client) worker.client.send(text);
+        else worker.buffer.push(text);
+    };
+    proc.stdout.on('data', deliver);
+    proc.stderr.on('data', deliver);
+
+    proc.on('error', (err) => {
+        deliver(Buffer.from(`Failed to start Python: ${err.message}\r\n`, 'utf8'));
+    });
+
+    proc.on('close', () => {
+        worker.exited = true;
+        clearTimeout(worker.idleTimer);
+        const client = worker.client;
+        if (client) {
+            client.proc = null;
+            try { client.close(); } catch {}
+            console.log("Process killed");
+        } else {
+            // An idle worker died (e.g. failed to start): drop it and top up
+            const index = idleWorkers.indexOf(worker);
+            if (index !== -1) idleWorkers.splice(index, 1);
+            // After a short wait, so a worker that cannot start is not respawned in a loop
+            setTimeout(refillPool, 1000);
+        }
+    });
+    return worker;
+}
+
+function retireWorker(worker) {
+    const index = idleWorkers.indexOf(worker);
+    if (index === -1) return;
+    idleWorkers.splice(index, 1);
+    try { worker.proc.kill(); } catch {}
+    refillPool();
+}
+
+function refillPool() {
+    if (!POOL_SIZE || !getPython().cmd) return;
+    while (idleWorkers.length < POOL_SIZE) {
+        const worker = spawnWorker();
+        worker.idleTimer = setTimeout(() => retireWorker(worker), POOL_MAX_IDLE_MS);
+        idleWorkers.push(worker);
+    }
+}
+
+// Take a warm worker if one is alive, otherwise start one now
+function takeWorker() {
+    let worker = null;
+    while (idleWorkers.length && !worker) {
+        const candidate = idleWorkers.shift();
+        clearTimeout(candidate.idleTimer);
+        if (!candidate.exited) worker = candidate;
+    }
+    // Start the replacement after this connection has its worker
+    setImmediate(refillPool);
+    return worker || spawnWorker();
+}
+
+function attachWorker(worker, client) {
+    worker.client = client;
+    client.proc = worker.proc;
+    // Replay what the worker printed (banner, card prompt) while it waited
+    if (worker.buffer.length) {
+        client.send(worker.buffer.join(''));
+        worker.buffer = [];
+    }
+    if (worker.exited) {
+        client.proc = null;
+        try { client.close(); } catch {}
+    }
+}
+
+process.on('exit', () => {
+    for (const worker of idleWorkers) {
+        try { worker.proc.kill(); } catch {}
+    }
+});
+
+/**
+ * Multi-session server mode
+ * With ATM_SERVER_ADDR=host:port, connections are multiplexed onto one
+ * `run.py --serve` process (see atm_server.py) instead of one Python process
+ * each. The gateway starts that server itself and restarts it if it exits,
+ * unless ATM_SERVER_SPAWN=0 (e.g. when it runs as a separate service).
+ */
+const SERVER_ADDR = process.env.ATM_SERVER_ADDR || '';
+let serverProc = null;
+
+function parseServerAddr() {
+    const index = SERVER_ADDR.lastIndexOf(':');
+    if (index === -1) return { host: SERVER_ADDR || '127.0.0.1', port: 7001 };
+    return { host: SERVER_ADDR.slice(0, index) || '127.0.0.1', port: parseInt(SERVER_ADDR.slice(index + 1), 10) || 7001 };
+}
+
+function startServer() {
+    if (!SERVER_ADDR || process.env.ATM_SERVER_SPAWN === '0' || serverProc) return;
+    const py = getPython();
+    if (!py.cmd) return;
+    serverProc = spawn(py.cmd, [...py.args, '-u', path.join(__dirname, '..', 'run.py'), '--serve', SERVER_ADDR], {
+        cwd: path.join(__dirname, '..'),
+        env: { ...process.env, ...rateLimitEnv(), ...lockEnv(), PYTHONIOENCODING: 'utf-8' },
+        stdio: ['ignore', 'inherit', 'inherit']
+    });
+    serverProc.on('close', (code) => {
+        serverProc = null;
+        console.log(`ATM server exited (${code}), restarting`);
+        setTimeout(startServer, 2000);
+    });
+}
+
+function connectServer(client) {
+    const { host, port } = parseServerAddr();
+    const conn = net.connect(port, host);
+    client.conn = conn;
+    // Always send UTF-8 strings to the browser (avoid Buffer JSON)
+    conn.on('data', (data) => client.send(data.toString('utf8')));
+    conn.on('error', (err) => {
+        client.send(`ATM server unavailable: ${err.message}\r\n`);
+    });
+    conn.on('close', () => {
+        client.conn = null;
+        try { client.close(); } catch {}
+    });
+}
+
+process.on('exit', () => {
+    if (serverProc) {
+        try { serverProc.kill(); } catch {}
+    }
+});
+
 /**
  * WebSocket handler function for terminal connections
  * Manages the lifecycle of Python process sessions for clients
@@ -64,10 +258,8 @@ function socket() {
     this.autodestroy();
 
     this.on('open', function (client) {
-        const scriptPath = path.join(__dirname, '..', 'run.py');
-
         // Resolve Python binary cross-platform
-        const py = resolvePython();
+        const py = getPython();
         if (!py.cmd) {
             const msg = `Python 3 not found. Please install Python 3 and add it to PATH.
 Tried: ${py.tried.join(', ')}
@@ -78,38 +270,25 @@ On Windows, install from python.org and ensure "Add python.exe to PATH" is selec
             return;
         }
 
-        // Use unbuffered mode (-u) and force UTF-8 encoding for stdout/stderr
-        client.proc = spawn(py.cmd, [...py.args, '-u', scriptPath], {
-            cwd: path.join(__dirname, '..'),
-            env: { ...process.env, PYTHONIOENCODING: 'utf-8' },
-            stdio: ['pipe', 'pipe', 'pipe']
-        });
-
-        client.proc.on('error', (err) => {
-            client.send(Buffer.from(`Failed to start Python: ${err.message}\r\n`, 'utf8'));
-        });
-
-        // Always send UTF-8 strings to the browser (avoid Buffer JSON)
-        client.proc.stdout.on('data', (data) => client.send(data.toString('utf8')));
-        client.proc.stderr.on('data', (data) => client.send(data.toString('utf8')));
-
-        client.proc.on('close', () => {
-            client.proc = null;
-            try { client.close(); } catch {}
-            console.log("Process killed");
-        });
+        if (SERVER_ADDR) connectServer(client);
+        else attachWorker(takeWorker(), client);
     });
 
     this.on('message', function (client, msg) {
         // msg is Buffer in raw mode; convert CR -> LF for Python input()
-        if (client.proc?.stdin?.writable) {
+        const sink = client.conn || client.proc?.stdin;
+        if (sink?.writable) {
             const buf = Buffer.isBuffer(msg) ? msg : Buffer.from(String(msg), 'utf8');
             const normalized = buf.toString('utf8').replace(/\r/g, '\n');
-            client.proc.stdin.write(normalized);
+            sink.write(normalized);
         }
     });
 
     this.on('close', function (client) {
+        if (client.conn) {
+            try { client.conn.destroy(); } catch {}
+            client.conn = null;
+        }
         if (client.proc) {
             try { client.proc.kill(); } catch {}
             client.proc = null;
@@ -127,11 +306,13 @@ On Windows, install from python.org and ensure "Add python.exe to PATH" is selec
  * This runs when the module is loaded and creates the creds.json file
  * if the CREDS environment variable is set
  */
-if (process.env.CREDS != null) {
+const credsReady = new Promise((resolve) => {
+    if (process.env.CREDS == null) return resolve();
     console.log("Creating creds.json file.");
     fs.writeFile('creds.json', process.env.CREDS, 'utf8', function (err) {
         if (err) {
             console.log('Error writing file: ', err);
         }
+        resolve();
     });
-}
\ No newline at end of file
+});
@@ -0,0 +1,279 @@
+import os
+import sys
+import csv
+import argparse
+
+from cardHolder import _join_key, iter_rows
+from money import Money
+from scheduler import RequestScheduler
+
+# Bulk CSV import and export of the four worksheets.
+#
+#     python csv_tool.py import client branch-clients.csv --rejects bad.csv
+#     python csv_tool.py export atmCards cards.csv
+#
+# Imports stream the CSV file: each row is validated (formats, duplicate
+# keys in the file and in the sheet, references to accounts/holders) and
+# valid rows are sent in append_rows chunks. Requests go through the
+# RequestScheduler, so a large import keeps to the same per-minute quota
+# as the ATM sessions (ATM_READS_PER_MINUTE / ATM_WRITES_PER_MINUTE /
+# ATM_RATE_LIMIT_DIR). Exports read the sheet in pages and write rows as
+# they arrive.
+
+# Worksheet title -> column headers in sheet order. version is the
+# balance's version stamp (see cardHolder.compare_and_set); exports keep
+# it so a re-imported sheet goes on checking the same stamps
+SCHEMAS = {
+    "client": ["cardNum", "pin", "firstName", "lastName", "balance", "version"],
+    "accountHolder": ["id", "firstname", "lastname", "phone"],
+    "account": ["accountID", "holderID", "balance", "version"],
+    "atmCards": ["accountID", "cardNum", "pin", "failedTries"],
+}
+
+# Columns a CSV file may leave out; a missing or blank version imports as 0
+OPTIONAL_COLUMNS = {"version"}
+
+# Worksheet title -> index of the column that must be unique
+KEY_COLUMNS = {"client": 0, "accountHolder": 0, "account": 0, "atmCards": 1}
+
+# Worksheet title -> (column index, referenced worksheet): the value must
+# be a key of the referenced worksheet
+REFERENCES = {
+    "account": (1, "accountHolder"),
+    "atmCards": (0, "account"),
+}
+
+
+def _card(value):
+    if not (value.isdigit() and 12 <= len(value) <= 19):
+        raise ValueError("card number must be 12-19 digits")
+    return value
+
+
+def _pin(value):
+    if not (value.isdigit() and len(value) >= 4):
+        raise ValueError("PIN must be at least 4 digits")
+    return value
+
+
+def _name(value):
+    if not value:
+        raise ValueError("name is empty")
+    return value
+
+
+def _id(value):
+    if not value.isdigit():
+        raise ValueError("ID must be a non-negative integer")
+    return int(value)
+
+
+def _amount(value):
+    amount = Money.parse(value)
+    if amount < 0:
+        raise ValueError("balance cannot be negative")
+    return float(amount)
+
+
+def _count(value):
+    return _id(value) if value else 0
+
+
+# Column header -> validator returning the value to write
+VALIDATORS = {
+    "cardNum": _card, "pin": _pin, "firstName": _name, "lastName": _name,
+    "firstname": _name, "lastname": _name, "phone": str, "balance": _amount,
+    "id": _id, "accountID": _id, "holderID": _id, "failedTries": _count,
+    "version": _count,
+}
+
+
+def _key(value):
+    return str(_join_key(value))
+
+
+def _sheet_keys(spreadsheet, title):
+    """Keys already present in a worksheet (one column read)."""
+    column = KEY_COLUMNS[title] + 1
+    return {_key(v) for v in spreadsheet.worksheet(title).col_values(column)[1:] if str(v).strip()}
+
+
+class ImportReport:
+    """Outcome of an import: counts plus the first max_errors problems."""
+    def __init__(self, max_errors=100):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.imported = 0
+        self.rejected = 0
+        self.chunks = 0
+        self.errors = []
+        self.failed_at_line = None
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line, message))
+
+    def as_dict(self):
+        return {"rows": self.rows, "imported": self.imported, "rejected": self.rejected,
+                "chunks": self.chunks, "errors": self.errors, "failed_at_line": self.failed_at_line}
+
+
+def import_csv(spreadsheet, title, source, chunk_size=500, dry_run=False, rejects=None, max_errors=100):
+    """
+    Validate the rows of a CSV file and append them to a worksheet.
+
+    Args:
+        spreadsheet: Spreadsheet (or WorksheetCache) to write to
+        title: Worksheet title, one of SCHEMAS
+        source: Open text file with a header row naming the columns
+        chunk_size: Rows per append_rows request
+        dry_run: Only validate
+        rejects: Optional open text file receiving rejected rows plus an error column
+        max_errors: Errors kept in the report (all are counted)
+
+    Returns:
+        ImportReport
+    """
+    columns = SCHEMAS[title]
+    report = ImportReport(max_errors)
+    reader = csv.reader(source)
+    header = [h.strip() for h in next(reader, [])]
+    missing = [c for c in columns if c not in header and c not in OPTIONAL_COLUMNS]
+    if missing:
+        raise ValueError(f"CSV header is missing column(s): {', '.join(missing)}")
+    positions = [header.index(c) if c in header else None for c in columns]
+    reject_writer = csv.writer(rejects) if rejects is not None else None
+    if reject_writer is not None:
+        reject_writer.writerow(header + ["error"])
+
+    key_column = KEY_COLUMNS[title]
+    seen = _sheet_keys(spreadsheet, title)
+    reference = REFERENCES.get(title)
+    known = _sheet_keys(spreadsheet, reference[1]) if reference else None
+    ws = spreadsheet.worksheet(title)
+    chunk, chunk_line = [], None
+
+    def flush():
+        nonlocal chunk, chunk_line
+        if chunk and not dry_run:
+            # USER_ENTERED stores values the way update_cell and CellBatch do
+            ws.append_rows(chunk, value_input_option="USER_ENTERED")
+            report.chunks += 1
+        report.imported += len(chunk)
+        chunk, chunk_line = [], None
+
+    for raw in reader:
+        if not any(cell.strip() for cell in raw):
+            continue
+        report.rows += 1
+        line = reader.line_num
+        try:
+            cells = [raw[p].strip() if p is not None and p < len(raw) else "" for p in positions]
+            row = [VALIDATORS[c](v) for c, v in zip(columns, cells)]
+            key = _key(row[key_column])
+            if key in seen:
+                raise ValueError(f"duplicate {columns[key_column]} {key}")
+            if reference and _key(row[reference[0]]) not in known:
+                raise ValueError(f"unknown {columns[reference[0]]} {row[reference[0]]}")
+        except ValueError as e:
+            report.reject(line, str(e))
+            if reject_writer is not None:
+                reject_writer.writerow(raw + [str(e)])
+            continue
+        seen.add(key)
+        chunk.append(row)
+        chunk_line = chunk_line or line
+        if len(chunk) >= chunk_size:
+            try:
+                flush()
+            except Exception as e:
+                print(f"[ERROR] Import stopped: {e}")
+                report.failed_at_line = chunk_line
+                return report
+    try:
+        flush()
+    except Exception as e:
+        print(f"[ERROR] Import stopped: {e}")
+        report.failed_at_line = chunk_line
+    return report
+
+
+def export_csv(spreadsheet, title, target, page_size=1000):
+    """
+    Write a worksheet to CSV page by page.
+
+    Returns:
+        Number of data rows written
+    """
+    columns = SCHEMAS[title]
+    writer = csv.writer(target)
+    writer.writerow(columns)
+    count = 0
+    for _, row in iter_rows(spreadsheet.worksheet(title), len(columns), page_size):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def _enable_pacing():
+    # Same quota defaults as the gateway gives the ATM sessions
+    if RequestScheduler.active() is None:
+        RequestScheduler.enable(read_per_minute=float(os.environ.get("ATM_READS_PER_MINUTE") or 60),
+                                write_per_minute=float(os.environ.get("ATM_WRITES_PER_MINUTE") or 60),
+                                state_dir=os.environ.get("ATM_RATE_LIMIT_DIR") or None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import or export worksheets as CSV")
+    commands = parser.add_subparsers(dest="command", required=True)
+    imp = commands.add_parser("import", help="append validated CSV rows to a worksheet")
+    imp.add_argument("sheet", choices=tuple(SCHEMAS))
+    imp.add_argument("file", help="CSV file with a header row, or - for stdin")
+    imp.add_argument("--chunk-size", type=int, default=500, help="rows per append_rows request")
+    imp.add_argument("--dry-run", action="store_true", help="validate only")
+    imp.add_argument("--rejects", help="write rejected rows to this CSV file")
+    exp = commands.add_parser("export", help="write a worksheet to CSV")
+    exp.add_argument("sheet", choices=tuple(SCHEMAS))
+    exp.add_argument("file", help="output CSV file, or - for stdout")
+    exp.add_argument("--page-size", type=int, default=1000, help="rows per read request")
+    args = parser.parse_args(argv)
+
+    from cardHolder import SheetsConnection
+    _enable_pacing()
+    spreadsheet = SheetsConnection.get().SHEET
+
+    if args.command == "export":
+        if args.file == "-":
+            export_csv(spreadsheet, args.sheet, sys.stdout, args.page_size)
+            return 0
+        with open(args.file, "w", newline="", encoding="utf-8") as target:
+            count = export_csv(spreadsheet, args.sheet, target, args.page_size)
+        print(f"{args.sheet}: {count} rows exported to {args.file}")
+        return 0
+
+    source = sys.stdin if args.file == "-" else open(args.file, newline="", encoding="utf-8-sig")
+    rejects = open(args.rejects, "w", newline="", encoding="utf-8") if args.rejects else None
+    try:
+        report = import_csv(spreadsheet, args.sheet, source, chunk_size=args.chunk_size,
+                            dry_run=args.dry_run, rejects=rejects)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        return 2
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if rejects is not None:
+            rejects.close()
+    verb = "validated" if args.dry_run else "imported"
+    print(f"{args.sheet}: {report.imported} rows {verb} in {report.chunks} requests, {report.rejected} rejected")
+    for line, message in report.errors:
+        print(f"  line {line}: {message}")
+    if report.failed_at_line is not None:
+        print(f"Rows from line {report.failed_at_line} on were not imported.")
+        return 1
+    return 1 if report.rejected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
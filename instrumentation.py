@@ -0,0 +1,218 @@
+import sys
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Round-trip instrumentation for backend calls.
+#
+# cardHolder.py reports every worksheet call (and every worksheet lookup
+# that misses the handle cache) to METRICS, tagged with the operation the
+# session is performing. run.py names the operations: login, balance,
+# withdraw, deposit, pin, transfer. Calls made outside a named operation
+# (e.g. by the write-behind thread) are counted under "other".
+
+_operation = contextvars.ContextVar("atm_operation", default="other")
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+
+# Calls that download a whole worksheet
+FULL_SHEET_CALLS = ("get_all_values", "get_all_records")
+
+
+def current_operation():
+    return _operation.get()
+
+
+def set_operation(name):
+    """Tag the calls that follow (in this thread/context) with an operation name."""
+    _operation.set(name)
+
+
+@contextmanager
+def operation(name):
+    """Tag the calls made inside the block with an operation name."""
+    token = _operation.set(name)
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+def payload_size(value):
+    """Approximate size in bytes of a request or response payload."""
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (bool, int, float)):
+        return len(str(value))
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+    # gspread Cell
+    cell_value = getattr(value, "value", None)
+    return payload_size(cell_value) if isinstance(cell_value, (str, int, float)) else 0
+
+
+class BackendMetrics:
+    """
+    Counters and latency histograms of backend calls, keyed by
+    (operation, call, worksheet). Safe to update from several threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self.started_at = time.time()
+
+    def record(self, call, worksheet, seconds, sent=0, received=0, error=None, op=None):
+        """
+        Record one backend call.
+
+        Args:
+            call: gspread method name (e.g. "get_all_values")
+            worksheet: Worksheet title, or None for spreadsheet-level calls
+            seconds: Wall-clock duration of the call
+            sent: Request payload size in bytes
+            received: Response payload size in bytes
+            error: Exception raised by the call, if any
+            op: Operation name (defaults to the current operation)
+        """
+        key = (op or current_operation(), call, worksheet)
+        ms = seconds * 1000.0
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = {"count": 0, "errors": 0, "seconds": 0.0,
+                                                 "bytes_sent": 0, "bytes_received": 0}
+            counter["count"] += 1
+            counter["seconds"] += seconds
+            counter["bytes_sent"] += sent
+            counter["bytes_received"] += received
+            if error is not None:
+                counter["errors"] += 1
+            buckets = self._histograms.get(key[:2])
+            if buckets is None:
+                buckets = self._histograms[key[:2]] = [0] * len(LATENCY_BUCKETS_MS)
+            for i, bound in enumerate(LATENCY_BUCKETS_MS):
+                if ms <= bound:
+                    buckets[i] += 1
+                    break
+
+    @contextmanager
+    def timed(self, call, worksheet, args=()):
+        """
+        Time a call made inside the block. Assign the response to the
+        yielded dict's "result" key to have its size recorded.
+        """
+        outcome = {"result": None}
+        started = time.perf_counter()
+        error = None
+        try:
+            yield outcome
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.record(call, worksheet, time.perf_counter() - started,
+                        sent=payload_size(list(args)), received=payload_size(outcome["result"]),
+                        error=error)
+
+    def counters(self, op=None, call=None, worksheet=None):
+        """
+        Return matching counters as a list of dicts with op/call/worksheet
+        keys plus count, errors, seconds, bytes_sent and bytes_received.
+        """
+        with self._lock:
+            items = [(key, dict(counter)) for key, counter in self._counters.items()]
+        result = []
+        for (key_op, key_call, key_ws), counter in sorted(items, key=lambda item: tuple(str(k) for k in item[0])):
+            if op is not None and key_op != op:
+                continue
+            if call is not None and key_call != call:
+                continue
+            if worksheet is not None and key_ws != worksheet:
+                continue
+            counter.update(op=key_op, call=key_call, worksheet=key_ws)
+            result.append(counter)
+        return result
+
+    def totals(self, op=None):
+        """Sum of the counters, optionally for one operation."""
+        total = {"count": 0, "errors": 0, "seconds": 0.0, "bytes_sent": 0, "bytes_received": 0}
+        for counter in self.counters(op=op):
+            for field in total:
+                total[field] += counter[field]
+        return total
+
+    def by_operation(self):
+        """Totals per operation name."""
+        ops = sorted({counter["op"] for counter in self.counters()})
+        return {name: self.totals(op=name) for name in ops}
+
+    def full_sheet_downloads(self, op=None):
+        """Counters of calls that fetched an entire worksheet."""
+        return [c for c in self.counters(op=op) if c["call"] in FULL_SHEET_CALLS]
+
+    def histogram(self, op=None, call=None):
+        """
+        Latency histogram merged over matching (operation, call) pairs.
+
+        Returns:
+            List of (upper bound in ms, count) pairs
+        """
+        merged = [0] * len(LATENCY_BUCKETS_MS)
+        with self._lock:
+            for (key_op, key_call), buckets in self._histograms.items():
+                if (op is None or key_op == op) and (call is None or key_call == call):
+                    merged = [a + b for a, b in zip(merged, buckets)]
+        return list(zip(LATENCY_BUCKETS_MS, merged))
+
+    def snapshot(self):
+        """Everything recorded so far, as JSON-serializable data."""
+        with self._lock:
+            histograms = [{"op": op, "call": call, "buckets_ms": [
+                              ["inf" if bound == float("inf") else bound, count]
+                              for bound, count in zip(LATENCY_BUCKETS_MS, buckets)]}
+                          for (op, call), buckets in sorted(self._histograms.items())]
+        return {
+            "started_at": self.started_at,
+            "ended_at": time.time(),
+            "operations": self.by_operation(),
+            "counters": self.counters(),
+            "histograms": histograms,
+        }
+
+    def format_summary(self):
+        lines = [f"{'operation':<10}{'call':<16}{'worksheet':<15}{'n':>5}{'err':>5}{'ms':>10}{'bytes':>10}"]
+        for c in self.counters():
+            lines.append(f"{c['op']:<10}{c['call']:<16}{str(c['worksheet'] or '-'):<15}{c['count']:>5}"
+                         f"{c['errors']:>5}{c['seconds'] * 1000:>10.1f}{c['bytes_sent'] + c['bytes_received']:>10}")
+        return "\n".join(lines)
+
+    def dump(self, path, extra=None):
+        """
+        Write the metrics at session end: JSON to a file, or a summary
+        table to stderr when path is "-". extra maps further sections
+        (e.g. "locks") to JSON-serializable data to include.
+        """
+        extra = extra or {}
+        if path == "-":
+            print(self.format_summary(), file=sys.stderr)
+            for name, data in extra.items():
+                print(f"{name}: {json.dumps(data)}", file=sys.stderr)
+            return
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(dict(self.snapshot(), **extra), f, indent=2)
+
+
+# Process-wide metrics used by cardHolder.py
+METRICS = BackendMetrics()
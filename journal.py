@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: claim() cannot be enforced
+    fcntl = None
+
+# Append-only journal used to make multi-row writes recoverable.
+# Each line is one JSON record. An operation is written as a "begin" record
+# holding everything needed to redo or undo it, followed later by a
+# "commit" or "abort" record with the same id. Anything that has a begin
+# record but no outcome was interrupted and needs recovery.
+
+class JournalBusy(OSError):
+    """Raised by Journal.claim() when another process owns the journal."""
+
+
+class Journal:
+    """
+    Append-only, fsync'ed JSON-lines journal.
+
+    Args:
+        path: File to append to (created if missing)
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._owner = None
+
+    def claim(self):
+        """
+        Become the only process using this journal: an exclusive flock()
+        on path + ".lock", held until release() or the process exits.
+
+        Returns:
+            True once claimed, False where flock() is not available
+
+        Raises:
+            JournalBusy: if another process holds the claim
+        """
+        if fcntl is None:
+            return False
+        if self._owner is None:
+            f = open(self.path + ".lock", "a+")
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                raise JournalBusy(f"{self.path} is in use by another process") from None
+            self._owner = f
+        return True
+
+    def release(self):
+        """Give up the claim taken by claim()."""
+        if self._owner is not None:
+            try:
+                fcntl.flock(self._owner.fileno(), fcntl.LOCK_UN)
+            finally:
+                self._owner.close()
+                self._owner = None
+
+    def append(self, record):
+        """Write one record and force it to disk before returning."""
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def begin(self, op, **data):
+        """
+        Record the start of an operation.
+
+        Returns:
+            The id to pass to commit() or abort()
+        """
+        entry_id = uuid.uuid4().hex
+        record = {"id": entry_id, "op": op, "state": "begin", "ts": time.time()}
+        record.update(data)
+        self.append(record)
+        return entry_id
+
+    def commit(self, entry_id):
+        self.append({"id": entry_id, "state": "commit", "ts": time.time()})
+
+    def commit_many(self, entry_ids):
+        """Commit several entries with a single record (and a single fsync)."""
+        if entry_ids:
+            self.append({"ids": list(entry_ids), "state": "commit", "ts": time.time()})
+
+    def abort(self, entry_id, **data):
+        record = {"id": entry_id, "state": "abort", "ts": time.time()}
+        record.update(data)
+        self.append(record)
+
+    def records(self):
+        """Read every record in order. A torn last line (crash mid-write) is skipped."""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with self._lock:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+        return records
+
+    def pending(self, op=None, min_age=0.0):
+        """
+        Return begin records that have no commit/abort yet.
+
+        Args:
+            op: Only return operations of this type
+            min_age: Skip entries younger than this many seconds, so a
+                     process does not recover another one's in-flight work
+        """
+        begun = {}
+        for record in self.records():
+            if record.get("state") == "begin":
+                begun[record["id"]] = record
+            else:
+                for entry_id in record.get("ids") or [record.get("id")]:
+                    begun.pop(entry_id, None)
+        cutoff = time.time() - min_age
+        return [r for r in begun.values()
+                if (op is None or r.get("op") == op) and r.get("ts", 0) <= cutoff]
+
+    def compact(self):
+        """
+        Rewrite the journal keeping only pending entries.
+        Only safe while no other process is appending to the same file.
+        """
+        keep = self.pending()
+        tmp_path = self.path + ".tmp"
+        with self._lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in keep:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+
+class JournalFlusher:
+    """
+    Background thread that applies journaled operations in batches.
+
+    submit() queues an entry that is already on disk; the thread hands up
+    to max_batch queued entries to apply() and commits them with one
+    journal record once apply() returns. apply() may return the ids of
+    entries it refused to write; those are aborted (reason "stale")
+    instead. If apply() raises, the batch is kept and retried after
+    retry_delay. start() first re-queues entries a previous process
+    journaled but never committed.
+
+    Args:
+        journal: Journal the entries were written to
+        apply: Callable taking a list of begin records; raises on failure
+        op: Operation type handled by this flusher
+        interval: Seconds to wait for more entries before flushing
+        max_batch: Maximum entries per apply() call
+        replay_min_age: Only replay entries at least this old on start()
+    """
+    def __init__(self, journal, apply, op="write", interval=0.5, max_batch=200,
+                 retry_delay=2.0, replay_min_age=30.0):
+        self.journal = journal
+        self.apply = apply
+        self.op = op
+        self.interval = interval
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.replay_min_age = replay_min_age
+        self.last_error = None
+        self._queue = []
+        self._cond = threading.Condition()
+        self._busy = False
+        self._flushing = 0
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            self._queue[:0] = self.journal.pending(op=self.op, min_age=self.replay_min_age)
+        self._thread = threading.Thread(target=self._run, name="journal-flusher", daemon=True)
+        self._thread.start()
+
+    def submit(self, record):
+        with self._cond:
+            self._queue.append(record)
+            self._cond.notify_all()
+
+    def queued(self):
+        """Entries not yet applied, oldest first."""
+        with self._cond:
+            return list(self._queue)
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything submitted so far has been applied.
+
+        Returns:
+            True if the queue drained, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._queue or self._busy:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def stop(self, timeout=None):
+        """Flush what is queued (up to timeout) and stop the thread."""
+        drained = self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return drained
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if self._stopping and not self._queue:
+                    return
+                # Give concurrent writers a moment to join this batch
+                deadline = time.monotonic() + self.interval
+                while len(self._queue) < self.max_batch and not (self._stopping or self._flushing):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.max_batch]
+                self._busy = True
+            try:
+                refused = set(self.apply(batch) or ())
+                for entry_id in refused:
+                    self.journal.abort(entry_id, reason="stale")
+                self.journal.commit_many([record["id"] for record in batch if record["id"] not in refused])
+                self.last_error = None
+                applied = True
+            except Exception as e:
+                self.last_error = e
+                applied = False
+            with self._cond:
+                if applied:
+                    del self._queue[:len(batch)]
+                self._busy = False
+                self._cond.notify_all()
+                if not applied and not self._stopping:
+                    self._cond.wait(self.retry_delay)
+                elif not applied:
+                    return
@@ -0,0 +1,184 @@
+import os
+import time
+import zlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks are per process only
+    fcntl = None
+
+# Per-card / per-account locks for concurrent sessions.
+#
+# Sessions that share a process (atm_server.py) or a host (one run.py per
+# gateway connection) can withdraw from, deposit to or transfer from the
+# same card at the same time. The versioned writes in cardHolder.py keep
+# such races from losing money, but every conflict costs a re-read and a
+# retry against the Sheets quota. LockManager makes operations on the same
+# card or account take turns instead, while operations on other cards run
+# in parallel:
+#   - keys ("account:100", "client:4512...") are hashed onto a fixed set of
+#     striped locks, so memory does not grow with the number of cards;
+#   - a call that needs several keys (a transfer) takes their stripes in
+#     ascending order, so two transfers in opposite directions cannot
+#     deadlock;
+#   - a stripe that is not free within the timeout raises LockTimeout;
+#   - acquisitions, contended acquisitions, timeouts and wait times are
+#     counted (stats()).
+# With lock_dir set, each stripe is also an flock()ed file in that
+# directory, so every process on the host pointing at the same directory
+# takes part.
+
+
+class LockTimeout(RuntimeError):
+    """Raised when a lock could not be taken in time."""
+
+
+class LockManager:
+    """
+    Striped locks keyed by card number or account ID.
+
+    Args:
+        stripes: Number of locks the keys are spread over
+        timeout: Seconds to wait for a lock before raising LockTimeout
+        lock_dir: Directory for stripe files shared between processes
+    """
+    def __init__(self, stripes=64, timeout=30.0, lock_dir=None):
+        self._stats_lock = threading.Lock()
+        self._held = threading.local()
+        self.lock_dir = None
+        self.configure(stripes=stripes, timeout=timeout, lock_dir=lock_dir)
+
+    def configure(self, stripes=None, timeout=None, lock_dir=None):
+        """
+        Change the settings. Only call while no locks are held (at startup):
+        the stripes are recreated and the counters reset.
+        """
+        if stripes is not None:
+            if stripes < 1:
+                raise ValueError("stripes must be at least 1")
+            self.stripes = stripes
+        if timeout is not None:
+            self.timeout = timeout
+        if lock_dir:
+            if fcntl is None:
+                raise OSError("lock_dir needs fcntl (not available on this platform)")
+            os.makedirs(lock_dir, exist_ok=True)
+            self.lock_dir = lock_dir
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self.reset()
+
+    def reset(self):
+        with self._stats_lock:
+            self.counts = {"acquisitions": 0, "contended": 0, "timeouts": 0}
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def stripe(self, key):
+        """Index of the stripe a key maps to (stable across processes)."""
+        return zlib.crc32(str(key).encode("utf-8")) % self.stripes
+
+    @contextmanager
+    def hold(self, *keys, timeout=None):
+        """
+        Hold the locks of the given keys for the duration of the block.
+
+        Stripes are taken in ascending order. A thread that already holds
+        a stripe (a transfer calling update_balance) re-enters it; taking
+        new stripes while holding others can break the ordering, and then
+        the timeout is what ends a deadlock.
+
+        Raises:
+            LockTimeout: if a stripe was not free within timeout seconds
+                (default: the manager's timeout)
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        held = self._held.__dict__.setdefault("stripes", {})
+        taken = []
+        try:
+            for index in sorted({self.stripe(key) for key in keys}):
+                if index in held:
+                    held[index][0] += 1
+                else:
+                    held[index] = [1, self._acquire(index, keys, deadline)]
+                taken.append(index)
+            yield
+        finally:
+            for index in reversed(taken):
+                held[index][0] -= 1
+                if held[index][0] == 0:
+                    self._release(index, held.pop(index)[1])
+
+    def _acquire(self, index, keys, deadline):
+        started = time.monotonic()
+        lock = self._locks[index]
+        contended = not lock.acquire(blocking=False)
+        if contended and not lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            self._count(started, contended, timed_out=True)
+            raise LockTimeout(f"Timed out waiting for the lock of {', '.join(map(str, keys))}")
+        lock_file = None
+        try:
+            if self.lock_dir:
+                lock_file, file_contended = self._acquire_file(index, deadline)
+                contended = contended or file_contended
+        except LockTimeout:
+            lock.release()
+            self._count(started, contended, timed_out=True)
+            raise LockTimeout(f"Timed out waiting for the lock of {', '.join(map(str, keys))}") from None
+        except BaseException:
+            lock.release()
+            raise
+        self._count(started, contended)
+        return lock_file
+
+    def _acquire_file(self, index, deadline):
+        # flock() has no timeout: poll with LOCK_NB until the deadline
+        f = open(os.path.join(self.lock_dir, f"atm-lock-{index}.lock"), "a+")
+        contended = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return f, contended
+                except BlockingIOError:
+                    contended = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LockTimeout(f"stripe {index}")
+                    time.sleep(min(0.005, remaining))
+        except BaseException:
+            f.close()
+            raise
+
+    def _release(self, index, lock_file):
+        if lock_file is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            finally:
+                lock_file.close()
+        self._locks[index].release()
+
+    def _count(self, started, contended, timed_out=False):
+        waited = time.monotonic() - started
+        with self._stats_lock:
+            if timed_out:
+                self.counts["timeouts"] += 1
+            else:
+                self.counts["acquisitions"] += 1
+            if contended:
+                self.counts["contended"] += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def stats(self):
+        """Contention counters, as JSON-serializable data."""
+        with self._stats_lock:
+            return dict(self.counts, stripes=self.stripes,
+                        wait_ms=round(self.wait_seconds * 1000, 1),
+                        max_wait_ms=round(self.max_wait_seconds * 1000, 1))
+
+
+# Process-wide locks used by cardHolder.py
+LOCKS = LockManager()
@@ -0,0 +1,137 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# Fixed-point money in integer cents.
+#
+# Balances arrive from the sheet as strings in several formats ('3 649,30',
+# '557,22', '150.79') or as numbers. Money parses them once, when a record
+# is loaded, and then does exact integer arithmetic, so balances do not
+# drift the way repeated float additions do. Floats and ints mix freely
+# with Money (floats are taken to the nearest cent), and float(money) gives
+# the value to write back to Sheets, SQLite or the journal.
+
+_CENT = Decimal("0.01")
+
+
+class Money:
+    """
+    An amount of money stored as a whole number of cents.
+
+    Args:
+        cents: Integer number of cents (use Money.parse for other values)
+    """
+    __slots__ = ("cents",)
+
+    def __init__(self, cents=0):
+        self.cents = int(cents)
+
+    @classmethod
+    def parse(cls, value):
+        """
+        Convert a sheet value, user input or number to Money.
+        Accepts values like '3 649,30', '557,22', '150.79', 12 or 12.5.
+
+        Raises:
+            ValueError: If the value is not a finite amount
+        """
+        if isinstance(value, Money):
+            return value
+        if isinstance(value, bool):
+            raise ValueError(f"Invalid amount: {value!r}")
+        if isinstance(value, int):
+            return cls(value * 100)
+        if isinstance(value, float):
+            text = repr(value)
+        else:
+            text = str(value).replace('\xa0', '').replace(' ', '').replace(',', '.')
+        try:
+            cents = Decimal(text).quantize(_CENT, rounding=ROUND_HALF_UP)
+        except InvalidOperation:
+            raise ValueError(f"Invalid amount: {value!r}") from None
+        return cls(int(cents.scaleb(2)))
+
+    @classmethod
+    def _coerce(cls, other):
+        if isinstance(other, Money):
+            return other
+        if isinstance(other, (int, float)) and not isinstance(other, bool):
+            return cls.parse(other)
+        return None
+
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __int__(self):
+        return int(self.cents / 100)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __hash__(self):
+        # Equal to the hash of the float with the same value
+        return hash(self.cents / 100)
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+    def __str__(self):
+        sign = "-" if self.cents < 0 else ""
+        units, cents = divmod(abs(self.cents), 100)
+        return f"{sign}{units}.{cents:02d}"
+
+    def __format__(self, spec):
+        if not spec:
+            return str(self)
+        return format(self.to_decimal(), spec)
+
+    def __round__(self, ndigits=None):
+        if ndigits is None:
+            return int(self.to_decimal().quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        if ndigits >= 2:
+            return self
+        step = Decimal(1).scaleb(-ndigits)
+        return Money(int(self.to_decimal().quantize(step, rounding=ROUND_HALF_UP).scaleb(2)))
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Money(abs(self.cents))
+
+    def __add__(self, other):
+        other = self._coerce(other)
+        return NotImplemented if other is None else Money(self.cents + other.cents)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        other = self._coerce(other)
+        return NotImplemented if other is None else Money(self.cents - other.cents)
+
+    def __rsub__(self, other):
+        other = self._coerce(other)
+        return NotImplemented if other is None else Money(other.cents - self.cents)
+
+    def _compare(self, other, op):
+        other = self._coerce(other)
+        return NotImplemented if other is None else op(self.cents, other.cents)
+
+    def __eq__(self, other):
+        return self._compare(other, int.__eq__)
+
+    def __lt__(self, other):
+        return self._compare(other, int.__lt__)
+
+    def __le__(self, other):
+        return self._compare(other, int.__le__)
+
+    def __gt__(self, other):
+        return self._compare(other, int.__gt__)
+
+    def __ge__(self, other):
+        return self._compare(other, int.__ge__)
@@ -0,0 +1,212 @@
+import os
+import sys
+import csv
+import json
+import zlib
+import argparse
+import tempfile
+import contextlib
+
+from cardHolder import _join_key, iter_rows
+from money import Money
+
+# Reconciliation of the two copies of the balances.
+#
+# The 'client' worksheet (SimpleClientRepo) keeps a balance per card; the
+# relational sheets keep it per account ('atmCards' maps cards to
+# accounts, 'account' holds the balance). This job checks that they agree
+# without holding any worksheet in memory:
+#   1. every worksheet is read in A1 range pages (cardHolder.iter_rows)
+#      and its rows are hash-partitioned into temporary files (by
+#      accountID or cardNum);
+#   2. atmCards and account are joined one partition at a time, which
+#      yields (cardNum, accountID, balance) rows partitioned by cardNum;
+#   3. those are joined with the client partitions and compared; a card
+#      listed again in 'client' is reported as a duplicate.
+# Memory use is bounded by one partition plus one page, so the partition
+# count should grow with the sheets:
+#
+#     python reconcile.py --page-size 1000 --partitions 64 --json
+
+# Worksheet title -> number of columns read
+COLUMNS = {"client": 5, "account": 3, "atmCards": 4}
+
+
+def _cell(row, index):
+    return str(row[index]).strip() if len(row) > index else ""
+
+
+def _cents(value):
+    # Unparseable balances count as 0, as in ClientRecord
+    try:
+        return Money.parse(value).cents
+    except (ValueError, TypeError):
+        return 0
+
+
+class _Spill:
+    """Rows hash-partitioned by key into temporary CSV files."""
+    def __init__(self, directory, name, partitions):
+        self.paths = [os.path.join(directory, f"{name}-{i}.csv") for i in range(partitions)]
+        self._files = [open(path, "w", newline="", encoding="utf-8") for path in self.paths]
+        self._writers = [csv.writer(f) for f in self._files]
+
+    def add(self, key, *values):
+        index = zlib.crc32(key.encode("utf-8")) % len(self.paths)
+        self._writers[index].writerow([key, *values])
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def partition(self, index):
+        """Yield the (key, *values) rows of one partition."""
+        with open(self.paths[index], newline="", encoding="utf-8") as f:
+            yield from csv.reader(f)
+
+
+class _Findings:
+    """Counts every finding but keeps at most limit examples of each kind."""
+    KINDS = ("mismatches", "client_only", "client_duplicates", "cards_without_client",
+             "cards_without_account", "accounts_without_card")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.counts = {kind: 0 for kind in self.KINDS}
+        self.examples = {kind: [] for kind in self.KINDS}
+
+    def add(self, kind, item):
+        self.counts[kind] += 1
+        if len(self.examples[kind]) < self.limit:
+            self.examples[kind].append(item)
+
+
+def reconcile(spreadsheet, page_size=1000, partitions=16, limit=100, workdir=None):
+    """
+    Compare the 'client' balances with the 'account'/'atmCards' balances.
+
+    Args:
+        spreadsheet: Spreadsheet (or gspread-like adapter) with the sheets
+        page_size: Rows per read request
+        partitions: Number of spill partitions per dataset
+        limit: Examples kept per kind of finding (all are counted)
+        workdir: Directory for the spill files (a temporary one by default)
+
+    Returns:
+        Report dict with "totals", "matched", "counts" and "examples" keys
+    """
+    findings = _Findings(limit)
+    totals = {title: {"rows": 0, "balance": 0} for title in COLUMNS}
+    matched = 0
+    # Spill files are closed before their directory is removed, also on errors
+    with tempfile.TemporaryDirectory(prefix="atm-reconcile-", dir=workdir) as directory, \
+            contextlib.ExitStack() as stack:
+        # 1. Partition the relational sheets by accountID and client by card
+        spills = {name: stack.enter_context(_Spill(directory, name, partitions))
+                  for name in ("account", "cards", "client")}
+        for _, row in iter_rows(spreadsheet.worksheet("account"), COLUMNS["account"], page_size):
+            cents = _cents(_cell(row, 2))
+            totals["account"]["rows"] += 1
+            totals["account"]["balance"] += cents
+            spills["account"].add(str(_join_key(_cell(row, 0))), cents)
+        for _, row in iter_rows(spreadsheet.worksheet("atmCards"), COLUMNS["atmCards"], page_size):
+            totals["atmCards"]["rows"] += 1
+            spills["cards"].add(str(_join_key(_cell(row, 0))), _cell(row, 1))
+        for _, row in iter_rows(spreadsheet.worksheet("client"), COLUMNS["client"], page_size):
+            cents = _cents(_cell(row, 4))
+            totals["client"]["rows"] += 1
+            totals["client"]["balance"] += cents
+            spills["client"].add(_cell(row, 0), cents)
+        for spill in spills.values():
+            spill.close()
+
+        # 2. atmCards x account -> card balances, partitioned by cardNum
+        linked = stack.enter_context(_Spill(directory, "linked", partitions))
+        for i in range(partitions):
+            accounts = {}
+            for account_id, cents in spills["account"].partition(i):
+                accounts.setdefault(account_id, [int(cents), False])
+            for account_id, card in spills["cards"].partition(i):
+                account = accounts.get(account_id)
+                if account is None:
+                    findings.add("cards_without_account", {"card": card, "accountID": account_id})
+                    linked.add(card, account_id, "")
+                else:
+                    account[1] = True
+                    linked.add(card, account_id, account[0])
+            for account_id, (cents, used) in accounts.items():
+                if not used:
+                    findings.add("accounts_without_card", {"accountID": account_id, "balance": cents / 100})
+        linked.close()
+
+        # 3. client x card balances
+        for i in range(partitions):
+            cards, seen = {}, set()
+            for card, account_id, cents in linked.partition(i):
+                cards.setdefault(card, (account_id, cents))
+            for card, cents in spills["client"].partition(i):
+                if card in seen:
+                    findings.add("client_duplicates", {"card": card, "balance": int(cents) / 100})
+                    continue
+                seen.add(card)
+                link = cards.pop(card, None)
+                if link is None:
+                    findings.add("client_only", {"card": card, "balance": int(cents) / 100})
+                    continue
+                account_id, account_cents = link
+                if account_cents == "":
+                    continue  # already reported as a card without account
+                if int(account_cents) == int(cents):
+                    matched += 1
+                else:
+                    findings.add("mismatches", {
+                        "card": card, "accountID": account_id,
+                        "client_balance": int(cents) / 100, "account_balance": int(account_cents) / 100,
+                        "difference": (int(cents) - int(account_cents)) / 100,
+                    })
+            for card, (account_id, cents) in cards.items():
+                findings.add("cards_without_client", {"card": card, "accountID": account_id})
+
+    for total in totals.values():
+        total["balance"] = total["balance"] / 100
+    return {"totals": totals, "matched": matched, "counts": findings.counts, "examples": findings.examples}
+
+
+def format_report(report):
+    lines = []
+    for title, total in report["totals"].items():
+        balance = f", balance €{total['balance']:,.2f}" if title != "atmCards" else ""
+        lines.append(f"{title}: {total['rows']} rows{balance}")
+    lines.append(f"matched: {report['matched']}")
+    for kind, count in report["counts"].items():
+        lines.append(f"{kind}: {count}")
+        for item in report["examples"][kind]:
+            lines.append("  " + ", ".join(f"{k}={v}" for k, v in item.items()))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that client and account balances agree")
+    parser.add_argument("--page-size", type=int, default=1000, help="rows per read request")
+    parser.add_argument("--partitions", type=int, default=16, help="spill partitions per dataset")
+    parser.add_argument("--limit", type=int, default=100, help="examples listed per finding")
+    parser.add_argument("--workdir", help="directory for spill files")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    from cardHolder import SheetsConnection
+    report = reconcile(SheetsConnection.get().SHEET, page_size=args.page_size, partitions=args.partitions,
+                       limit=args.limit, workdir=args.workdir)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    # Non-zero exit status when anything disagrees, for scheduled jobs
+    return 1 if any(report["counts"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
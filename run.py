@@ -1,7 +1,18 @@
 import sys
 import os
+import json
+import time
 import platform
-from cardHolder import API, show_welcome_message, transfer_money
+import threading
+import contextvars
+
+# Startup timing: module import starts the clock (see startup_report)
+_STARTED_AT = time.perf_counter()
+_STARTUP_MARKS = {}
+
+from cardHolder import API, UnitOfWork, show_welcome_message, transfer_money
+from instrumentation import METRICS, operation, set_operation
+from money import Money
 
 # Cross-platform input handling
 IS_WINDOWS = platform.system() == 'Windows'
@@ -11,42 +22,147 @@ else:
     import termios
     import tty
 
-# Import the API class and test the connection
-api = None
-try:
-    api = API()
-    if api is None:
-        print("[WARN] Google APIs unavailable")
-except Exception as e:
-    print(f"[WARN] Failed to initialize API: {e}")
-
-# Import necessary classes
-# If any are unsuccessful assign api to "None" so the program wont continue
-try:
-    from cardHolder import Account
-except Exception as e:
-    print(f"[WARN] Failed to import Account: {e}")
-    api = None
-
-try:
-    from cardHolder import AccountHolder
-except Exception as e:
-    print(f"[WARN] Failed to import AccountHolder: {e}")
-    api = None
-
-try:
-    from cardHolder import ATMCard
-except Exception as e:
-    print(f"[WARN] Failed to import ATMCard: {e}")
-    api = None
-
-# Import repo for the single-sheet format
-try:
-    from cardHolder import SimpleClientRepo
-    repo = SimpleClientRepo()
-except Exception as _:
-    repo = None
+# ATM_BACKEND selects the data store: "sheets" (Google Sheets, the default)
+# or "sqlite" (a local database file, see sqlite_backend.py)
+ATM_BACKEND = os.environ.get("ATM_BACKEND", "sheets").strip().lower()
+ATM_SQLITE_PATH = os.environ.get("ATM_SQLITE_PATH", "atm.db")
+
+# Opt-in write-behind mode: writes are acknowledged once they are in the local
+# journal and a background thread applies them to Google Sheets. Only one
+# process can own a journal; others sharing the path write directly.
+write_behind_journal = os.environ.get("ATM_WRITE_BEHIND_JOURNAL")
+
+# The backends are created by _ensure_backends() the first time a session
+# needs them (after the banner is shown), not when this module is imported.
+# _PENDING marks one that has not been created yet; api/repo may also be
+# assigned directly, in which case they are left alone.
+_PENDING = object()
+api = _PENDING
+repo = _PENDING
+_backends_lock = threading.Lock()
+
+
+def _enable_scheduler():
+    # Keep Google Sheets traffic under the per-minute quotas. Set
+    # ATM_READS_PER_MINUTE / ATM_WRITES_PER_MINUTE to enable the scheduler;
+    # ATM_RATE_LIMIT_DIR shares the budget between all sessions on the host.
+    if ATM_BACKEND == "sqlite" or not (os.environ.get("ATM_READS_PER_MINUTE") or os.environ.get("ATM_WRITES_PER_MINUTE")):
+        return
+    from scheduler import RequestScheduler
+    if RequestScheduler.active() is not None:
+        return
+    try:
+        RequestScheduler.enable(read_per_minute=float(os.environ.get("ATM_READS_PER_MINUTE") or 60),
+                                write_per_minute=float(os.environ.get("ATM_WRITES_PER_MINUTE") or 60),
+                                state_dir=os.environ.get("ATM_RATE_LIMIT_DIR") or None)
+    except (ValueError, OSError) as e:
+        print(f"[WARN] Request scheduler disabled: {e}")
+
+
+def _configure_locks():
+    # Sessions on the same card or account take turns (locks.LOCKS).
+    # ATM_LOCK_DIR extends the locks to every session on the host that
+    # uses the same directory; ATM_LOCK_TIMEOUT is the wait in seconds
+    # before an operation gives up.
+    lock_dir = os.environ.get("ATM_LOCK_DIR")
+    lock_timeout = os.environ.get("ATM_LOCK_TIMEOUT")
+    if not (lock_dir or lock_timeout):
+        return
+    from locks import LOCKS
+    try:
+        LOCKS.configure(timeout=float(lock_timeout) if lock_timeout else None, lock_dir=lock_dir or None)
+    except (ValueError, OSError) as e:
+        print(f"[WARN] Lock settings ignored: {e}")
+
+
+def _create_api():
+    try:
+        if ATM_BACKEND == "sqlite":
+            from sqlite_backend import SqliteAPI
+            return SqliteAPI(ATM_SQLITE_PATH)
+        # API() and SimpleClientRepo() share one authorized connection
+        # (cardHolder.SheetsConnection), so credentials are loaded once
+        return API()
+    except Exception as e:
+        print(f"[WARN] Failed to initialize API: {e}")
+        return None
+
+
+def _create_repo():
+    try:
+        if ATM_BACKEND == "sqlite":
+            from sqlite_backend import SqliteClientRepo
+            return SqliteClientRepo(ATM_SQLITE_PATH)
+        from cardHolder import SimpleClientRepo
+        # Transfers are journaled so a crash mid-transfer is repaired on the next start.
+        # Set ATM_JOURNAL_PATH to an empty string to disable the journal.
+        from cardHolder import WriteBehind
+        return SimpleClientRepo(journal_path=os.environ.get("ATM_JOURNAL_PATH", "transfers.journal") or None,
+                                write_behind=WriteBehind.active() is not None)
+    except Exception as _:
+        return None
+
+
+def _ensure_backends():
+    """Create whichever of api/repo has not been created or assigned yet."""
+    global api, repo
+    if api is not _PENDING and repo is not _PENDING:
+        return
+    with _backends_lock:
+        _enable_scheduler()
+        _configure_locks()
+        if api is _PENDING:
+            api = _create_api()
+        if repo is _PENDING:
+            if write_behind_journal:
+                from cardHolder import WriteBehind
+                from journal import JournalBusy
+                try:
+                    WriteBehind.enable(write_behind_journal)
+                except JournalBusy as e:
+                    print(f"[WARN] Write-behind disabled: {e}")
+            repo = _create_repo()
+    _mark("backends")
+
 
+def _mark(name):
+    """Record when a startup milestone was first reached."""
+    _STARTUP_MARKS.setdefault(name, time.perf_counter())
+
+
+def startup_report():
+    """
+    Milliseconds from importing run.py to each startup milestone: imports,
+    banner and backends. If the launcher sets ATM_SPAWNED_AT (epoch ms, as
+    the gateway does) the time since the process was spawned is included.
+    """
+    report = {name: round((at - _STARTED_AT) * 1000, 1) for name, at in _STARTUP_MARKS.items()}
+    spawned_at = os.environ.get("ATM_SPAWNED_AT")
+    if spawned_at:
+        try:
+            now_ms = time.time() * 1000
+            since_start = (time.perf_counter() - _STARTED_AT) * 1000
+            report["spawn_to_import"] = round(now_ms - float(spawned_at) - since_start, 1)
+        except ValueError:
+            pass
+    return report
+
+
+def _write_startup_report():
+    # ATM_STARTUP_REPORT=<file> appends one JSON line per session start;
+    # "-" prints it to stderr
+    target = os.environ.get("ATM_STARTUP_REPORT")
+    if not target:
+        return
+    line = json.dumps(startup_report())
+    try:
+        if target == "-":
+            print(f"[STARTUP] {line}", file=sys.stderr)
+        else:
+            with open(target, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        print(f"[WARN] Failed to write startup report: {e}")
 
 
 def print_banner():
@@ -192,10 +308,69 @@ def get_pin(prompt="PIN: ", max_length=6):
     
     return pin
 
+class _Prefetch:
+    """
+    Runs a lookup on a daemon thread so it overlaps with the user typing.
+    The calling context is copied, so backend calls keep their operation tag.
+    """
+    def __init__(self, fn, *args):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run, fn, args),
+                         name="card-prefetch", daemon=True).start()
+
+    def _run(self, fn, args):
+        try:
+            self._result = fn(*args)
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+def _lookup_card(api, card_num):
+    """
+    Look a card up the way authenticate() always has: ATM cards through the
+    API first, then the client sheet through the repo.
+
+    Returns:
+        (source, obj, notes): source is 'api' or 'repo' when found, 'retry'
+        when the repo has no such card, or None; notes are messages to show
+    """
+    notes = []
+    if api is not None:
+        try:
+            cards = api.getATMCards(card_num)
+        except Exception as e:
+            notes.append("Unable to process your card. Please try again or contact support.")
+            cards = []
+        if cards:
+            return ('api', cards[0], notes)
+    if repo is not None:
+        try:
+            rec = repo.get_record(card_num)
+            if not rec:
+                return ('retry', None, notes)
+            return ('repo', rec, notes)
+        except Exception as e:
+            notes.append(f"[WARN] Sheet lookup failed: {e}")
+    return (None, None, notes)
+
 def authenticate(api):
     """Prompt for card and PIN first, return a tuple (source, obj) or None.
     source: 'api' for ATMCard via API, 'repo' for ClientRecord via SimpleClientRepo
+
+    The card lookup starts in the background as soon as the card number is
+    entered, so it runs while the PIN is being typed.
     """
+    _ensure_backends()
     while True:
         try:
             card_num = input("Insert Your Card: ").strip()
@@ -206,93 +381,86 @@ def authenticate(api):
             print("\nOperation cancelled")
             return None
 
-        if api is not None:
-            try:
-                cards = api.getATMCards(card_num)
-            except Exception as e:
-                print("Unable to process your card. Please try again or contact support.")
-                cards = []
+        lookup = _Prefetch(_lookup_card, api, card_num)
+        try:
+            pin = get_pin("PIN: ")
+        except (EOFError, KeyboardInterrupt):
+            print("\nOperation cancelled")
+            return None
 
-            if cards: 
-                card = cards[0]
-                pin_attempts = 0
-                while pin_attempts < 3:
-                    pin = get_pin("PIN: ")
-                    if not card.verify_pin(pin):
-                        pin_attempts += 1
-                        remaining_attempts = 3 - pin_attempts
-                        print("Incorrect PIN.")
-                        if remaining_attempts > 0:
-                            print(f"You have {remaining_attempts} attempt(s) remaining for your PIN to enter")
-                            try:
-                                print(f"Failed tries: {card.getFailedTries()}")
-                            except:
-                                pass
-                        if pin_attempts >= 3:
-                            print("Too many failed PIN attempts. Your card has been locked for security.")
-                            print("Please contact your bank administration to unlock your card.")
-                            return None
-                        continue
-                    return ('api', card)
-
-        if repo is not None:
-            try:
-                rec = repo.get_record(card_num)
-                if not rec:
-                    print("Card not found. Please try again.")
-                    continue
+        source, obj, notes = lookup.result()
+        for note in notes:
+            print(note)
+        if source == 'retry':
+            print("Card not found. Please try again.")
+            continue
+        if source is None:
+            print("Card not found.")
+            return None
 
-                pin_attempts = 0
-                while pin_attempts < 3:
-                    pin = get_pin("PIN: ")
-                    if str(rec.pin) == str(pin):
-                        return ('repo', rec)
-                    else:
-                        pin_attempts += 1
-                        remaining_attempts = 3 - pin_attempts
-                        print("Incorrect PIN.")
-                        if remaining_attempts > 0:
-                            print(f"You have {remaining_attempts} attempt(s) remaining for your PIN to enter")
-                        if pin_attempts >= 3:
-                            print("Too many failed PIN attempts. Your card has been locked for security.")
-                            print("Please contact your bank administration to unlock your card.")
-                            return None
-                        continue
-            except Exception as e:
-                print(f"[WARN] Sheet lookup failed: {e}")
-
-        print("Card not found.")
-        return None
+        pin_attempts = 0
+        while True:
+            if source == 'api':
+                verified = UnitOfWork.run(obj.verify_pin, pin, best_effort=True)
+            else:
+                verified = str(obj.pin) == str(pin)
+            if verified:
+                return (source, obj)
+            pin_attempts += 1
+            remaining_attempts = 3 - pin_attempts
+            print("Incorrect PIN.")
+            if remaining_attempts > 0:
+                print(f"You have {remaining_attempts} attempt(s) remaining for your PIN to enter")
+                if source == 'api':
+                    try:
+                        print(f"Failed tries: {obj.getFailedTries()}")
+                    except:
+                        pass
+            if pin_attempts >= 3:
+                print("Too many failed PIN attempts. Your card has been locked for security.")
+                print("Please contact your bank administration to unlock your card.")
+                return None
+            try:
+                pin = get_pin("PIN: ")
+            except (EOFError, KeyboardInterrupt):
+                print("\nOperation cancelled")
+                return None
 
 def _parse_amount(s):
     """
-    Parse amount string to float, handling various formats.
+    Parse amount string to Money, handling various formats.
     
     Args:
         s: Amount string (can contain spaces, commas, etc.)
     
     Returns:
-        Float value of the amount
+        Money value of the amount (compares equal to the matching float)
     
     Raises:
         ValueError: If the string cannot be converted to a valid amount
     """
     try:
-        s = str(s).replace('\xa0', '').replace(' ', '').replace(',', '.')
-        amount = float(s)
+        amount = Money.parse(s)
         if amount < 0:
             raise ValueError("Amount cannot be negative")
         return amount
     except (ValueError, TypeError) as e:
         raise ValueError(f"Invalid amount format: {s}") from e
 
+# Operation names used to tag backend calls in instrumentation.METRICS
+MENU_OPERATIONS = {"1": "balance", "2": "withdraw", "3": "deposit", "4": "pin", "5": "transfer"}
+
 def main():
     print_banner()
+    _mark("banner")
+    _ensure_backends()
+    _write_startup_report()
     if api is None and repo is None:
         print("[ERROR] Backend unavailable. Please check Google credentials or Sheets.")
         return
 
-    auth = authenticate(api)
+    with operation("login"):
+        auth = authenticate(api)
     if not auth:
         print("Goodbye!")
         return
@@ -317,6 +485,7 @@ def main():
         if choice in ("6", "quit", "exit"):
             print("Goodbye!")
             break
+        set_operation(MENU_OPERATIONS.get(choice, "other"))
 
         if source == 'api':
             # Existing API + ATMCard flow
@@ -330,7 +499,7 @@ def main():
                     print(f"Invalid amount. {e}"); continue
                 if amt <= 0: 
                     print("Amount must be positive"); continue
-                if obj.withdraw(amt):
+                if UnitOfWork.run(obj.withdraw, amt):
                     print(f"✓ Withdrawn €{amt:,.2f}. New balance: €{obj.check_balance():,.2f}")
                 else:
                     print("Withdrawal failed (insufficient funds or server error).")
@@ -341,7 +510,7 @@ def main():
                     print(f"Invalid amount. {e}"); continue
                 if amt <= 0: 
                     print("Amount must be positive"); continue
-                if obj.deposit(amt):
+                if UnitOfWork.run(obj.deposit, amt):
                     print(f"✓ Deposited €{amt:,.2f}. New balance: €{obj.check_balance():,.2f}")
                 else:
                     print("Deposit failed (server error).")
@@ -361,12 +530,17 @@ def main():
                 if len(new_pin) < 4:
                     print("PIN must be at least 4 digits"); continue
                     
-                if obj.change_pin(new_pin):
+                if UnitOfWork.run(obj.change_pin, new_pin):
                     print("✓ PIN changed successfully.")
                 else:
                     print("Failed to change PIN.")
             elif choice == "5":
-                transfer_money(obj, repo)
+                # Transfers move client balances: use this card's client record
+                rec = repo.get_record(obj.getCardNumber()) if repo is not None else None
+                if rec:
+                    transfer_money(rec, repo)
+                else:
+                    print("Transfers are not available for this card.")
             else:
                 print("Invalid option. Please choose 1-6.")
         else:
@@ -381,9 +555,9 @@ def main():
                     print("Amount must be positive"); continue
                 if amt > obj.balance:
                     print("Withdrawal failed (insufficient funds)."); continue
-                new_balance = obj.balance - amt
-                if repo.update_balance(obj.cardNum, new_balance):
-                    obj.balance = new_balance
+                # Versioned write: obj.balance may be re-read before amt is applied
+                if repo.update_balance(obj.cardNum, obj.balance - amt, expected=obj):
+                    obj.balance -= amt
                     print(f"✓ Withdrawn €{amt:,.2f}. New balance: €{obj.balance:,.2f}")
                 else:
                     print("Withdrawal failed (server error).")
@@ -394,9 +568,8 @@ def main():
                     print(f"Invalid amount. {e}"); continue
                 if amt <= 0: 
                     print("Amount must be positive"); continue
-                new_balance = obj.balance + amt
-                if repo.update_balance(obj.cardNum, new_balance):
-                    obj.balance = new_balance
+                if repo.update_balance(obj.cardNum, obj.balance + amt, expected=obj):
+                    obj.balance += amt
                     print(f"✓ Deposited €{amt:,.2f}. New balance: €{obj.balance:,.2f}")
                 else:
                     print("Deposit failed (server error).")
@@ -450,10 +623,30 @@ def main():
                 transfer_money(obj, repo)
             else:
                 print("Invalid option. Please choose 1-6.")
+    set_operation("other")
     return
 
+_mark("imports")
+
 if __name__ == "__main__":
-    if api is not None or repo is not None:
-        main()
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        # Server mode: one process serving many sessions (see atm_server.py)
+        from atm_server import main as serve_main
+        _ensure_backends()
+        serve_main(sys.argv[2] if len(sys.argv) > 2 else None, backends=(api, repo), ui=sys.modules[__name__])
     else:
-        print("[ERROR] No backend available. Cannot start ATM application.")
\ No newline at end of file
+        main()
+    if write_behind_journal:
+        # Anything not flushed here stays in the journal and is replayed next start
+        from cardHolder import WriteBehind
+        WriteBehind.disable(timeout=10)
+    # ATM_METRICS_OUTPUT=<file> writes per-operation backend call metrics
+    # (and lock contention) as JSON when the session ends; "-" prints a
+    # summary table to stderr
+    metrics_output = os.environ.get("ATM_METRICS_OUTPUT")
+    if metrics_output:
+        try:
+            from locks import LOCKS
+            METRICS.dump(metrics_output, extra={"locks": LOCKS.stats()})
+        except OSError as e:
+            print(f"[WARN] Failed to write metrics: {e}")
\ No newline at end of file
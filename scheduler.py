@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import random
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: buckets are per process only
+    fcntl = None
+
+# Quota-aware scheduling of Google Sheets requests.
+#
+# Sheets limits reads and writes per minute. RequestScheduler sits in front
+# of every worksheet call made by cardHolder.py and:
+#   - takes a token from a read or write TokenBucket before each request,
+#     so bursts are smoothed out instead of answered with 429s;
+#   - lets identical reads that are in flight at the same time share one
+#     request (e.g. several sessions downloading the 'client' tab);
+#   - gives waiting writes the next free request slot ahead of reads, so a
+#     burst of logins cannot starve balance updates;
+#   - retries 429 answers with backoff after draining the bucket.
+# With state_dir set, the buckets live in small lock-protected files so
+# every run.py process on the host (one per gateway connection) shares the
+# same budget. Coalescing and write priority apply within a process.
+
+WRITE_CALLS = frozenset([
+    "update_cell", "update_cells", "update", "batch_update", "append_row", "append_rows",
+    "insert_row", "insert_rows", "delete_row", "delete_rows", "clear", "batch_clear",
+    "update_title", "add_worksheet", "del_worksheet",
+])
+
+
+def call_kind(name):
+    """Classify a gspread method name as a "read" or a "write"."""
+    return "write" if name in WRITE_CALLS else "read"
+
+
+class SchedulerTimeout(RuntimeError):
+    """Raised when no quota token became available in time."""
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute.
+
+    Args:
+        rate_per_minute: Sustained requests per minute
+        burst: Bucket capacity (defaults to half a minute's worth)
+        state_path: File holding the bucket state, shared between processes
+    """
+    def __init__(self, rate_per_minute, burst=None, state_path=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst if burst is not None else max(1.0, rate_per_minute / 2.0))
+        self.state_path = state_path if fcntl is not None else None
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time.time()
+
+    def _update(self, change):
+        """Apply change(tokens) -> tokens to the refilled bucket and store the result."""
+        with self._lock:
+            if self.state_path is None:
+                now = time.time()
+                tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._tokens, self._updated = change(tokens), now
+                return self._tokens
+            with open(self.state_path, "a+", encoding="utf-8") as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read() or "{}")
+                    except ValueError:
+                        state = {}
+                    now = time.time()
+                    tokens = state.get("tokens", self.capacity)
+                    tokens = min(self.capacity, tokens + max(0.0, now - state.get("ts", now)) * self.rate)
+                    tokens = change(tokens)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({"tokens": tokens, "ts": now}))
+                    f.flush()
+                    return tokens
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def try_acquire(self):
+        """
+        Take a token if one is available.
+
+        Returns:
+            0.0 if a token was taken, otherwise the seconds until one is due
+        """
+        taken = []
+
+        def take(tokens):
+            if tokens >= 1.0:
+                taken.append(True)
+                return tokens - 1.0
+            return tokens
+        tokens = self._update(take)
+        if taken:
+            return 0.0
+        return (1.0 - tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def acquire(self, timeout=None):
+        """Block until a token is taken. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if wait == 0.0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(min(wait, 1.0))
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server answered 429."""
+        self._update(lambda tokens: 0.0)
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _copy_result(value):
+    # Rows are lists; give each caller its own copy of a shared read
+    if isinstance(value, list):
+        return [list(v) if isinstance(v, list) else v for v in value]
+    return value
+
+
+class RequestScheduler:
+    """
+    Rate limits, coalesces and prioritizes backend requests.
+
+    Args:
+        read_per_minute: Read requests allowed per minute
+        write_per_minute: Write requests allowed per minute
+        burst: Bucket capacity for both buckets (default: half a minute)
+        max_concurrent: Requests allowed in flight at once in this process
+        max_retries: Retries of a request answered with 429
+        retry_base: First backoff delay in seconds (doubled per retry)
+        acquire_timeout: Seconds to wait for a token before giving up
+        state_dir: Directory for bucket files shared between processes
+    """
+    _active = None
+    _active_lock = threading.Lock()
+
+    def __init__(self, read_per_minute=60, write_per_minute=60, burst=None, max_concurrent=4,
+                 max_retries=3, retry_base=1.0, acquire_timeout=60.0, state_dir=None):
+        def bucket_path(kind):
+            return os.path.join(state_dir, f"atm-sheets-{kind}.bucket") if state_dir else None
+        self.buckets = {
+            "read": TokenBucket(read_per_minute, burst, bucket_path("read")),
+            "write": TokenBucket(write_per_minute, burst, bucket_path("write")),
+        }
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        self._running = 0
+        self._waiting_writes = 0
+        self._inflight = {}
+        self._generation = 0
+        self.counts = {"requests": 0, "coalesced": 0, "retries": 0, "throttled": 0, "timeouts": 0}
+
+    @classmethod
+    def enable(cls, **kwargs):
+        """Route every worksheet call in this process through a scheduler."""
+        with cls._active_lock:
+            cls._active = cls(**kwargs)
+            return cls._active
+
+    @classmethod
+    def active(cls):
+        return cls._active
+
+    @classmethod
+    def disable(cls):
+        with cls._active_lock:
+            cls._active = None
+
+    def submit(self, kind, key, fn):
+        """
+        Run fn() as a backend request of the given kind ("read"/"write").
+        Reads with the same key that overlap in time share one request;
+        pass key=None to never coalesce.
+        """
+        if kind == "write":
+            with self._cond:
+                # Reads that start after this write must not reuse older results
+                self._generation += 1
+            return self._execute(kind, fn)
+        if key is None:
+            return self._execute(kind, fn)
+        with self._cond:
+            key = (self._generation, key)
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = _InFlight()
+                leader = True
+            else:
+                self.counts["coalesced"] += 1
+                leader = False
+        if not leader:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return _copy_result(pending.result)
+        try:
+            pending.result = self._execute(kind, fn)
+            return pending.result
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self._cond:
+                self._inflight.pop(key, None)
+            pending.done.set()
+
+    def _execute(self, kind, fn):
+        bucket = self.buckets[kind]
+        attempt = 0
+        while True:
+            if bucket.try_acquire() != 0.0:
+                with self._cond:
+                    self.counts["throttled"] += 1
+                if not bucket.acquire(self.acquire_timeout):
+                    with self._cond:
+                        self.counts["timeouts"] += 1
+                    raise SchedulerTimeout(f"No Sheets {kind} quota available after {self.acquire_timeout}s")
+            self._enter(kind)
+            try:
+                with self._cond:
+                    self.counts["requests"] += 1
+                return fn()
+            except Exception as e:
+                # gspread.exceptions.APIError carries the HTTP response
+                if getattr(getattr(e, "response", None), "status_code", None) != 429 or attempt >= self.max_retries:
+                    raise
+                bucket.drain()
+            finally:
+                self._leave()
+            with self._cond:
+                self.counts["retries"] += 1
+            delay = self.retry_base * (2 ** attempt)
+            time.sleep(delay + random.uniform(0, delay / 2))
+            attempt += 1
+
+    def _enter(self, kind):
+        with self._cond:
+            if kind == "write":
+                self._waiting_writes += 1
+                try:
+                    while self._running >= self.max_concurrent:
+                        self._cond.wait()
+                finally:
+                    self._waiting_writes -= 1
+            else:
+                while self._running >= self.max_concurrent or self._waiting_writes:
+                    self._cond.wait()
+            self._running += 1
+
+    def _leave(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return dict(self.counts, in_flight=self._running)
@@ -0,0 +1,350 @@
+import json
+import time
+import random
+import threading
+from collections import Counter, deque
+
+import gspread.utils
+import gspread.exceptions
+from gspread.cell import Cell
+
+# In-process stand-in for the part of the gspread API this project uses.
+#
+# Spreadsheets live in memory. Every call can be slowed down by a fixed
+# latency plus jitter and can fail with the errors Google Sheets returns
+# under load: 429 when a quota is exhausted and 503 for transient backend
+# failures. Failed calls are rejected before they change anything, like
+# the real service. A seed makes the injected faults reproducible.
+#
+# Typical use:
+#     emulator = SheetsEmulator(latency=0.08, quota_error_rate=0.01, seed=1)
+#     emulator.load("client_database", {"client": [[...header...], [...]]})
+#     install(emulator)   # API(), repos and models now talk to the emulator
+
+
+class _EmulatedResponse:
+    """The bits of a requests.Response that gspread.exceptions.APIError reads."""
+    def __init__(self, status_code, message, status):
+        self.status_code = status_code
+        self._body = {"error": {"code": status_code, "message": message, "status": status}}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+def _cell_text(value):
+    """Store values the way Sheets shows them after USER_ENTERED input."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _payload_size(value):
+    return len(json.dumps(value, default=str))
+
+
+class SheetsEmulator:
+    """
+    Emulated Sheets service: owns the spreadsheets, the fault injection and
+    the call statistics.
+
+    Args:
+        latency: Seconds added to every call
+        jitter: Extra random latency, uniform in [0, jitter]
+        quota_error_rate: Probability that a call fails with 429
+        transient_error_rate: Probability that a call fails with 503
+        read_quota_per_minute: Reads allowed per rolling minute before 429s
+                               (None for unlimited; Sheets allows 60 per user)
+        write_quota_per_minute: Same for writes
+        seed: Seed for the jitter and fault generator
+    """
+    def __init__(self, latency=0.0, jitter=0.0, quota_error_rate=0.0, transient_error_rate=0.0,
+                 read_quota_per_minute=None, write_quota_per_minute=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_error_rate = quota_error_rate
+        self.transient_error_rate = transient_error_rate
+        self.quota_per_minute = {"read": read_quota_per_minute, "write": write_quota_per_minute}
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._spreadsheets = {}
+        self._windows = {"read": deque(), "write": deque()}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = Counter()
+            self.errors = Counter()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def stats(self):
+        """Snapshot of the call counters."""
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "errors": dict(self.errors),
+                "round_trips": sum(self.calls.values()),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+            }
+
+    def load(self, name, sheets):
+        """
+        Create (or replace) a spreadsheet.
+
+        Args:
+            name: Spreadsheet name, as passed to open()
+            sheets: Dict of worksheet title -> list of rows (header included)
+        """
+        spreadsheet = EmulatedSpreadsheet(self, name)
+        for title, rows in sheets.items():
+            spreadsheet._add(title, rows)
+        with self._lock:
+            self._spreadsheets[name] = spreadsheet
+        return spreadsheet
+
+    def open(self, name):
+        self.request("read", "open", name)
+        with self._lock:
+            spreadsheet = self._spreadsheets.get(name)
+        if spreadsheet is None:
+            raise gspread.exceptions.SpreadsheetNotFound(name)
+        return spreadsheet
+
+    def request(self, kind, method, sent=None):
+        """
+        Account for one round trip: sleep, apply quotas and fault injection.
+        Raises gspread.exceptions.APIError when the call is rejected.
+        """
+        with self._lock:
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+            roll = self._random.random()
+            self.calls[method] += 1
+            if sent is not None:
+                self.bytes_sent += _payload_size(sent)
+            error = self._quota_exceeded(kind)
+            if error is None and roll < self.quota_error_rate:
+                error = (429, "Quota exceeded (injected)", "RESOURCE_EXHAUSTED")
+            elif error is None and roll < self.quota_error_rate + self.transient_error_rate:
+                error = (503, "The service is currently unavailable (injected)", "UNAVAILABLE")
+            if error is not None:
+                self.errors[error[0]] += 1
+        if delay > 0:
+            time.sleep(delay)
+        if error is not None:
+            raise gspread.exceptions.APIError(_EmulatedResponse(*error))
+
+    def _quota_exceeded(self, kind):
+        limit = self.quota_per_minute.get(kind)
+        if limit is None:
+            return None
+        window = self._windows[kind]
+        now = time.monotonic()
+        while window and now - window[0] >= 60.0:
+            window.popleft()
+        if len(window) >= limit:
+            return (429, f"Quota exceeded for quota metric '{kind.capitalize()} requests'", "RESOURCE_EXHAUSTED")
+        window.append(now)
+        return None
+
+    def received(self, value):
+        """Account for a response body and return it."""
+        with self._lock:
+            self.bytes_received += _payload_size(value)
+        return value
+
+
+class EmulatedSpreadsheet:
+    def __init__(self, emulator, title):
+        self.emulator = emulator
+        self.title = title
+        self._worksheets = {}
+
+    def _add(self, title, rows):
+        ws = EmulatedWorksheet(self, title, rows)
+        self._worksheets[title] = ws
+        return ws
+
+    def worksheet(self, title):
+        self.emulator.request("read", "worksheet", title)
+        ws = self._worksheets.get(title)
+        if ws is None:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return ws
+
+    def worksheets(self):
+        self.emulator.request("read", "worksheets")
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows=0, cols=0, index=None):
+        self.emulator.request("write", "add_worksheet", title)
+        return self._add(title, [])
+
+    def del_worksheet(self, worksheet):
+        self.emulator.request("write", "del_worksheet", worksheet.title)
+        self._worksheets.pop(worksheet.title, None)
+
+
+class EmulatedWorksheet:
+    """One tab. Cells are strings; rows are padded to the widest row on read."""
+    def __init__(self, spreadsheet, title, rows):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self._rows = [[_cell_text(v) for v in row] for row in rows]
+
+    @property
+    def _emulator(self):
+        return self.spreadsheet.emulator
+
+    @property
+    def _lock(self):
+        return self._emulator._lock
+
+    def _padded(self, rows):
+        width = max((len(r) for r in self._rows), default=0)
+        return [list(r) + [""] * (width - len(r)) for r in rows]
+
+    def _set(self, row, col, value):
+        while len(self._rows) < row:
+            self._rows.append([])
+        cells = self._rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = _cell_text(value)
+
+    @property
+    def row_count(self):
+        """Rows in the grid, as gspread reports it (no request)."""
+        return len(self._rows)
+
+    # Reads
+
+    def get_all_values(self):
+        self._emulator.request("read", "get_all_values")
+        with self._lock:
+            return self._emulator.received(self._padded(self._rows))
+
+    def get_values(self, range_name=None, **kwargs):
+        """Values of an A1 range such as "A2:E101" or "B:B" (the whole sheet if omitted)."""
+        self._emulator.request("read", "get_values", range_name)
+        with self._lock:
+            return self._emulator.received(self._range(range_name))
+
+    get = get_values
+
+    def batch_get(self, ranges, **kwargs):
+        """Values of several A1 ranges in one request."""
+        self._emulator.request("read", "batch_get", list(ranges))
+        with self._lock:
+            return self._emulator.received([self._range(name) for name in ranges])
+
+    def _range(self, range_name):
+        rows = self._padded(self._rows)
+        if range_name:
+            first, _, last = range_name.partition(":")
+            r1, c1 = self._a1(first, start=True)
+            r2, c2 = self._a1(last or first, start=False)
+            rows = [r[c1 - 1:c2] for r in rows[r1 - 1:r2]]
+            # Sheets drops trailing empty rows from a range response
+            while rows and not any(rows[-1]):
+                rows.pop()
+        return rows
+
+    @staticmethod
+    def _a1(label, start):
+        """Parse "B2", "B" or "2" into (row, col); a missing part is open-ended."""
+        letters = "".join(ch for ch in label if ch.isalpha())
+        digits = "".join(ch for ch in label if ch.isdigit())
+        unbounded = 1 if start else 10 ** 6
+        row = int(digits) if digits else unbounded
+        col = gspread.utils.a1_to_rowcol(letters + "1")[1] if letters else unbounded
+        return row, col
+
+    def row_values(self, row):
+        self._emulator.request("read", "row_values", row)
+        with self._lock:
+            values = list(self._rows[row - 1]) if 0 < row <= len(self._rows) else []
+            # Sheets trims trailing empty cells
+            while values and values[-1] == "":
+                values.pop()
+            return self._emulator.received(values)
+
+    def col_values(self, col):
+        self._emulator.request("read", "col_values", col)
+        with self._lock:
+            values = [r[col - 1] if len(r) >= col else "" for r in self._rows]
+            while values and values[-1] == "":
+                values.pop()
+            return self._emulator.received(values)
+
+    def findall(self, query, in_row=None, in_column=None, case_sensitive=True):
+        self._emulator.request("read", "findall", str(query))
+        return self._find(query, in_row, in_column, case_sensitive)
+
+    def find(self, query, in_row=None, in_column=None, case_sensitive=True):
+        self._emulator.request("read", "find", str(query))
+        cells = self._find(query, in_row, in_column, case_sensitive)
+        return cells[0] if cells else None
+
+    def _find(self, query, in_row, in_column, case_sensitive):
+        text = str(query) if case_sensitive else str(query).lower()
+        cells = []
+        with self._lock:
+            for r, row in enumerate(self._rows, start=1):
+                if in_row is not None and r != in_row:
+                    continue
+                for c, value in enumerate(row, start=1):
+                    if in_column is not None and c != in_column:
+                        continue
+                    if (value if case_sensitive else value.lower()) == text:
+                        cells.append(Cell(r, c, value))
+            self._emulator.received([[cell.row, cell.col, cell.value] for cell in cells])
+            return cells
+
+    # Writes
+
+    def update_cell(self, row, col, value):
+        self._emulator.request("write", "update_cell", [row, col, value])
+        with self._lock:
+            self._set(row, col, value)
+        return {"updatedCells": 1}
+
+    def update(self, range_name, values, **kwargs):
+        self.batch_update([{"range": range_name, "values": values}], **kwargs)
+
+    def batch_update(self, data, **kwargs):
+        """Apply several A1 ranges in one request, all or nothing."""
+        self._emulator.request("write", "batch_update", data)
+        updated = 0
+        with self._lock:
+            for item in data:
+                row, col = gspread.utils.a1_to_rowcol(item["range"].split(":")[0])
+                for r, values in enumerate(item["values"]):
+                    for c, value in enumerate(values):
+                        self._set(row + r, col + c, value)
+                        updated += 1
+        return {"totalUpdatedCells": updated}
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        self._emulator.request("write", "append_rows", values)
+        with self._lock:
+            for row in values:
+                self._rows.append([_cell_text(v) for v in row])
+        return {"updates": {"updatedRows": len(values)}}
+
+
+def install(emulator, spreadsheet_name="client_database"):
+    """
+    Make the emulator the process-wide Sheets connection, so API(),
+    SimpleClientRepo and the model classes all use it.
+    """
+    from cardHolder import SheetsConnection
+    return SheetsConnection.use_spreadsheet(emulator.open(spreadsheet_name),
+                                            spreadsheet_name=spreadsheet_name)
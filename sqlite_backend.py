@@ -0,0 +1,501 @@
+import sys
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from money import Money
+
+from cardHolder import (
+    API,
+    ATMCard,
+    Account,
+    AccountHolder,
+    ClientRecord,
+    ClientRepository,
+    SheetsConnection,
+    _a1_to_rowcol,
+    _version,
+)
+
+# SQLite storage backend.
+#
+# The four worksheets used by the application become tables with primary
+# key indexes. SqliteClientRepo and SqliteAPI answer lookups with indexed
+# queries, and SqliteSpreadsheet exposes the same tables through the small
+# part of the gspread worksheet surface cardHolder.py uses, so the model
+# classes (which write through API().SHEET) work unchanged.
+#
+# Sheet row N is the table row with rowid N - 1: rows are only ever
+# appended (or all replaced), so rowids stay contiguous and a row is
+# written with a primary-key UPDATE instead of an OFFSET scan. IDs that
+# are integers are therefore UNIQUE columns rather than INTEGER PRIMARY
+# KEY, which would make them the rowid. Balances are stored as INTEGER
+# cents and read back as Money text ("1000.50").
+
+# Worksheet title -> (column definitions in sheet order, secondary indexes)
+TABLES = {
+    "client": (
+        ["cardNum TEXT PRIMARY KEY", "pin TEXT", "firstName TEXT", "lastName TEXT", "balance INTEGER",
+         "version INTEGER DEFAULT 0"],
+        [],
+    ),
+    "accountHolder": (
+        ["id INTEGER UNIQUE", "firstname TEXT", "lastname TEXT", "phone TEXT"],
+        [],
+    ),
+    "account": (
+        ["accountID INTEGER UNIQUE", "holderID INTEGER", "balance INTEGER", "version INTEGER DEFAULT 0"],
+        ["holderID"],
+    ),
+    "atmCards": (
+        ["accountID INTEGER", "cardNum TEXT PRIMARY KEY", "pin TEXT", "failedTries INTEGER"],
+        ["accountID"],
+    ),
+}
+
+
+# Columns holding amounts in cents
+CENTS_COLUMNS = {"balance"}
+
+
+def _columns(title):
+    return [definition.split()[0] for definition in TABLES[title][0]]
+
+
+# Version stamps copied from rows that never had one are stored as ''
+_VERSION = "IFNULL(NULLIF(version, ''), 0)"
+
+
+class _VersionConflict(Exception):
+    """A versioned UPDATE matched no row; rolls the transaction back."""
+
+
+def _cell_text(value):
+    """Render a stored value the way Sheets returns formatted cells."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _money_text(cents):
+    """Render a stored amount ("1000.50"); blanks and text stay as they are."""
+    if isinstance(cents, int) and not isinstance(cents, bool):
+        return str(Money(cents))
+    return _cell_text(cents)
+
+
+def _cents(value):
+    """Amount to store for a sheet value or number; a blank stays blank."""
+    if value is None or str(value).strip() == "":
+        return ""
+    return Money.parse(value).cents
+
+
+def _stored(title, values):
+    """A sheet row as stored in a table: amounts in cents, padded to width."""
+    columns = _columns(title)
+    row = (list(values) + [""] * len(columns))[:len(columns)]
+    return [_cents(v) if c in CENTS_COLUMNS else v for c, v in zip(columns, row)]
+
+
+class _Cell:
+    """The row, col and value of a found cell, as gspread's Cell has them."""
+    def __init__(self, row, col, value):
+        self.row = row
+        self.col = col
+        self.value = value
+
+
+class SqliteDatabase:
+    """
+    One SQLite connection per database file, shared by the repo, the API
+    and the spreadsheet adapter. Uses WAL mode so readers never block the
+    writer, and explicit transactions for multi-row changes.
+    """
+    _lock = threading.Lock()
+    _databases = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.create_schema()
+
+    @classmethod
+    def get(cls, path):
+        with cls._lock:
+            db = cls._databases.get(path)
+            if db is None:
+                db = cls(path)
+                cls._databases[path] = db
+            return db
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            for db in cls._databases.values():
+                db.conn.close()
+            cls._databases.clear()
+
+    def create_schema(self):
+        with self.transaction() as cur:
+            for title, (columns, indexes) in TABLES.items():
+                cur.execute(f'CREATE TABLE IF NOT EXISTS "{title}" ({", ".join(columns)})')
+                # Databases created before a column was added get it appended
+                existing = {row[1] for row in cur.execute(f'PRAGMA table_info("{title}")')}
+                for definition in columns:
+                    if definition.split()[0] not in existing:
+                        cur.execute(f'ALTER TABLE "{title}" ADD COLUMN {definition}')
+                self._upgrade(cur, title)
+                for column in indexes:
+                    cur.execute(f'CREATE INDEX IF NOT EXISTS "idx_{title}_{column}" ON "{title}" ({column})')
+
+    def _upgrade(self, cur, title):
+        # Rebuild a table created with an older layout (REAL balances, an
+        # integer id as the rowid) or whose rowids have gaps, keeping the
+        # row order, so that sheet row N is rowid N - 1 again
+        columns = TABLES[title][0]
+        info = {row[1]: (row[2].upper(), bool(row[5])) for row in cur.execute(f'PRAGMA table_info("{title}")')}
+        expected = {d.split()[0]: (d.split()[1], "PRIMARY KEY" in d) for d in columns}
+        count, last = cur.execute(f'SELECT COUNT(*), IFNULL(MAX(rowid), 0) FROM "{title}"').fetchone()
+        if all(info[name] == layout for name, layout in expected.items()) and count == last:
+            return
+        names = _columns(title)
+        rows = cur.execute(f'SELECT {", ".join(names)} FROM "{title}" ORDER BY rowid').fetchall()
+        in_dollars = {name for name in names if name in CENTS_COLUMNS and info[name][0] != "INTEGER"}
+        rows = [[_cents(v) if name in in_dollars else v for name, v in zip(names, row)] for row in rows]
+        cur.execute(f'ALTER TABLE "{title}" RENAME TO "{title}__old"')
+        cur.execute(f'CREATE TABLE "{title}" ({", ".join(columns)})')
+        cur.executemany(f'INSERT INTO "{title}" VALUES ({", ".join("?" for _ in names)})', rows)
+        cur.execute(f'DROP TABLE "{title}__old"')
+
+    @contextmanager
+    def transaction(self):
+        """Run a block in one write transaction; rolled back if it raises."""
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                yield cur
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            cur.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def replace_rows(self, title, rows):
+        """Replace a table's contents with sheet rows (header excluded)."""
+        placeholders = ", ".join("?" for _ in _columns(title))
+        with self.transaction() as cur:
+            cur.execute(f'DELETE FROM "{title}"')
+            cur.executemany(f'INSERT INTO "{title}" VALUES ({placeholders})', [_stored(title, row) for row in rows])
+
+
+class SqliteWorksheet:
+    """
+    A table seen as a worksheet: row 1 is the header and row N holds the
+    table row with rowid N - 1. Values are returned as strings.
+    """
+    # compare_and_set checks version stamps inside the UPDATE
+    ATOMIC_CAS = True
+
+    def __init__(self, db, title):
+        self.db = db
+        self.title = title
+        self.columns = _columns(title)
+
+    def _rows(self):
+        cols = ", ".join(self.columns)
+        return self.db.query(f'SELECT rowid, {cols} FROM "{self.title}" ORDER BY rowid')
+
+    def _text(self, columns, values):
+        return [_money_text(v) if c in CENTS_COLUMNS else _cell_text(v) for c, v in zip(columns, values)]
+
+    def _value(self, col, value):
+        return _cents(value) if self.columns[col - 1] in CENTS_COLUMNS else value
+
+    @property
+    def row_count(self):
+        """Header plus data rows, like gspread's grid size."""
+        return self.db.query(f'SELECT IFNULL(MAX(rowid), 0) FROM "{self.title}"')[0][0] + 1
+
+    def get_all_values(self):
+        return [list(self.columns)] + [self._text(self.columns, row[1:]) for row in self._rows()]
+
+    def get_values(self, range_name=None, **kwargs):
+        """Values of a bounded A1 range such as "A2:E501" (the whole table if omitted)."""
+        if not range_name:
+            return self.get_all_values()
+        first, _, last = range_name.partition(":")
+        row1, col1 = _a1_to_rowcol(first)
+        row2, col2 = _a1_to_rowcol(last or first)
+        columns = self.columns[col1 - 1:col2]
+        rows = [list(columns)] if row1 == 1 else []
+        cols = ", ".join(columns)
+        if row2 >= max(row1, 2):
+            found = self.db.query(f'SELECT {cols} FROM "{self.title}" WHERE rowid BETWEEN ? AND ? ORDER BY rowid',
+                                  (max(row1, 2) - 1, row2 - 1))
+            rows += [self._text(columns, row) for row in found]
+        return rows
+
+    def batch_get(self, ranges, **kwargs):
+        return [self.get_values(name) for name in ranges]
+
+    def row_values(self, row):
+        if row == 1:
+            return list(self.columns)
+        cols = ", ".join(self.columns)
+        found = self.db.query(f'SELECT {cols} FROM "{self.title}" WHERE rowid = ?', (int(row) - 1,))
+        return self._text(self.columns, found[0]) if found else []
+
+    def col_values(self, col):
+        column = self.columns[col - 1]
+        values = self.db.query(f'SELECT {column} FROM "{self.title}" ORDER BY rowid')
+        return [column] + [self._text([column], v)[0] for v in values]
+
+    def findall(self, query, in_row=None, in_column=None):
+        cells = []
+        text = str(query)
+        for row in self._rows():
+            index = row[0] + 1
+            if in_row is not None and index != in_row:
+                continue
+            for col, value in enumerate(self._text(self.columns, row[1:]), start=1):
+                if in_column is not None and col != in_column:
+                    continue
+                if value == text:
+                    cells.append(_Cell(index, col, value))
+        return cells
+
+    def find(self, query, in_row=None, in_column=None):
+        # The key column is indexed, so try it first
+        if in_row is None and in_column in (None, 1):
+            key = self.columns[0]
+            found = self.db.query(f'SELECT rowid FROM "{self.title}" WHERE {key} = ?', (str(query),))
+            if found:
+                return _Cell(found[0][0] + 1, 1, str(query))
+        cells = self.findall(query, in_row=in_row, in_column=in_column)
+        return cells[0] if cells else None
+
+    def _write(self, cur, row, col, value):
+        cur.execute(f'UPDATE "{self.title}" SET {self.columns[col - 1]} = ? WHERE rowid = ?',
+                    (self._value(col, value), int(row) - 1))
+        if cur.rowcount != 1:
+            raise IndexError(f"{self.title} has no row {row}")
+
+    def update_cell(self, row, col, value):
+        with self.db.transaction() as cur:
+            self._write(cur, row, col, value)
+
+    def batch_update(self, data, **kwargs):
+        """Apply several A1 ranges in one transaction."""
+        with self.db.transaction() as cur:
+            for item in data:
+                start = item["range"].split(":")[0]
+                first_row, first_col = _a1_to_rowcol(start)
+                for r, values in enumerate(item["values"]):
+                    for c, value in enumerate(values):
+                        self._write(cur, first_row + r, first_col + c, value)
+
+    def compare_and_set(self, writes, cells=()):
+        """
+        cardHolder.compare_and_set in one transaction: each UPDATE only
+        matches while the row's version stamp (the column after col) is
+        unchanged, and the other cells are rolled back with them.
+        """
+        try:
+            with self.db.transaction() as cur:
+                for row, col, value in cells:
+                    self._write(cur, row, col, value)
+                for row, col, value, version in writes:
+                    rowid = int(row) - 1
+                    if not cur.execute(f'SELECT 1 FROM "{self.title}" WHERE rowid = ?', (rowid,)).fetchone():
+                        raise IndexError(f"{self.title} has no row {row}")
+                    column, stamp = self.columns[col - 1], self.columns[col]
+                    value = self._value(col, value)
+                    if version is None:
+                        cur.execute(f'UPDATE "{self.title}" SET {column} = ?, '
+                                    f"{stamp} = IFNULL(NULLIF({stamp}, ''), 0) + 1 WHERE rowid = ?",
+                                    (value, rowid))
+                    else:
+                        cur.execute(f'UPDATE "{self.title}" SET {column} = ?, {stamp} = ? '
+                                    f"WHERE rowid = ? AND IFNULL(NULLIF({stamp}, ''), 0) = ?",
+                                    (value, version + 1, rowid, version))
+                    if cur.rowcount != 1:
+                        raise _VersionConflict(row)
+        except _VersionConflict:
+            current = {}
+            for row, col, _, _ in writes:
+                stamped = self.row_values(row)[col - 1:col + 1] + ["", ""]
+                current[row] = (stamped[0], _version(stamped[1]))
+            return current
+        return None
+
+    def append_rows(self, values, **kwargs):
+        placeholders = ", ".join("?" for _ in self.columns)
+        with self.db.transaction() as cur:
+            cur.executemany(f'INSERT INTO "{self.title}" VALUES ({placeholders})',
+                            [_stored(self.title, row) for row in values])
+
+
+class SqliteSpreadsheet:
+    """Spreadsheet-shaped view of a SqliteDatabase for SheetsConnection.use_spreadsheet()."""
+    def __init__(self, db):
+        self.db = db
+        self.title = db.path
+
+    def worksheet(self, title):
+        if title not in TABLES:
+            # Only this error needs gspread, so it is imported here
+            from gspread.exceptions import WorksheetNotFound
+            raise WorksheetNotFound(title)
+        return SqliteWorksheet(self.db, title)
+
+    def worksheets(self):
+        return [SqliteWorksheet(self.db, title) for title in TABLES]
+
+
+class SqliteClientRepo(ClientRepository):
+    """
+    SQLite implementation of the client repository. Every lookup is a
+    primary-key query and transfers run in a single transaction.
+    """
+    def __init__(self, path="atm.db"):
+        self.db = SqliteDatabase.get(path)
+
+    def get_record(self, card_num):
+        found = self.db.query(
+            "SELECT cardNum, pin, firstName, lastName, balance, version FROM client WHERE cardNum = ?",
+            (str(card_num).strip(),))
+        if not found:
+            return None
+        card_num, pin, first_name, last_name, balance, version = found[0]
+        return ClientRecord(card_num, pin, first_name, last_name, _money_text(balance), version)
+
+    def verify(self, card_num, pin):
+        found = self.db.query("SELECT pin FROM client WHERE cardNum = ?", (str(card_num).strip(),))
+        return bool(found) and str(found[0][0]).strip() == str(pin)
+
+    def _update(self, column, card_num, value, label, stamped=False):
+        # stamped: the write also increments the row's version stamp
+        stamp = f", version = {_VERSION} + 1" if stamped else ""
+        try:
+            with self.db.transaction() as cur:
+                cur.execute(f"UPDATE client SET {column} = ?{stamp} WHERE cardNum = ?",
+                            (value, str(card_num).strip()))
+                return cur.rowcount == 1
+        except Exception as e:
+            print(f"[ERROR] Failed to update {label}: {e}")
+            return False
+
+    def update_balance(self, card_num, new_balance, expected=None):
+        if expected is None:
+            return self._update("balance", card_num, Money.parse(new_balance).cents, "balance", stamped=True)
+        try:
+            return self._versioned_write([(expected, Money.parse(new_balance) - expected.balance)], self._cas)
+        except Exception as e:
+            print(f"[ERROR] Failed to update balance: {e}")
+            return False
+
+    def update_pin(self, card_num, new_pin):
+        return self._update("pin", card_num, str(new_pin), "PIN")
+
+    def _cas(self, targets):
+        # The version check is part of each UPDATE, so it is atomic here
+        try:
+            with self.db.transaction() as cur:
+                for rec, balance in targets:
+                    cur.execute(f"UPDATE client SET balance = ?, version = ? WHERE cardNum = ? AND {_VERSION} = ?",
+                                (Money.parse(balance).cents, rec.version + 1, str(rec.cardNum).strip(), rec.version))
+                    if cur.rowcount != 1:
+                        raise _VersionConflict(rec.cardNum)
+        except _VersionConflict:
+            current = {}
+            for rec, _ in targets:
+                found = self.db.query(f"SELECT balance, {_VERSION} FROM client WHERE cardNum = ?",
+                                      (str(rec.cardNum).strip(),))
+                if not found:
+                    raise LookupError(f"card {rec.cardNum} not found")
+                current[rec.cardNum] = (_money_text(found[0][0]), _version(found[0][1]))
+            return current
+        return None
+
+    def transfer(self, source, dest, amount):
+        try:
+            amount = Money.parse(amount)
+            return self._versioned_write([(source, -amount), (dest, amount)], self._cas)
+        except Exception as e:
+            print(f"[ERROR] Failed to transfer: {e}")
+            return False
+
+
+class SqliteAPI(API):
+    """
+    API backed by SQLite. The get* lookups use indexed queries; the
+    SqliteSpreadsheet is registered as the shared connection so model
+    mutations (which build their own API()) also write to SQLite.
+    """
+    def __init__(self, path="atm.db"):
+        self.SCOPE = SheetsConnection.SCOPE
+        self.db = SqliteDatabase.get(path)
+        conn = SheetsConnection.use_spreadsheet(SqliteSpreadsheet(self.db))
+        self.CREDS = self.SCOPED_CREDS = self.GSPREAD_CLIENT = None
+        self.SHEET = conn.SHEET
+
+    def getAccountHolders(self, id):
+        sql = "SELECT id, firstname, lastname, phone FROM accountHolder"
+        rows = self.db.query(sql + " ORDER BY rowid") if int(id) == 0 else \
+            self.db.query(sql + " WHERE id = ?", (int(id),))
+        return [AccountHolder(*[_cell_text(v) for v in row]) for row in rows]
+
+    def getAccountByID(self, id):
+        sql = f"SELECT accountID, holderID, balance, {_VERSION} FROM account"
+        rows = self.db.query(sql + " ORDER BY rowid") if int(id) == 0 else \
+            self.db.query(sql + " WHERE accountID = ?", (int(id),))
+        return [self._located(Account(_cell_text(row[0]), _cell_text(row[1]), _money_text(row[2])), version=row[3])
+                for row in rows]
+
+    def getAccountByHolderID(self, id):
+        sql = f"SELECT accountID, holderID, balance, {_VERSION} FROM account"
+        rows = self.db.query(sql + " ORDER BY rowid") if int(id) == 0 else \
+            self.db.query(sql + " WHERE holderID = ? ORDER BY rowid", (int(id),))
+        return [self._located(Account(_cell_text(row[0]), _cell_text(row[1]), _money_text(row[2])), version=row[3])
+                for row in rows]
+
+    def getATMCards(self, id):
+        sql = ("SELECT c.accountID, a.holderID, a.balance, c.cardNum, c.pin, c.failedTries, "
+               "IFNULL(NULLIF(a.version, ''), 0) FROM atmCards c JOIN account a ON a.accountID = c.accountID")
+        rows = self.db.query(sql + " ORDER BY c.rowid") if int(id) == 0 else \
+            self.db.query(sql + " WHERE c.cardNum = ?", (str(id).strip(),))
+        return [self._located(ATMCard(*[_money_text(v) if i == 2 else _cell_text(v) for i, v in enumerate(row[:6])]),
+                              version=row[6]) for row in rows]
+
+
+def copy_from_spreadsheet(spreadsheet, path="atm.db"):
+    """
+    Copy the four worksheets of a spreadsheet into a SQLite database.
+
+    Returns:
+        Dict of worksheet title -> number of rows copied
+    """
+    db = SqliteDatabase.get(path)
+    copied = {}
+    for title in TABLES:
+        rows = spreadsheet.worksheet(title).get_all_values()[1:]
+        db.replace_rows(title, rows)
+        copied[title] = len(rows)
+    return copied
+
+
+if __name__ == "__main__":
+    # python sqlite_backend.py [atm.db] - snapshot Google Sheets into SQLite
+    target = sys.argv[1] if len(sys.argv) > 1 else "atm.db"
+    for title, count in copy_from_spreadsheet(SheetsConnection.get().SHEET, target).items():
+        print(f"{title}: {count} rows")
@@ -6,9 +6,16 @@ Tests for run.py and cardHolder.py modules
 import unittest
 import sys
 import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 from unittest.mock import Mock, patch, MagicMock, call, PropertyMock
 from io import StringIO
 
+import gspread
+
 # Add project root to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
@@ -23,9 +30,53 @@ from cardHolder import (
     ATMCard,
     API,
     AccountHolder,
+    SheetsConnection,
+    CellBatch,
+    Journal,
+    WriteBehind,
     transfer_money,
-    show_welcome_message
+    show_welcome_message,
+    iter_rows,
+    UnitOfWork,
+    compare_and_set,
+    ClientRepository
 )
+from sheets_emulator import SheetsEmulator, install as install_emulator
+from instrumentation import BackendMetrics, METRICS, operation
+from scheduler import RequestScheduler, TokenBucket
+from atm_server import ATMSession, ATMServer, _captured
+from bench_atm import build_dataset, percentile, run_benchmark
+from sqlite_backend import SqliteDatabase, SqliteAPI, SqliteClientRepo, SqliteWorksheet, copy_from_spreadsheet
+from money import Money
+from journal import JournalBusy
+import journal
+from locks import LOCKS, LockManager, LockTimeout
+import analytics
+import reconcile
+import csv_tool
+
+
+def _serve_pages(ws):
+    """
+    Let a mock worksheet answer the A1 range reads made by cardHolder.iter_rows
+    and find_rows ("A2:E501", batch_get of "B7:B7") from the rows of its
+    get_all_values mock.
+    """
+    def bounds(label):
+        letters = "".join(ch for ch in label if ch.isalpha())
+        col = 0
+        for ch in letters:
+            col = col * 26 + ord(ch) - ord("A") + 1
+        return int("".join(ch for ch in label if ch.isdigit())), col
+
+    def get_values(range_name, **kwargs):
+        source = ws.get_all_values.side_effect
+        rows = source() if callable(source) else ws.get_all_values.return_value
+        (r1, c1), (r2, c2) = (bounds(part) for part in range_name.split(":"))
+        return [list(row[c1 - 1:c2]) for row in rows[r1 - 1:r2]]
+    ws.get_values.side_effect = get_values
+    ws.batch_get.side_effect = lambda ranges, **kwargs: [get_values(r) for r in ranges]
+    return ws
 
 
 # TestRunModule here:
@@ -359,6 +410,24 @@ class TestRunModule(unittest.TestCase):
              output = mock_stdout.getvalue()
              self.assertIn("PIN changed successfully", output)
      
+     @patch('run.authenticate')
+     @patch('run.print_banner')
+     @patch('run.transfer_money')
+     @patch('builtins.input', side_effect=['5', '6'])
+     @patch('run.api', Mock())
+     def test_main_api_card_transfers_from_client_record(self, mock_input, mock_transfer, mock_banner, mock_auth):
+         """Test main function transfer for an API card"""
+         mock_card = Mock()
+         mock_card.getCardNumber.return_value = '4532772818527395'
+         mock_card.check_balance.return_value = 1000.00
+         mock_auth.return_value = ('api', mock_card)
+         mock_repo = Mock()
+         
+         with patch('run.repo', mock_repo), patch('sys.stdout', new_callable=StringIO):
+             main()
+         mock_repo.get_record.assert_called_once_with('4532772818527395')
+         mock_transfer.assert_called_once_with(mock_repo.get_record.return_value, mock_repo)
+     
      @patch('run.print_banner')
      @patch('run.api', None)
      @patch('run.repo', None)
@@ -372,6 +441,56 @@ class TestRunModule(unittest.TestCase):
 
 # TestCardHolderModule here:
 
+class TestCardPrefetch(unittest.TestCase):
+    """Test cases for the background card lookup in authenticate"""
+
+    @patch('run.repo', None)
+    def test_pin_prompt_overlaps_lookup(self):
+        """Test that the PIN is requested while the card lookup is still running"""
+        import threading
+        pin_entered = threading.Event()
+        seen = {}
+        mock_card = Mock()
+        mock_card.verify_pin.return_value = True
+        mock_api = Mock()
+
+        def slow_lookup(card_num):
+            seen["lookup_started"] = True
+            # Only finishes once the PIN has been typed
+            seen["waited_for_pin"] = pin_entered.wait(5)
+            return [mock_card]
+        mock_api.getATMCards.side_effect = slow_lookup
+
+        def type_pin(prompt):
+            pin_entered.set()
+            return '1234'
+        with patch('builtins.input', return_value='4532772818527395'), patch('run.get_pin', side_effect=type_pin):
+            result = authenticate(mock_api)
+        self.assertEqual(result, ('api', mock_card))
+        self.assertTrue(seen["waited_for_pin"])
+        mock_card.verify_pin.assert_called_once_with('1234')
+
+    @patch('run.get_pin', side_effect=KeyboardInterrupt)
+    @patch('builtins.input', return_value='4532772818527395')
+    @patch('run.repo')
+    def test_cancel_during_pin_entry(self, mock_repo, mock_input, mock_get_pin):
+        """Test that cancelling at the PIN prompt ends authentication cleanly"""
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            self.assertIsNone(authenticate(None))
+        self.assertIn("Operation cancelled", mock_stdout.getvalue())
+
+    @patch('run.get_pin', return_value='1234')
+    @patch('builtins.input', side_effect=['1111', '4532772818527395'])
+    @patch('run.repo')
+    def test_unknown_repo_card_asks_again(self, mock_repo, mock_input, mock_get_pin):
+        """Test that an unknown card is reported after the PIN and the card is asked for again"""
+        record = Mock(pin='1234')
+        mock_repo.get_record.side_effect = lambda card: record if card == '4532772818527395' else None
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            self.assertEqual(authenticate(None), ('repo', record))
+        self.assertIn("Card not found. Please try again.", mock_stdout.getvalue())
+
+
 class TestCardHolderModule(unittest.TestCase):
     """Test cases for cardHolder.py module"""
     
@@ -639,6 +758,7 @@ class TestCardHolderFunctions(unittest.TestCase):
         
         output = mock_stdout.getvalue()
         self.assertIn("SUCCESS", output)
+        mock_repo.transfer.assert_called_once_with(source, dest, 100.0)
         self.assertEqual(source.balance, 900.00)
         self.assertEqual(dest.balance, 600.00)
     
@@ -748,13 +868,31 @@ class TestCardHolderFunctions(unittest.TestCase):
         dest.balance = 500.00
         
         mock_repo.get_record.return_value = dest
-        mock_repo.update_balance.return_value = False
+        mock_repo.transfer.return_value = False
         
         transfer_money(source, mock_repo)
         
         output = mock_stdout.getvalue()
         self.assertIn("failed", output)
     
+    @patch('builtins.input', side_effect=['100', '4532761841325802', 'y'])
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_transfer_money_repo_without_transfer(self, mock_stdout, mock_input):
+        """Test transfer falls back to two balance updates for minimal repos"""
+        mock_repo = Mock(spec=['get_record', 'update_balance'])
+        source = ClientRecord('4532772818527395', '1234', 'Jane', 'Roe', '1000')
+        dest = ClientRecord('4532761841325802', '0000', 'John', 'Doe', '500')
+        mock_repo.get_record.return_value = dest
+        mock_repo.update_balance.return_value = True
+
+        transfer_money(source, mock_repo)
+
+        self.assertIn("SUCCESS", mock_stdout.getvalue())
+        mock_repo.update_balance.assert_has_calls([
+            call('4532772818527395', 900.0),
+            call('4532761841325802', 600.0)
+        ])
+
     @patch('sys.stdout', new_callable=StringIO)
     def test_show_welcome_message(self, mock_stdout):
         """Test show_welcome_message function"""
@@ -778,7 +916,90 @@ class TestCardHolderFunctions(unittest.TestCase):
 
 class TestAPIClass(unittest.TestCase):
     """Test cases for API class"""
-    
+
+    def setUp(self):
+        """Start every test without a cached Sheets connection."""
+        SheetsConnection.reset()
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_api_instances_share_connection(self, mock_creds, mock_authorize):
+        """Test that API and SimpleClientRepo authorize only once per process"""
+        first = API()
+        second = API()
+        repo = SimpleClientRepo()
+
+        mock_creds.assert_called_once()
+        mock_authorize.assert_called_once()
+        mock_authorize.return_value.open.assert_called_once_with("client_database")
+        self.assertIs(first.SHEET, second.SHEET)
+        self.assertIs(first.SHEET, repo.SHEET)
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_worksheet_handles_are_cached(self, mock_creds, mock_authorize):
+        """Test that a tab is resolved once across API instances"""
+        mock_sheet = Mock()
+        mock_sheet.worksheet.return_value.get_all_values.return_value = [
+            ['accountID', 'holderID', 'balance'],
+            ['100', '1', '1000.50']
+        ]
+        _serve_pages(mock_sheet.worksheet.return_value)
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        API().getAccountByID(100)
+        API().getAccountByID(0)
+        API().getAccountByHolderID(1)
+
+        mock_sheet.worksheet.assert_called_once_with("account")
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_worksheet_cache_invalidated_on_stale_tab(self, mock_creds, mock_authorize):
+        """Test that a handle is dropped when its tab was renamed or deleted"""
+        import gspread
+        response = Mock(status_code=400)
+        response.json.return_value = {"error": {"code": 400, "message": "Unable to parse range"}}
+        mock_sheet = Mock()
+        mock_sheet.worksheet.return_value.get_values.side_effect = gspread.exceptions.APIError(response)
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        api = API()
+        for _ in range(2):
+            with self.assertRaises(gspread.exceptions.APIError):
+                api.getAccountByID(100)
+
+        self.assertEqual(mock_sheet.worksheet.call_count, 2)
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_worksheet_cache_invalidated_on_rename_and_delete(self, mock_creds, mock_authorize):
+        """Test that renaming or deleting a tab through the cache forgets it"""
+        mock_sheet = Mock()
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        api = API()
+        api.SHEET.worksheet("account").update_title("accounts")
+        ws = api.SHEET.worksheet("account")
+        ws.title = "account"
+        api.SHEET.del_worksheet(ws)
+        api.SHEET.worksheet("account")
+
+        self.assertEqual(mock_sheet.worksheet.call_count, 3)
+        mock_sheet.del_worksheet.assert_called_once_with(mock_sheet.worksheet.return_value)
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_api_failed_connection_is_retried(self, mock_stdout, mock_creds, mock_authorize):
+        """Test that a failed authorization is not cached"""
+        mock_authorize.side_effect = [Exception("Connection failed"), Mock()]
+        API()
+        api = API()
+
+        self.assertEqual(mock_authorize.call_count, 2)
+        self.assertIsNotNone(api.SHEET)
+
     @patch('cardHolder.gspread.authorize')
     @patch('cardHolder.Credentials.from_service_account_file')
     def test_api_initialization_success(self, mock_creds, mock_authorize):
@@ -829,6 +1050,7 @@ class TestAPIClass(unittest.TestCase):
             ['1', 'John', 'Doe', '123456'],
             ['2', 'Jane', 'Smith', '789012']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         api = API()
@@ -847,6 +1069,7 @@ class TestAPIClass(unittest.TestCase):
             ['100', '1', '1000.50'],
             ['101', '2', '2000.75']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         api = API()
@@ -865,6 +1088,7 @@ class TestAPIClass(unittest.TestCase):
             ['100', '1', '1000.50'],
             ['101', '1', '2000.75']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         api = API()
@@ -885,14 +1109,14 @@ class TestAPIClass(unittest.TestCase):
                     ['accountID', 'holderID', 'balance'],
                     ['100', '1', '1000.50']
                 ]
-                return ws
+                return _serve_pages(ws)
             elif name == "atmCards":
                 ws = Mock()
                 ws.get_all_values.return_value = [
                     ['accountID', 'cardNum', 'pin', 'failedTries'],
                     ['100', '4532772818527395', '1234', '0']
                 ]
-                return ws
+                return _serve_pages(ws)
         
         mock_sheet.worksheet.side_effect = mock_worksheet
         mock_authorize.return_value.open.return_value = mock_sheet
@@ -904,6 +1128,73 @@ class TestAPIClass(unittest.TestCase):
         self.assertEqual(result[0].getCardNumber(), '4532772818527395')
 
 
+    def _join_sheet(self):
+        """Build a mock spreadsheet with holder, account and card tabs."""
+        tabs = {
+            "accountHolder": [
+                ['id', 'firstname', 'lastname', 'phone'],
+                ['1', 'John', 'Doe', '123456'],
+                ['2', 'Jane', 'Smith', '789012'],
+                ['3', 'No', 'Account', '000000']
+            ],
+            "account": [
+                ['accountID', 'holderID', 'balance'],
+                ['100', '1', '1000,50'],
+                ['101', '2', '2000.75'],
+                ['102', '1', '5']
+            ],
+            "atmCards": [
+                ['accountID', 'cardNum', 'pin', 'failedTries'],
+                ['101', '4532761841325802', '0000', '0'],
+                ['100', '4532772818527395', '1234', '1'],
+                ['999', '5128381368581872', '1111', '0']
+            ]
+        }
+        sheets = {name: _serve_pages(Mock(**{"get_all_values.return_value": rows})) for name, rows in tabs.items()}
+        mock_sheet = Mock()
+        mock_sheet.worksheet.side_effect = lambda name: sheets[name]
+        return mock_sheet, sheets
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_get_atm_cards_all_joined_on_account(self, mock_creds, mock_authorize):
+        """Test that all cards are paired with their account from one read of each sheet"""
+        mock_sheet, sheets = self._join_sheet()
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        result = API().getATMCards(0)
+
+        self.assertEqual([c.getCardNumber() for c in result], ['4532761841325802', '4532772818527395'])
+        self.assertEqual(result[0].getAccountHolderID(), '2')
+        self.assertAlmostEqual(result[1].check_balance(), 1000.50, places=2)
+        sheets["account"].get_all_values.assert_called_once()
+        sheets["atmCards"].get_all_values.assert_called_once()
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_get_atm_cards_unknown_card_skips_account_read(self, mock_creds, mock_authorize):
+        """Test that an unknown card number does not download the account sheet"""
+        mock_sheet, sheets = self._join_sheet()
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        self.assertEqual(API().getATMCards('1111222233334444'), [])
+        sheets["account"].get_all_values.assert_not_called()
+        sheets["account"].get_values.assert_not_called()
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_get_account_holders_with_accounts(self, mock_creds, mock_authorize):
+        """Test the holder to account join"""
+        mock_sheet, sheets = self._join_sheet()
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        pairs = API().getAccountHoldersWithAccounts(1)
+
+        self.assertEqual([(h.getFirstname(), a.getAccountID()) for h, a in pairs],
+                         [('John', '100'), ('John', '102')])
+        self.assertEqual(len(API().getAccountHoldersWithAccounts(0)), 3)
+
+
 # Test AccountHolder class
 
 class TestAccountHolderClass(unittest.TestCase):
@@ -935,6 +1226,11 @@ class TestAccountHolderClass(unittest.TestCase):
         self.assertEqual(holder.firstname, 'Jane')
         self.assertEqual(holder.lastname, 'Smith')
         self.assertEqual(holder.phone, '789012')
+        mock_api.SHEET.worksheet.return_value.batch_update.assert_called_once_with(
+            [{"range": "B2:D2", "values": [["Jane", "Smith", "789012"]]}],
+            value_input_option="USER_ENTERED"
+        )
+        mock_api.SHEET.worksheet.return_value.update_cell.assert_not_called()
     
     @patch('cardHolder.API')
     def test_update_account_failure(self, mock_api_class):
@@ -953,7 +1249,11 @@ class TestAccountHolderClass(unittest.TestCase):
 
 class TestSimpleClientRepo(unittest.TestCase):
     """Test cases for SimpleClientRepo class"""
-    
+
+    def setUp(self):
+        """Start every test without a cached Sheets connection."""
+        SheetsConnection.reset()
+
     @patch('cardHolder.gspread.authorize')
     @patch('cardHolder.Credentials.from_service_account_file')
     def test_get_record_found(self, mock_creds, mock_authorize):
@@ -963,6 +1263,7 @@ class TestSimpleClientRepo(unittest.TestCase):
             ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
             ['4532772818527395', '1234', 'John', 'Doe', '1000.50']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         repo = SimpleClientRepo()
@@ -980,6 +1281,7 @@ class TestSimpleClientRepo(unittest.TestCase):
         mock_sheet.worksheet.return_value.get_all_values.return_value = [
             ['cardNum', 'pin', 'firstName', 'lastName', 'balance']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         repo = SimpleClientRepo()
@@ -993,6 +1295,7 @@ class TestSimpleClientRepo(unittest.TestCase):
         """Test getting record from empty sheet"""
         mock_sheet = Mock()
         mock_sheet.worksheet.return_value.get_all_values.return_value = []
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         repo = SimpleClientRepo()
@@ -1009,6 +1312,7 @@ class TestSimpleClientRepo(unittest.TestCase):
             ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
             ['4532772818527395', '1234', 'John', 'Doe', '1000.50']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         repo = SimpleClientRepo()
@@ -1025,6 +1329,7 @@ class TestSimpleClientRepo(unittest.TestCase):
             ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
             ['4532772818527395', '1234', 'John', 'Doe', '1000.50']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         repo = SimpleClientRepo()
@@ -1040,6 +1345,7 @@ class TestSimpleClientRepo(unittest.TestCase):
         mock_sheet.worksheet.return_value.get_all_values.return_value = [
             ['cardNum', 'pin', 'firstName', 'lastName', 'balance']
         ]
+        _serve_pages(mock_sheet.worksheet.return_value)
         mock_authorize.return_value.open.return_value = mock_sheet
         
         repo = SimpleClientRepo()
@@ -1052,9 +1358,8 @@ class TestSimpleClientRepo(unittest.TestCase):
     def test_update_balance_success(self, mock_creds, mock_authorize):
         """Test successful balance update"""
         mock_ws = Mock()
-        mock_cell = Mock()
-        mock_cell.row = 2
-        mock_ws.find.return_value = mock_cell
+        mock_ws.col_values.return_value = ['cardNum', '4532772818527395']
+        mock_ws.batch_get.return_value = [[['1000.50', '3']]]
         
         mock_sheet = Mock()
         mock_sheet.worksheet.return_value = mock_ws
@@ -1064,14 +1369,17 @@ class TestSimpleClientRepo(unittest.TestCase):
         result = repo.update_balance('4532772818527395', 2000.00)
         
         self.assertTrue(result)
-        mock_ws.update_cell.assert_called_once_with(2, 5, 2000.00)
+        # Written as given, with the stored version stamp bumped
+        mock_ws.batch_get.assert_called_once()
+        mock_ws.batch_update.assert_called_once_with(
+            [{"range": "E2:F2", "values": [[2000.0, 4]]}], value_input_option="USER_ENTERED")
     
     @patch('cardHolder.gspread.authorize')
     @patch('cardHolder.Credentials.from_service_account_file')
     def test_update_balance_card_not_found(self, mock_creds, mock_authorize):
         """Test balance update for non-existent card"""
         mock_ws = Mock()
-        mock_ws.find.return_value = None
+        mock_ws.col_values.return_value = ['cardNum']
         
         mock_sheet = Mock()
         mock_sheet.worksheet.return_value = mock_ws
@@ -1088,7 +1396,7 @@ class TestSimpleClientRepo(unittest.TestCase):
     def test_update_balance_exception(self, mock_stdout, mock_creds, mock_authorize):
         """Test balance update with exception"""
         mock_ws = Mock()
-        mock_ws.find.side_effect = Exception("Database error")
+        mock_ws.col_values.side_effect = Exception("Database error")
         
         mock_sheet = Mock()
         mock_sheet.worksheet.return_value = mock_ws
@@ -1133,10 +1441,1001 @@ class TestSimpleClientRepo(unittest.TestCase):
         
         repo = SimpleClientRepo()
         result = repo.update_pin('4532772818527395', '5678')
-        
+
         self.assertFalse(result)
         self.assertIn("ERROR", mock_stdout.getvalue())
 
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_snapshot_serves_lookups_from_memory(self, mock_creds, mock_authorize):
+        """Test snapshot mode downloads the sheet once for repeated lookups"""
+        mock_ws = Mock()
+        mock_ws.get_all_values.return_value = [
+            ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+            ['4532772818527395', '1234', 'John', 'Doe', '1000.50'],
+            ['4532761841325802', '0000', 'Alice', 'Tester', '50']
+        ]
+        mock_sheet = Mock()
+        mock_sheet.worksheet.return_value = mock_ws
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        repo = SimpleClientRepo(snapshot_ttl=60)
+        self.assertTrue(repo.verify('4532772818527395', '1234'))
+        self.assertEqual(repo.get_record('4532761841325802').firstName, 'Alice')
+        self.assertIsNone(repo.get_record('unknown'))
+
+        mock_ws.get_all_values.assert_called_once()
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_snapshot_write_uses_indexed_row(self, mock_creds, mock_authorize):
+        """Test snapshot mode writes to the indexed row and updates the snapshot"""
+        mock_ws = Mock()
+        mock_ws.get_all_values.return_value = [
+            ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+            ['4532772818527395', '1234', 'John', 'Doe', '1000.50'],
+            ['4532761841325802', '0000', 'Alice', 'Tester', '50']
+        ]
+        mock_sheet = Mock()
+        mock_sheet.worksheet.return_value = mock_ws
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        mock_ws.batch_get.return_value = [[['50']]]
+        repo = SimpleClientRepo(snapshot_ttl=60)
+        self.assertTrue(repo.update_balance('4532761841325802', 75.25))
+        self.assertTrue(repo.update_pin('4532761841325802', '4321'))
+
+        mock_ws.find.assert_not_called()
+        mock_ws.col_values.assert_not_called()
+        mock_ws.batch_update.assert_called_once_with(
+            [{"range": "E3:F3", "values": [[75.25, 1]]}], value_input_option="USER_ENTERED")
+        mock_ws.update_cell.assert_any_call(3, 2, '4321')
+        record = repo.get_record('4532761841325802')
+        self.assertEqual((record.balance, record.version), (75.25, 1))
+        self.assertEqual(record.pin, '4321')
+        mock_ws.get_all_values.assert_called_once()
+
+    @patch('cardHolder.gspread.authorize')
+    @patch('cardHolder.Credentials.from_service_account_file')
+    def test_snapshot_reloads_after_ttl(self, mock_creds, mock_authorize):
+        """Test snapshot is reloaded once the TTL has expired"""
+        mock_ws = Mock()
+        mock_ws.get_all_values.return_value = [
+            ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+            ['4532772818527395', '1234', 'John', 'Doe', '1000.50']
+        ]
+        mock_sheet = Mock()
+        mock_sheet.worksheet.return_value = mock_ws
+        mock_authorize.return_value.open.return_value = mock_sheet
+
+        repo = SimpleClientRepo(snapshot_ttl=30)
+        with patch('cardHolder.time.monotonic', side_effect=[100.0, 110.0, 140.0, 140.0]):
+            repo.get_record('4532772818527395')
+            repo.get_record('4532772818527395')
+            repo.get_record('4532772818527395')
+
+        self.assertEqual(mock_ws.get_all_values.call_count, 2)
+
+
+# Test SimpleClientRepo.transfer and its journal
+
+class TestSimpleClientRepoTransfer(unittest.TestCase):
+    """Test cases for single-request transfers and journal recovery"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tmpdir, "transfers.journal")
+        self.rows = [
+            ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+            ['4532772818527395', '1234', 'John', 'Doe', '1000'],
+            ['4532761841325802', '0000', 'Alice', 'Tester', '50']
+        ]
+        self.mock_ws = Mock()
+        self.mock_ws.get_all_values.side_effect = lambda: [list(r) for r in self.rows]
+        _serve_pages(self.mock_ws)
+        self.mock_ws.col_values.side_effect = lambda col: [r[col - 1] for r in self.rows]
+        mock_sheet = Mock()
+        mock_sheet.worksheet.return_value = self.mock_ws
+        patcher_auth = patch('cardHolder.gspread.authorize')
+        patcher_creds = patch('cardHolder.Credentials.from_service_account_file')
+        patcher_auth.start().return_value.open.return_value = mock_sheet
+        patcher_creds.start()
+        self.addCleanup(patcher_auth.stop)
+        self.addCleanup(patcher_creds.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_transfer_writes_both_balances_in_one_request(self):
+        """Test that a transfer is one batch_update and is journaled as committed"""
+        repo = SimpleClientRepo(journal_path=self.journal_path)
+        source = repo.get_record('4532772818527395')
+        dest = repo.get_record('4532761841325802')
+
+        self.assertTrue(repo.transfer(source, dest, 100))
+
+        # Each balance is written with its row's next version stamp
+        self.mock_ws.batch_update.assert_called_once_with([
+            {"range": "E2:F2", "values": [[900.0, 1]]},
+            {"range": "E3:F3", "values": [[150.0, 1]]}
+        ], value_input_option="USER_ENTERED")
+        self.mock_ws.find.assert_not_called()
+        self.assertEqual(repo.journal.pending(), [])
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_failed_transfer_stays_pending(self, mock_stdout):
+        """Test that a transfer whose write fails is left for recovery"""
+        self.mock_ws.batch_update.side_effect = Exception("Quota exceeded")
+        repo = SimpleClientRepo(journal_path=self.journal_path)
+        source = repo.get_record('4532772818527395')
+        dest = repo.get_record('4532761841325802')
+
+        self.assertFalse(repo.transfer(source, dest, 100))
+        self.assertEqual(len(repo.journal.pending()), 1)
+        self.assertIn("ERROR", mock_stdout.getvalue())
+
+    def _crashed_transfer(self, src_balance, dst_balance):
+        Journal(self.journal_path).begin("transfer", writes=[
+            {"card": "4532772818527395", "old": 1000.0, "new": 900.0},
+            {"card": "4532761841325802", "old": 50.0, "new": 150.0}
+        ])
+        self.rows[1][4] = src_balance
+        self.rows[2][4] = dst_balance
+
+    @patch('cardHolder.SimpleClientRepo.RECOVERY_MIN_AGE', 0)
+    def test_recover_completes_half_applied_transfer(self):
+        """Test that restart writes the missing side of a half-applied transfer"""
+        self._crashed_transfer('900', '50')
+
+        repo = SimpleClientRepo(journal_path=self.journal_path)
+
+        # The missing side is written with its version stamp bumped
+        self.mock_ws.batch_update.assert_called_once_with(
+            [{"range": "E3:F3", "values": [[150.0, 1]]}], value_input_option="USER_ENTERED")
+        self.assertEqual(repo.journal.pending(), [])
+
+    @patch('cardHolder.SimpleClientRepo.RECOVERY_MIN_AGE', 0)
+    def test_recover_aborts_unapplied_transfer(self):
+        """Test that restart drops a transfer that never reached the sheet"""
+        self._crashed_transfer('1000', '50')
+
+        repo = SimpleClientRepo(journal_path=self.journal_path)
+
+        self.mock_ws.update_cell.assert_not_called()
+        self.mock_ws.batch_update.assert_not_called()
+        self.assertEqual(repo.journal.pending(), [])
+
+    @patch('cardHolder.SimpleClientRepo.RECOVERY_MIN_AGE', 0)
+    def test_recover_leaves_conflicting_transfer_pending(self):
+        """Test that balances changed since the crash are not overwritten"""
+        self._crashed_transfer('700', '50')
+
+        repo = SimpleClientRepo(journal_path=self.journal_path)
+
+        self.mock_ws.update_cell.assert_not_called()
+        self.assertEqual(len(repo.journal.pending()), 1)
+
+    def test_recover_ignores_recent_entries(self):
+        """Test that in-flight transfers of other sessions are not touched"""
+        self._crashed_transfer('900', '50')
+
+        repo = SimpleClientRepo(journal_path=self.journal_path)
+
+        self.mock_ws.update_cell.assert_not_called()
+        self.assertEqual(len(repo.journal.pending()), 1)
+
+
+# Test write-behind mode
+
+class TestWriteBehind(unittest.TestCase):
+    """Test cases for journaled write-behind mode"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tmpdir, "writes.journal")
+        self.rows = {
+            "client": [
+                ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                ['4532772818527395', '1234', 'John', 'Doe', '1000'],
+                ['4532761841325802', '0000', 'Alice', 'Tester', '50']
+            ],
+            "account": [
+                ['accountID', 'holderID', 'balance'],
+                ['100', '1', '1000.50']
+            ]
+        }
+        self.sheets = {}
+        for name, rows in self.rows.items():
+            ws = Mock()
+            ws.get_all_values.side_effect = lambda rows=rows: [list(r) for r in rows]
+            ws.col_values.side_effect = lambda col, rows=rows: [r[col - 1] for r in rows]
+            self.sheets[name] = ws
+        _serve_pages(self.sheets["client"])
+        self.mock_sheet = Mock()
+        self.mock_sheet.worksheet.side_effect = lambda name: self.sheets[name]
+        patcher_auth = patch('cardHolder.gspread.authorize')
+        patcher_creds = patch('cardHolder.Credentials.from_service_account_file')
+        patcher_auth.start().return_value.open.return_value = self.mock_sheet
+        patcher_creds.start()
+        self.addCleanup(patcher_auth.stop)
+        self.addCleanup(patcher_creds.stop)
+
+    def tearDown(self):
+        WriteBehind.disable(timeout=5)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_repo_requires_enabled_mode(self):
+        """Test that write_behind needs WriteBehind.enable() first"""
+        with self.assertRaises(ValueError):
+            SimpleClientRepo(write_behind=True)
+
+    def test_writes_are_journaled_then_flushed_in_one_batch(self):
+        """Test that writes return before reaching the sheet and flush as one batch"""
+        wb = WriteBehind.enable(self.journal_path, interval=60)
+        repo = SimpleClientRepo(write_behind=True)
+        dest = repo.get_record('4532761841325802')
+
+        self.assertTrue(repo.update_balance('4532772818527395', 950.0))
+        self.assertTrue(repo.transfer(repo.get_record('4532772818527395'), dest, 100))
+        self.assertFalse(repo.update_balance('unknown', 1.0))
+
+        client_ws = self.sheets["client"]
+        client_ws.batch_update.assert_not_called()
+        self.assertEqual(repo.get_record('4532772818527395').balance, 850.0)
+        self.assertEqual(len(wb.journal.pending()), 2)
+
+        # The snapshot keeps unflushed writes when it is reloaded
+        repo.refresh()
+        self.assertEqual(repo.get_record('4532761841325802').balance, 150.0)
+
+        self.assertTrue(wb.flusher.flush(timeout=5))
+        client_ws.batch_update.assert_called_once_with([
+            {"range": "E2:F2", "values": [[850.0, 2]]},
+            {"range": "E3:F3", "values": [[150.0, 1]]}
+        ], value_input_option="USER_ENTERED")
+        self.assertEqual(wb.journal.pending(), [])
+
+    def test_account_increase_balance_is_journaled(self):
+        """Test that Account.increaseBalance goes through the journal"""
+        wb = WriteBehind.enable(self.journal_path, interval=0)
+        account = Account('100', '1', '1000.50')
+        account._accountRow, account.version = 2, 0
+        self.sheets["account"].batch_get.return_value = [[['1000.50', '0']]]
+
+        self.assertTrue(account.increaseBalance(-100.0))
+        self.assertTrue(wb.flusher.flush(timeout=5))
+
+        # Balance and version stamp go to the sheet together
+        self.sheets["account"].batch_update.assert_called_once_with(
+            [{"range": "C2:D2", "values": [[900.50, 1]]}], value_input_option="USER_ENTERED")
+        self.sheets["account"].row_values.assert_not_called()
+
+    def test_sessions_on_one_account_before_flush_keep_both_withdrawals(self):
+        """Test that unflushed withdrawals are seen by later loads and checked by stale ones"""
+        sheets, _, atm_cards = build_dataset(clients=2)
+        sheets["account"][1][2] = "500.00"
+        emulator = SheetsEmulator()
+        emulator.load("client_database", sheets)
+        install_emulator(emulator)
+        self.addCleanup(SheetsConnection.reset)
+        wb = WriteBehind.enable(self.journal_path, interval=60)
+        card_num = atm_cards[0][0]
+
+        stale = API().getATMCards(card_num)[0]
+        first = API().getATMCards(card_num)[0]
+        self.assertTrue(UnitOfWork.run(first.withdraw, 100))
+        # A session loading after the write sees the journaled balance
+        second = API().getATMCards(card_num)[0]
+        self.assertEqual((second.balance, second.version), (Money.parse("400"), 1))
+        self.assertTrue(second.withdraw(50))
+        # One loaded before both is checked against them and rebased
+        self.assertTrue(stale.withdraw(25))
+        self.assertEqual(stale.balance, Money.parse("325"))
+
+        self.assertTrue(wb.flusher.flush(timeout=5))
+        ws = emulator.open("client_database").worksheet("account")
+        self.assertEqual(ws.row_values(2)[2:4], ["325", "3"])
+
+    def test_unflushed_entries_are_replayed_on_start(self):
+        """Test that a crashed process's journaled writes are applied on restart"""
+        Journal(self.journal_path).begin("write", ts=0, writes=[
+            {"sheet": "client", "key_col": 1, "key": "4532761841325802", "cells": [[5, 75.0]]}
+        ])
+
+        wb = WriteBehind.enable(self.journal_path, interval=0)
+        self.assertTrue(wb.flusher.flush(timeout=5))
+
+        self.sheets["client"].update_cell.assert_called_once_with(3, 5, 75.0)
+        self.assertEqual(wb.journal.pending(), [])
+
+    @unittest.skipIf(journal.fcntl is None, "journal claims need flock()")
+    def test_journal_has_one_owner(self):
+        """Test that a journal in use cannot be claimed, so a fresh entry at start is a crashed one"""
+        Journal(self.journal_path).begin("write", writes=[
+            {"sheet": "client", "key_col": 1, "key": "4532761841325802", "cells": [[5, 75.0]]}
+        ])
+        wb = WriteBehind.enable(self.journal_path, interval=0)
+        self.assertTrue(wb.flusher.flush(timeout=5))
+        self.sheets["client"].update_cell.assert_called_once_with(3, 5, 75.0)
+
+        with self.assertRaises(JournalBusy):
+            Journal(self.journal_path).claim()
+        WriteBehind.disable(timeout=5)
+        other = Journal(self.journal_path)
+        self.assertTrue(other.claim())
+        other.release()
+
+    def test_replayed_balance_already_on_the_sheet_is_skipped(self):
+        """Test that an entry applied before a crash lost its commit is not written again"""
+        Journal(self.journal_path).begin("write", ts=0, writes=[
+            {"sheet": "client", "key_col": 1, "key": "4532772818527395",
+             "cells": [[5, 900.0], [6, 1]], "check": [6, 0]}
+        ])
+        self.rows["client"][1][4:] = ['900', '1']
+
+        wb = WriteBehind.enable(self.journal_path, interval=0)
+        self.assertTrue(wb.flusher.flush(timeout=5))
+
+        self.sheets["client"].batch_update.assert_not_called()
+        self.sheets["client"].update_cell.assert_not_called()
+        self.assertEqual(wb.journal.pending(), [])
+        self.assertNotIn("abort", [r["state"] for r in wb.journal.records()])
+
+    def test_entry_changed_on_the_sheet_is_not_applied(self):
+        """Test that a journaled balance based on a stamp another process moved past is aborted"""
+        sheets, _, atm_cards = build_dataset(clients=2)
+        emulator = SheetsEmulator()
+        emulator.load("client_database", sheets)
+        install_emulator(emulator)
+        self.addCleanup(SheetsConnection.reset)
+        wb = WriteBehind.enable(self.journal_path, interval=60)
+        card = API().getATMCards(atm_cards[0][0])[0]
+        self.assertTrue(UnitOfWork.run(card.withdraw, 10))
+        # Another process (not using this journal) writes the row first
+        ws = emulator.open("client_database").worksheet("account")
+        ws.batch_update([{"range": "C2:D2", "values": [["7", "5"]]}])
+
+        with patch('sys.stdout', new=StringIO()) as out:
+            self.assertTrue(wb.flusher.flush(timeout=5))
+        self.assertIn("Not applying journaled write", out.getvalue())
+        self.assertEqual(ws.row_values(2)[2:4], ["7", "5"])
+        self.assertEqual(wb.journal.pending(), [])
+        self.assertEqual([r.get("reason") for r in wb.journal.records() if r["state"] == "abort"], ["stale"])
+
+    def test_failed_flush_is_retried(self):
+        """Test that entries stay queued and journaled until the sheet accepts them"""
+        self.sheets["client"].update_cell.side_effect = [Exception("Quota exceeded"), None]
+        wb = WriteBehind.enable(self.journal_path, interval=0)
+        wb.flusher.retry_delay = 0.01
+        repo = SimpleClientRepo(write_behind=True)
+
+        self.assertTrue(repo.update_pin('4532772818527395', '9876'))
+        self.assertTrue(wb.flusher.flush(timeout=5))
+
+        self.assertEqual(self.sheets["client"].update_cell.call_count, 2)
+        self.assertEqual(wb.journal.pending(), [])
+
+
+class TestSheetsEmulator(unittest.TestCase):
+    """Test cases for the in-process Google Sheets emulator"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        self.sheets = {
+            "client": [
+                ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                ['4532772818527395', '1234', 'John', 'Doe', '1000'],
+                ['4532761841325802', '0000', 'Alice', 'Tester', '50']
+            ]
+        }
+
+    def tearDown(self):
+        SheetsConnection.reset()
+
+    def test_reads_and_writes(self):
+        """Test the worksheet surface used by the application"""
+        emulator = SheetsEmulator()
+        ws = emulator.load("client_database", self.sheets).worksheet("client")
+        self.assertEqual(ws.find('4532761841325802').row, 3)
+        self.assertIsNone(ws.find('nope'))
+        self.assertEqual([(c.row, c.col) for c in ws.findall('John')], [(2, 3)])
+        ws.update_cell(2, 5, 900.0)
+        ws.batch_update([{"range": "B3:C3", "values": [["9999", "Alicia"]]}])
+        self.assertEqual(ws.row_values(2)[4], '900')
+        self.assertEqual(ws.get_values("B3:C3"), [['9999', 'Alicia']])
+        self.assertEqual(ws.col_values(1)[1:], ['4532772818527395', '4532761841325802'])
+        self.assertEqual(emulator.stats()["calls"]["batch_update"], 1)
+
+    def test_injected_faults_are_reproducible(self):
+        """Test that seeded 429/503 faults repeat and leave data untouched"""
+        def run():
+            emulator = SheetsEmulator(quota_error_rate=0.3, transient_error_rate=0.2, seed=7)
+            ws = emulator.load("client_database", self.sheets)._worksheets["client"]
+            outcomes = []
+            for i in range(40):
+                try:
+                    ws.update_cell(2, 5, i)
+                    outcomes.append(200)
+                except gspread.exceptions.APIError as e:
+                    outcomes.append(e.response.status_code)
+            return outcomes, ws
+        first, ws = run()
+        second, _ = run()
+        self.assertEqual(first, second)
+        self.assertIn(429, first)
+        self.assertIn(503, first)
+        last_ok = max(i for i, status in enumerate(first) if status == 200)
+        self.assertEqual(ws._rows[1][4], str(last_ok))
+
+    def test_read_quota(self):
+        """Test that the per-minute read quota answers 429"""
+        emulator = SheetsEmulator(read_quota_per_minute=2)
+        ws = emulator.load("client_database", self.sheets)._worksheets["client"]
+        ws.get_all_values()
+        ws.get_all_values()
+        with self.assertRaises(gspread.exceptions.APIError) as ctx:
+            ws.get_all_values()
+        self.assertEqual(ctx.exception.response.status_code, 429)
+
+    def test_install_serves_repo(self):
+        """Test that install() routes SimpleClientRepo to the emulator"""
+        emulator = SheetsEmulator(latency=0.001)
+        emulator.load("client_database", self.sheets)
+        install_emulator(emulator)
+        repo = SimpleClientRepo()
+        self.assertTrue(repo.verify('4532772818527395', '1234'))
+        self.assertTrue(repo.update_balance('4532772818527395', 750))
+        self.assertEqual(repo.get_record('4532772818527395').balance, 750.0)
+
+
+class TestRequestScheduler(unittest.TestCase):
+    """Test cases for the quota-aware request scheduler"""
+
+    def tearDown(self):
+        RequestScheduler.disable()
+        SheetsConnection.reset()
+
+    def test_token_bucket(self):
+        """Test that the bucket allows a burst, then asks the caller to wait"""
+        bucket = TokenBucket(60, burst=2)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertGreater(bucket.try_acquire(), 0.5)
+        self.assertFalse(bucket.acquire(timeout=0.01))
+
+    def test_shared_bucket_file(self):
+        """Test that buckets with the same state file share their tokens"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        path = os.path.join(tmpdir, "reads.bucket")
+        first, second = TokenBucket(60, burst=1, state_path=path), TokenBucket(60, burst=1, state_path=path)
+        self.assertEqual(first.try_acquire(), 0.0)
+        self.assertGreater(second.try_acquire(), 0.0)
+
+    def test_identical_reads_are_coalesced(self):
+        """Test that concurrent identical reads share one request"""
+        import threading
+        scheduler = RequestScheduler(read_per_minute=600)
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return [['a', 'b']]
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(scheduler.submit("read", "key", fetch)))
+                   for _ in range(3)]
+        threads[0].start()
+        while not calls:
+            time.sleep(0.001)
+        for t in threads[1:]:
+            t.start()
+        while scheduler.stats()["coalesced"] < 2:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[['a', 'b']]] * 3)
+
+    def test_writes_go_before_waiting_reads(self):
+        """Test that a queued write takes the next free slot ahead of reads"""
+        import threading
+        scheduler = RequestScheduler(read_per_minute=600, write_per_minute=600, max_concurrent=1)
+        release = threading.Event()
+        order = []
+        blocker = threading.Thread(target=lambda: scheduler.submit("read", None, release.wait))
+        blocker.start()
+        while scheduler.stats()["in_flight"] == 0:
+            time.sleep(0.001)
+        reader = threading.Thread(target=lambda: scheduler.submit("read", None, lambda: order.append("read")))
+        reader.start()
+        time.sleep(0.05)
+        writer = threading.Thread(target=lambda: scheduler.submit("write", None, lambda: order.append("write")))
+        writer.start()
+        while scheduler._waiting_writes == 0:
+            time.sleep(0.001)
+        release.set()
+        for t in (blocker, reader, writer):
+            t.join(5)
+        self.assertEqual(order, ["write", "read"])
+
+    def test_quota_errors_are_retried(self):
+        """Test that a 429 answer is retried through the emulator"""
+        emulator = SheetsEmulator(write_quota_per_minute=1)
+        emulator.load("client_database", {"client": [['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                                                     ['4532772818527395', '1234', 'John', 'Doe', '1000']]})
+        install_emulator(emulator)
+        scheduler = RequestScheduler.enable(write_per_minute=6000, retry_base=0.001, max_retries=2)
+        ws = SheetsConnection.get().SHEET.worksheet("client")
+        ws.update_cell(2, 5, 900)
+        emulator._windows["write"].clear()
+        original = emulator._quota_exceeded
+        failures = iter([(429, "quota", "RESOURCE_EXHAUSTED")])
+        with patch.object(emulator, "_quota_exceeded", lambda kind: next(failures, None) or original(kind)):
+            ws.update_cell(2, 5, 800)
+        self.assertEqual(scheduler.stats()["retries"], 1)
+        self.assertEqual(ws.row_values(2)[4], '800')
+
+
+class TestInstrumentation(unittest.TestCase):
+    """Test cases for backend call instrumentation"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        METRICS.reset()
+        self.emulator = SheetsEmulator()
+        self.emulator.load("client_database", {
+            "client": [
+                ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                ['4532772818527395', '1234', 'John', 'Doe', '1000']
+            ]
+        })
+        install_emulator(self.emulator)
+
+    def tearDown(self):
+        SheetsConnection.reset()
+        METRICS.reset()
+
+    def test_counters_and_histogram(self):
+        """Test recording, filtering and bucketing of calls"""
+        metrics = BackendMetrics()
+        with operation("withdraw"):
+            metrics.record("update_cell", "client", 0.004, sent=10)
+            metrics.record("update_cell", "client", 0.3, error=ValueError())
+        metrics.record("get_all_values", "client", 0.02, received=500)
+        withdraw = metrics.totals(op="withdraw")
+        self.assertEqual((withdraw["count"], withdraw["errors"], withdraw["bytes_sent"]), (2, 1, 10))
+        self.assertEqual(metrics.full_sheet_downloads()[0]["op"], "other")
+        buckets = dict(metrics.histogram(op="withdraw"))
+        self.assertEqual((buckets[5], buckets[500]), (1, 1))
+        self.assertEqual(set(metrics.by_operation()), {"withdraw", "other"})
+
+    def test_worksheet_calls_are_tagged(self):
+        """Test that repo calls are recorded under the current operation"""
+        repo = SimpleClientRepo()
+        with operation("login"):
+            self.assertTrue(repo.verify('4532772818527395', '1234'))
+        with operation("withdraw"):
+            self.assertTrue(repo.update_balance('4532772818527395', 900))
+        self.assertEqual(METRICS.full_sheet_downloads(op="login"), [])
+        self.assertIn("get_values", [c["call"] for c in METRICS.counters(op="login", worksheet="client")])
+        self.assertEqual([c["call"] for c in METRICS.counters(op="withdraw", worksheet="client")],
+                         ["batch_get", "batch_update", "col_values"])
+        self.assertGreater(METRICS.totals(op="login")["bytes_received"], 0)
+
+    @patch('run.print_banner')
+    @patch('run.get_pin', return_value='1234')
+    @patch('builtins.input', side_effect=['4532772818527395', '2', '100', '6'])
+    def test_main_tags_menu_actions(self, mock_input, mock_pin, mock_banner):
+        """Test that main() attributes calls to login and withdraw"""
+        with patch('run.api', None), patch('run.repo', SimpleClientRepo()):
+            with patch('sys.stdout', new_callable=StringIO):
+                main()
+        ops = METRICS.by_operation()
+        self.assertGreater(ops["login"]["count"], 0)
+        # find, the version stamp check and the write
+        self.assertEqual(ops["withdraw"]["count"], 3)
+        path = os.path.join(tempfile.mkdtemp(), "metrics.json")
+        METRICS.dump(path)
+        with open(path) as f:
+            self.assertIn("withdraw", f.read())
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+
+class TestATMServer(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the multi-session asyncio server"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        emulator = SheetsEmulator()
+        emulator.load("client_database", {
+            "client": [
+                ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                ['4532772818527395', '1234', 'John', 'Doe', '1000'],
+                ['4532761841325802', '0000', 'Alice', 'Tester', '50']
+            ]
+        })
+        install_emulator(emulator)
+        self.repo = SimpleClientRepo()
+
+    def tearDown(self):
+        SheetsConnection.reset()
+
+    async def test_session_withdraw_and_transfer(self):
+        """Test the login, withdraw and transfer states"""
+        session = ATMSession(None, self.repo)
+        self.assertIn("Insert Your Card", session.start())
+        self.assertIn("Card not found. Please try again.", await session.feed("1111\n"))
+        self.assertIn("PIN:", await session.feed("4532772818527395\n"))
+        self.assertIn("Incorrect PIN.", await session.feed("9999\n"))
+        self.assertIn("WELCOME TO YOUR ACCOUNT", await session.feed("1234\n"))
+        await session.feed("2")
+        self.assertIn("New balance: €900.00", await session.feed("100"))
+        await session.feed("5")
+        await session.feed("50")
+        self.assertIn("Alice Tester", await session.feed("4532761841325802"))
+        self.assertIn("SUCCESS", await session.feed("y"))
+        self.assertEqual(self.repo.get_record('4532761841325802').balance, 100.0)
+        self.assertIn("Goodbye!", await session.feed("6"))
+        self.assertTrue(session.closed)
+
+    def test_captured_output_excludes_other_threads(self):
+        """Test that prints from other sessions' worker threads do not leak into a session"""
+        def helper():
+            worker = threading.Thread(target=print, args=("[ERROR] other session",))
+            worker.start()
+            worker.join()
+            print("this session")
+        with patch('sys.stdout', new=StringIO()) as console:
+            self.assertEqual(_captured(helper), "this session\n")
+        self.assertEqual(console.getvalue(), "[ERROR] other session\n")
+
+    async def test_session_pin_change(self):
+        """Test the PIN change states for a repo card"""
+        session = ATMSession(None, self.repo)
+        session.start()
+        await session.feed("4532761841325802")
+        await session.feed("0000")
+        self.assertIn("Enter current PIN", await session.feed("4"))
+        self.assertIn("Incorrect current PIN.", await session.feed("4321"))
+        await session.feed("0000")
+        await session.feed("5678")
+        self.assertIn("PIN changed successfully", await session.feed("5678"))
+        self.assertTrue(self.repo.verify('4532761841325802', '5678'))
+
+    async def test_session_api_card_transfer_is_tagged(self):
+        """Test that an API card transfers from its client record, tagged like run.main"""
+        emulator = SheetsEmulator()
+        emulator.load("client_database", {
+            "client": [['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                       ['4532772818527395', '1234', 'John', 'Doe', '1000'],
+                       ['4532761841325802', '0000', 'Alice', 'Tester', '50']],
+            "account": [['accountID', 'holderID', 'balance'], ['100', '1', '1000']],
+            "atmCards": [['accountID', 'cardNum', 'pin', 'failedTries'], ['100', '4532772818527395', '1234', '0']],
+        })
+        SheetsConnection.reset()
+        install_emulator(emulator)
+        METRICS.reset()
+        session = ATMSession(API(), SimpleClientRepo())
+        session.start()
+        await session.feed("4532772818527395")
+        self.assertIn("Welcome back!", await session.feed("1234"))
+        self.assertIn("Amount to transfer", await session.feed("5"))
+        await session.feed("50")
+        self.assertIn("Alice Tester", await session.feed("4532761841325802"))
+        self.assertIn("Your new balance: €950.00", await session.feed("y"))
+        repo = SimpleClientRepo()
+        self.assertEqual((repo.get_record('4532772818527395').balance, repo.get_record('4532761841325802').balance),
+                         (950, 100))
+        ops = METRICS.by_operation()
+        self.assertGreater(ops["login"]["count"], 0)
+        self.assertGreater(ops["transfer"]["count"], 0)
+        self.assertNotIn(None, ops)
+
+    async def test_server_runs_concurrent_sessions(self):
+        """Test two TCP sessions served by one process"""
+        import asyncio
+        server = await ATMServer(None, self.repo).start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+
+        async def session(card, pin):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"{card}\n{pin}\n1\n6\n".encode())
+            await writer.drain()
+            output = (await asyncio.wait_for(reader.read(), 5)).decode()
+            writer.close()
+            return output
+        async with server:
+            john, alice = await asyncio.gather(session('4532772818527395', '1234'),
+                                               session('4532761841325802', '0000'))
+        self.assertIn("Current balance: €1,000.00", john)
+        self.assertIn("Current balance: €50.00", alice)
+        self.assertTrue(john.rstrip().endswith("Goodbye!"))
+
+
+class TestLazyStartup(unittest.TestCase):
+    """Test cases for deferred backend initialization in run.py"""
+
+    def setUp(self):
+        import run
+        self.run = run
+        self.saved = (run.api, run.repo)
+        SheetsConnection.reset()
+
+    def tearDown(self):
+        self.run.api, self.run.repo = self.saved
+        SheetsConnection.reset()
+
+    def test_import_has_no_side_effects(self):
+        """Test that importing run.py creates no backend and loads no Google libraries"""
+        import subprocess
+        code = ("import sys, run; "
+                "print(run.api is run._PENDING, run.repo is run._PENDING, 'gspread' in sys.modules)")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stdout.split(), ["True", "True", "False"])
+
+    @patch('cardHolder.Credentials.from_service_account_file')
+    @patch('cardHolder.gspread.authorize')
+    def test_backends_share_one_authorization(self, mock_authorize, mock_creds):
+        """Test that API and repo are created on demand with a single authorization"""
+        mock_authorize.return_value.open.return_value.worksheet.return_value.get_all_values.return_value = []
+        self.run.api, self.run.repo = self.run._PENDING, self.run._PENDING
+        with patch.dict(os.environ, {"ATM_JOURNAL_PATH": ""}):
+            self.run._ensure_backends()
+        self.assertIsInstance(self.run.api, API)
+        self.assertIsInstance(self.run.repo, SimpleClientRepo)
+        self.assertEqual(mock_authorize.call_count, 1)
+        self.assertEqual(mock_creds.call_count, 1)
+
+    @unittest.skipIf(journal.fcntl is None, "journal claims need flock()")
+    @patch('cardHolder.Credentials.from_service_account_file')
+    @patch('cardHolder.gspread.authorize')
+    def test_busy_write_behind_journal_falls_back_to_direct_writes(self, mock_authorize, mock_creds):
+        """Test that a session whose write-behind journal is owned elsewhere still starts"""
+        mock_authorize.return_value.open.return_value.worksheet.return_value.get_all_values.return_value = []
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        owner = Journal(os.path.join(tmpdir, "writes.journal"))
+        owner.claim()
+        self.addCleanup(owner.release)
+        self.run.api, self.run.repo = self.run._PENDING, self.run._PENDING
+        with patch.object(self.run, "write_behind_journal", owner.path), \
+                patch.dict(os.environ, {"ATM_JOURNAL_PATH": ""}), \
+                patch('sys.stdout', new=StringIO()) as out:
+            self.run._ensure_backends()
+        self.assertIn("Write-behind disabled", out.getvalue())
+        self.assertIsNone(WriteBehind.active())
+        self.assertIsNone(self.run.repo.write_behind)
+
+    def test_assigned_backends_are_kept(self):
+        """Test that _ensure_backends leaves assigned backends alone"""
+        fake_api, fake_repo = Mock(), Mock()
+        self.run.api, self.run.repo = fake_api, fake_repo
+        self.run._ensure_backends()
+        self.assertIs(self.run.api, fake_api)
+        self.assertIs(self.run.repo, fake_repo)
+
+    def test_startup_report(self):
+        """Test the time-to-banner report"""
+        self.run._mark("banner")
+        with patch.dict(os.environ, {"ATM_SPAWNED_AT": str(time.time() * 1000 - 500)}):
+            report = self.run.startup_report()
+        self.assertIn("imports", report)
+        self.assertGreaterEqual(report["banner"], report["imports"])
+        self.assertIn("spawn_to_import", report)
+
+
+class TestBenchmark(unittest.TestCase):
+    """Test cases for the ATM latency benchmark"""
+
+    def setUp(self):
+        import run
+        self.saved = (run.api, run.repo)
+
+    def tearDown(self):
+        import run
+        run.api, run.repo = self.saved
+        SheetsConnection.reset()
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles"""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_reports_every_operation(self):
+        """Test that each operation gets latency, round trip and byte figures"""
+        report = run_benchmark(iterations=3, warmup=0, clients=5)
+        self.assertEqual(set(report["results"]),
+                         {"authenticate", "withdraw", "deposit", "pin_change", "transfer"})
+        for result in report["results"].values():
+            self.assertEqual(result["failures"], 0)
+            self.assertGreater(result["round_trips"], 0)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+        self.assertEqual(report["config"]["iterations"], 3)
+
+    def test_api_flow_writes_like_run_main(self):
+        """Test that api menu actions commit through a unit of work and PIN changes write"""
+        report = run_benchmark(iterations=4, warmup=0, clients=2, flow="api",
+                               operations=("withdraw", "deposit", "pin_change", "authenticate"))
+        for op in ("withdraw", "deposit", "pin_change", "authenticate"):
+            self.assertEqual(report["results"][op]["failures"], 0)
+        self.assertGreater(report["results"]["pin_change"]["round_trips"], 0)
+        self.assertGreater(report["results"]["pin_change"]["bytes"], 0)
+
+
+class TestSqliteBackend(unittest.TestCase):
+    """Test cases for the SQLite storage backend"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        self.tmpdir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmpdir, "atm.db")
+        sheets = {
+            "client": [
+                ['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                ['4532772818527395', '1234', 'John', 'Doe', '1000'],
+                ['4532761841325802', '0000', 'Alice', 'Tester', '50.25']
+            ],
+            "accountHolder": [
+                ['id', 'firstname', 'lastname', 'phone'],
+                ['1', 'John', 'Doe', '555-1234']
+            ],
+            "account": [
+                ['accountID', 'holderID', 'balance'],
+                ['100', '1', '1000.50'],
+                ['200', '1', '20']
+            ],
+            "atmCards": [
+                ['accountID', 'cardNum', 'pin', 'failedTries'],
+                ['100', '4532772818527395', '1234', '0'],
+                ['200', '4532761841325802', '0000', '1']
+            ]
+        }
+        spreadsheet = Mock()
+        spreadsheet.worksheet.side_effect = lambda name: Mock(get_all_values=Mock(return_value=sheets[name]))
+        copy_from_spreadsheet(spreadsheet, self.db_path)
+
+    def tearDown(self):
+        SheetsConnection.reset()
+        SqliteDatabase.close_all()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_database_uses_wal(self):
+        """Test that the database is opened in WAL mode"""
+        db = SqliteDatabase.get(self.db_path)
+        self.assertEqual(db.query("PRAGMA journal_mode")[0][0], "wal")
+
+    def test_repo_get_record_and_verify(self):
+        """Test lookups by card number"""
+        repo = SqliteClientRepo(self.db_path)
+        rec = repo.get_record('4532761841325802')
+        self.assertEqual(rec.firstName, 'Alice')
+        self.assertEqual(rec.balance, 50.25)
+        self.assertIsNone(repo.get_record('0000000000000000'))
+        self.assertTrue(repo.verify('4532772818527395', '1234'))
+        self.assertFalse(repo.verify('4532772818527395', '9999'))
+
+    def test_worksheet_range_reads(self):
+        """Test that A1 range pages are answered with rowid range queries"""
+        ws = SqliteWorksheet(SqliteDatabase.get(self.db_path), "client")
+        self.assertEqual([row[0] for _, row in iter_rows(ws, 5, page_size=1)],
+                         ['4532772818527395', '4532761841325802'])
+        self.assertEqual(ws.get_values("A1:B2"), [['cardNum', 'pin'], ['4532772818527395', '1234']])
+
+    def test_repo_updates(self):
+        """Test balance and PIN updates"""
+        repo = SqliteClientRepo(self.db_path)
+        self.assertTrue(repo.update_balance('4532772818527395', 900.5))
+        self.assertTrue(repo.update_pin('4532772818527395', '4321'))
+        self.assertFalse(repo.update_balance('0000000000000000', 1))
+        rec = repo.get_record('4532772818527395')
+        self.assertEqual(rec.balance, 900.5)
+        self.assertEqual(rec.pin, '4321')
+
+    def test_repo_transfer_is_atomic(self):
+        """Test that a transfer to a missing card leaves the source untouched"""
+        repo = SqliteClientRepo(self.db_path)
+        source = repo.get_record('4532772818527395')
+        dest = repo.get_record('4532761841325802')
+        self.assertTrue(repo.transfer(source, dest, 100))
+        self.assertEqual(repo.get_record('4532772818527395').balance, 900.0)
+        self.assertEqual(repo.get_record('4532761841325802').balance, 150.25)
+
+        missing = ClientRecord('0000000000000000', '1', 'No', 'One', '0')
+        with patch('sys.stdout', new_callable=StringIO):
+            self.assertFalse(repo.transfer(repo.get_record('4532772818527395'), missing, 100))
+        self.assertEqual(repo.get_record('4532772818527395').balance, 900.0)
+
+    def test_api_lookups(self):
+        """Test indexed API lookups"""
+        api = SqliteAPI(self.db_path)
+        cards = api.getATMCards('4532761841325802')
+        self.assertEqual(len(cards), 1)
+        self.assertEqual(cards[0].getAccountID(), '200')
+        self.assertEqual(cards[0].getFailedTries(), '1')
+        self.assertEqual(len(api.getATMCards(0)), 2)
+        self.assertEqual(api.getATMCards('1111'), [])
+        self.assertEqual([a.getAccountID() for a in api.getAccountByHolderID(1)], ['100', '200'])
+        self.assertEqual(api.getAccountHolders(1)[0].getPhone(), '555-1234')
+
+    def test_models_write_through_adapter(self):
+        """Test that model mutations reach SQLite through API()"""
+        api = SqliteAPI(self.db_path)
+        card = api.getATMCards('4532772818527395')[0]
+        self.assertTrue(card.withdraw(0.5))
+        self.assertTrue(card.setPin('5678'))
+        self.assertTrue(card.increaseFailedTries())
+        holder = api.getAccountHolders(1)[0]
+        self.assertTrue(holder.updateAccount('Jon', 'Doe', '555-0000'))
+
+        card = api.getATMCards('4532772818527395')[0]
+        self.assertEqual(float(card.getAccountBalance()), 1000.0)
+        self.assertEqual(card.getPin(), '5678')
+        self.assertEqual(card.getFailedTries(), '1')
+        self.assertEqual(api.getAccountHolders(1)[0].getFirstname(), 'Jon')
+
+    def test_balances_are_stored_as_cents(self):
+        """Test that balances are INTEGER cents in the table and Money text outside it"""
+        db = SqliteDatabase.get(self.db_path)
+        self.assertEqual(db.query("SELECT balance FROM account ORDER BY rowid"), [(100050,), (2000,)])
+        SqliteClientRepo(self.db_path).update_balance('4532761841325802', 0.1 + 0.2)
+        self.assertEqual(db.query("SELECT balance FROM client WHERE cardNum = '4532761841325802'"), [(30,)])
+        ws = SqliteWorksheet(db, "account")
+        self.assertEqual(ws.get_values("C2:C3"), [['1000.50'], ['20.00']])
+        ws.update_cell(3, 3, '20.5')
+        self.assertEqual(ws.row_values(3), ['200', '1', '20.50', ''])
+
+    def test_rows_are_addressed_by_rowid(self):
+        """Test that sheet row N is rowid N - 1 and missing rows are refused"""
+        db = SqliteDatabase.get(self.db_path)
+        ws = SqliteWorksheet(db, "account")
+        self.assertEqual(ws.find('200').row, 3)
+        self.assertEqual(ws.row_count, 3)
+        with self.assertRaises(IndexError):
+            ws.update_cell(4, 2, '1')
+        ws.append_rows([['300', '1', '5']])
+        self.assertEqual(ws.row_values(4), ['300', '1', '5.00', ''])
+        self.assertEqual(db.query("SELECT rowid FROM account WHERE accountID = 300"), [(3,)])
+
+    def test_old_layout_is_rebuilt(self):
+        """Test that REAL balances and id rowids with gaps are migrated in sheet order"""
+        path = os.path.join(self.tmpdir, "old.db")
+        old = sqlite3.connect(path)
+        old.execute("CREATE TABLE account (accountID INTEGER PRIMARY KEY, holderID INTEGER, balance REAL)")
+        old.executemany("INSERT INTO account VALUES (?, ?, ?)", [(300, 1, 12.5), (100, 1, 1000.5)])
+        old.commit()
+        old.close()
+        db = SqliteDatabase.get(path)
+        self.assertEqual(db.query("SELECT rowid, accountID, balance FROM account ORDER BY rowid"),
+                         [(1, 100, 100050), (2, 300, 1250)])
+        self.assertEqual(SqliteWorksheet(db, "account").row_values(3), ['300', '1', '12.50', '0'])
+
+    def test_backend_imports_without_gspread(self):
+        """Test that importing sqlite_backend loads no Google libraries"""
+        import subprocess
+        code = "import sys, sqlite_backend; print('gspread' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, timeout=60,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stdout.split(), ["False"])
+
+    def test_repository_interface_is_abstract(self):
+        """Test that a backend must implement the ClientRepository methods"""
+        class Partial(ClientRepository):
+            def get_record(self, card_num):
+                return None
+
+        with self.assertRaises(TypeError):
+            Partial()
+        self.assertIsInstance(SqliteClientRepo(self.db_path), ClientRepository)
+
 
 # Test Account.increaseBalance method
 
@@ -1151,14 +2450,19 @@ class TestAccountIncreaseBalance(unittest.TestCase):
         mock_cell.row = 2
         mock_cell.col = 1
         mock_api.SHEET.worksheet.return_value.findall.return_value = [mock_cell]
-        mock_api.SHEET.worksheet.return_value.row_values.return_value = ['100', '1', '1000.50']
+        # Stored balance and version stamp, read once before the first write
+        # and again by the version check
+        mock_api.SHEET.worksheet.return_value.batch_get.return_value = [[['1000.50', '0']]]
         mock_api_class.return_value = mock_api
         
         account = Account('100', '1', '1000.50')
+        account._accountRow = 2
         result = account.increaseBalance(100.00)
         
         self.assertTrue(result)
-        mock_api.SHEET.worksheet.return_value.update_cell.assert_called_once_with(2, 3, 1100.50)
+        self.assertEqual(account.version, 1)
+        mock_api.SHEET.worksheet.return_value.batch_update.assert_called_once_with(
+            [{"range": "C2:D2", "values": [[1100.50, 1]]}], value_input_option="USER_ENTERED")
     
     @patch('cardHolder.API')
     @patch('sys.stdout', new_callable=StringIO)
@@ -1290,6 +2594,50 @@ class TestATMCardDatabaseMethods(unittest.TestCase):
         self.assertFalse(result)
         self.assertIn("ERROR", mock_stdout.getvalue())
 
+# Test CellBatch write batching
+
+class TestCellBatch(unittest.TestCase):
+    """Test cases for CellBatch"""
+
+    def test_adjacent_cells_merge_into_one_range(self):
+        """Test that adjacent cells in a row become a single range"""
+        ws = Mock()
+        with CellBatch(ws) as batch:
+            batch.update_cell(2, 3, 'b')
+            batch.update_cell(2, 2, 'a')
+            batch.update_cell(5, 5, 10.5)
+            batch.update_cell(2, 5, 'd')
+
+        ws.batch_update.assert_called_once_with([
+            {"range": "B2:C2", "values": [["a", "b"]]},
+            {"range": "E2", "values": [["d"]]},
+            {"range": "E5", "values": [[10.5]]}
+        ], value_input_option="USER_ENTERED")
+
+    def test_single_cell_uses_update_cell(self):
+        """Test that a one-cell batch is sent with update_cell"""
+        ws = Mock()
+        with CellBatch(ws) as batch:
+            batch.update_cell(3, 4, 1)
+            batch.update_cell(3, 4, 2)
+
+        ws.update_cell.assert_called_once_with(3, 4, 2)
+        ws.batch_update.assert_not_called()
+
+    def test_nothing_sent_on_error_or_when_empty(self):
+        """Test that an empty batch or a failed operation sends nothing"""
+        ws = Mock()
+        with CellBatch(ws):
+            pass
+        with self.assertRaises(ValueError):
+            with CellBatch(ws) as batch:
+                batch.update_cell(2, 2, 'x')
+                raise ValueError("abort")
+
+        ws.update_cell.assert_not_called()
+        ws.batch_update.assert_not_called()
+
+
 # TestInputValidation here:
 
 class TestInputValidation(unittest.TestCase):
@@ -1373,6 +2721,756 @@ class TestErrorHandling(unittest.TestCase):
                     pass
 
 
+# TestPagedReads here:
+
+class TestPagedReads(unittest.TestCase):
+    """Test cases for paged, column-projected worksheet reads"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        sheets, self.client_cards, self.atm_cards = build_dataset(clients=10)
+        self.emulator = SheetsEmulator()
+        self.emulator.load("client_database", sheets)
+        install_emulator(self.emulator)
+        patcher = patch('cardHolder.READ_PAGE_SIZE', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        SheetsConnection.reset()
+
+    def reads(self):
+        return self.emulator.stats()["calls"].get("get_values", 0)
+
+    def test_get_record_stops_at_its_page(self):
+        """Test that a lookup fetches no pages after the one holding the card"""
+        repo = SimpleClientRepo()
+        self.assertEqual(repo.get_record(self.client_cards[1][0]).firstName, 'First2')
+        self.assertEqual(self.reads(), 1)
+        self.assertIsNone(repo.get_record('0000000000000000'))
+        # 10 rows in pages of 3: 3 + 3 + 3 + 1
+        self.assertEqual(self.reads(), 5)
+        self.assertNotIn("get_all_values", self.emulator.stats()["calls"])
+
+    def test_api_single_id_lookups(self):
+        """Test that card, account and holder lookups read only up to their row"""
+        api = API()
+        card = api.getATMCards(self.atm_cards[3][0])[0]
+        self.assertEqual((card.getAccountID(), card.getAccountHolderID()), ('104', '4'))
+        # card in the second atmCards page, account in the second account page
+        self.assertEqual(self.reads(), 4)
+        self.assertEqual(api.getAccountByID(101)[0].getAccountHolderID(), '1')
+        self.assertEqual(api.getAccountHolders(2)[0].getFirstname(), 'First2')
+        self.assertEqual(len(api.getAccountByHolderID(7)), 1)
+        self.assertEqual(self.reads(), 4 + 1 + 1 + 4)
+        self.assertEqual(list(iter_rows(self.emulator.open("client_database").worksheet("account"), 3,
+                                        page_size=20))[-1][0], 11)
+
+    def test_lookups_read_the_key_column_then_project(self):
+        """Test that verify pages through cardNum only and fetches just the PIN"""
+        rows = [['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                ['4532772818527395', '1234', 'John', 'Doe', '1000'],
+                ['4532761841325802', '0000', 'Alice', 'Tester', '50']]
+        ws = _serve_pages(Mock(**{"get_all_values.return_value": rows}))
+        repo = SimpleClientRepo()
+        with patch.object(repo, '_ws', return_value=ws):
+            self.assertTrue(repo.verify('4532761841325802', '0000'))
+            ws.get_values.assert_called_once_with("A2:A4")
+            ws.batch_get.assert_called_once_with(["B3:B3"])
+            self.assertEqual(repo.get_record('4532761841325802').lastName, 'Tester')
+            ws.batch_get.assert_called_with(["A3:F3"])
+        # All accounts of a holder come back in one batch_get
+        accounts = self.emulator.open("client_database").worksheet("account")
+        accounts.append_rows([['200', '7', '5']])
+        self.assertEqual([a.getAccountID() for a in API().getAccountByHolderID(7)], ['107', '200'])
+        self.assertEqual(self.emulator.stats()["calls"]["batch_get"], 1)
+
+    def test_blank_key_at_page_end_does_not_end_the_scan(self):
+        """Test that rows after a page shortened by a trailing blank row are still read"""
+        ws = self.emulator.open("client_database").worksheet("client")
+        # Row 4 closes the first page (rows 2-4); Sheets drops it from the response
+        ws.batch_update([{"range": "A4:E4", "values": [[""] * 5]}])
+        self.assertEqual(ws.get_values("A2:A4"), [[self.client_cards[0][0]], [self.client_cards[1][0]]])
+        repo = SimpleClientRepo()
+        self.assertEqual(repo.get_record(self.client_cards[4][0]).firstName, 'First5')
+        self.assertEqual([row for row, _ in iter_rows(ws, 1)], [2, 3, 5, 6, 7, 8, 9, 10, 11])
+
+        # Without a row_count the scan goes on until a page comes back empty
+        class Bare:
+            get_values = ws.get_values
+        self.assertEqual([row for row, _ in iter_rows(Bare(), 1)], [2, 3, 5, 6, 7, 8, 9, 10, 11])
+
+
+# TestAnalytics here:
+
+class TestAnalytics(unittest.TestCase):
+    """Test cases for bulk balance parsing and portfolio analytics"""
+
+    def test_parse_balance_column(self):
+        """Test that a whole column parses like _parse_balance_str"""
+        values = ['3 649,30', '557,22', '150.79', '1\xa0000', 12.5, 'abc', '']
+        cents, invalid = analytics.parse_balance_column(values)
+        self.assertEqual(list(cents), [364930, 55722, 15079, 100000, 1250, 0, 0])
+        self.assertEqual(invalid, 2)
+        for value, parsed in zip(values, cents):
+            self.assertAlmostEqual(int(parsed) / 100, _parse_balance_str(value), places=2)
+
+    HALF_CENTS = ['0.005', '2,675', '-1.005', '10.125', '1 234,565', '+0.015', '.5', '7.', '1e2', 2.675,
+                  '--1', 'abc', '']
+
+    def test_half_cents_round_like_money(self):
+        """Test that the pure-Python path rounds half-cents half up, as Money does"""
+        with patch.object(analytics, "np", None):
+            cents, invalid = analytics.parse_balance_column(self.HALF_CENTS)
+        self.assertEqual(cents[:10], [Money.parse(v).cents for v in self.HALF_CENTS[:10]])
+        self.assertEqual(cents[:5], [1, 268, -101, 1013, 123457])
+        self.assertEqual((cents[10:], invalid), ([0, 0, 0], 3))
+
+    @unittest.skipIf(analytics.np is None, "NumPy is not installed")
+    def test_numpy_path_matches_pure_python(self):
+        """Test that the NumPy path gives the same cents as the pure-Python path"""
+        cents, invalid = analytics.parse_balance_column(self.HALF_CENTS)
+        with patch.object(analytics, "np", None):
+            expected = analytics.parse_balance_column(self.HALF_CENTS)
+        self.assertEqual((cents.tolist(), invalid), expected)
+
+    @unittest.skipIf(analytics.np is None, "NumPy is not installed")
+    def test_numpy_top_n_breaks_ties_like_pure_python(self):
+        """Test that tied balances are ranked in row order on both paths"""
+        keys = [str(i) for i in range(12)]
+        cents = [5, 9, 5, 9, 1, 5, 9, 5, 0, 9, 5, 2]
+        for n in (1, 3, 4, 5, 7, 12, 20):
+            with patch.object(analytics, "np", None):
+                expected = analytics.top_n(keys, cents, n)
+            self.assertEqual(analytics.top_n(keys, analytics.np.asarray(cents), n), expected)
+        self.assertEqual(analytics.top_n(keys, cents, 5),
+                         [('1', 0.09), ('3', 0.09), ('6', 0.09), ('9', 0.09), ('0', 0.05)])
+
+    def test_summary_top_and_histogram(self):
+        """Test totals, percentiles, top-N and histogram buckets"""
+        cents = [1000, 2000, 3000, 4000, 10000]
+        summary = analytics.summarize(cents)
+        self.assertEqual(summary["total"], 200.0)
+        self.assertEqual(summary["mean"], 40.0)
+        self.assertEqual((summary["min"], summary["p50"], summary["max"]), (10.0, 30.0, 100.0))
+        keys = ['a', 'b', 'c', 'd', 'e']
+        self.assertEqual(analytics.top_n(keys, cents, 2), [('e', 100.0), ('d', 40.0)])
+        buckets = analytics.histogram(cents, bins=3)
+        self.assertEqual([count for _, _, count in buckets], [4, 0, 1])
+        self.assertEqual(buckets[-1][1], 100.0)
+        self.assertEqual(analytics.summarize([])["count"], 0)
+
+    def test_analyze_downloads_each_sheet_once(self):
+        """Test analytics over an emulated spreadsheet snapshot"""
+        SheetsConnection.reset()
+        emulator = SheetsEmulator()
+        spreadsheet = emulator.load("client_database", {
+            "client": [['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                       ['4532772818527395', '1234', 'John', 'Doe', '1 000,50'],
+                       ['4532761841325802', '0000', 'Alice', 'Tester', '50']],
+            "account": [['accountID', 'holderID', 'balance'], ['100', '1', '20,25']],
+        })
+        report = analytics.analyze(spreadsheet, top=1, bins=2)
+        self.assertEqual(report["client"]["summary"]["total"], 1050.5)
+        self.assertEqual(report["client"]["top"], [('4532772818527395', 1000.5)])
+        self.assertEqual(report["account"]["summary"]["total"], 20.25)
+        self.assertEqual(emulator.stats()["calls"]["get_all_values"], 2)
+        self.assertIn("client: 2 balances", analytics.format_report(report))
+
+
+# TestReconcile here:
+
+class TestReconcile(unittest.TestCase):
+    """Test cases for the client/account reconciliation job"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        self.emulator = SheetsEmulator()
+        self.spreadsheet = self.emulator.load("client_database", {
+            "client": [['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                       ['1111', '1234', 'John', 'Doe', '1 000,50'],
+                       ['2222', '0000', 'Alice', 'Tester', '50'],
+                       ['3333', '0000', 'Bob', 'Only', '5']],
+            "account": [['accountID', 'holderID', 'balance'],
+                        ['100', '1', '1000.50'], ['101', '2', '60'], ['102', '3', '7']],
+            "atmCards": [['accountID', 'cardNum', 'pin', 'failedTries'],
+                         ['100', '1111', '1234', '0'], ['101', '2222', '0000', '0'],
+                         ['105', '4444', '0000', '0']],
+        })
+
+    def tearDown(self):
+        SheetsConnection.reset()
+
+    def test_reports_mismatches_orphans_and_totals(self):
+        """Test every kind of finding with small pages and partitions"""
+        report = reconcile.reconcile(self.spreadsheet, page_size=2, partitions=3)
+        self.assertEqual(report["matched"], 1)
+        self.assertEqual(report["counts"], {"mismatches": 1, "client_only": 1, "client_duplicates": 0,
+                                            "cards_without_client": 1, "cards_without_account": 1,
+                                            "accounts_without_card": 1})
+        self.assertEqual(report["examples"]["mismatches"][0]["difference"], -10.0)
+        self.assertEqual(report["examples"]["client_only"][0]["card"], '3333')
+        self.assertEqual(report["examples"]["accounts_without_card"][0]["accountID"], '102')
+        self.assertEqual(report["totals"]["client"], {"rows": 3, "balance": 1055.5})
+        self.assertEqual(report["totals"]["account"], {"rows": 3, "balance": 1067.5})
+
+    def test_reads_in_pages(self):
+        """Test that worksheets are streamed in A1 range pages"""
+        reconcile.reconcile(self.spreadsheet, page_size=2, limit=0)
+        self.assertNotIn("get_all_values", self.emulator.stats()["calls"])
+        # 3 rows per sheet in pages of 2: the second page comes back short
+        self.assertEqual(self.emulator.stats()["calls"]["get_values"], 6)
+
+    def test_reports_cards_listed_twice_in_client(self):
+        """Test that a repeated client card is a duplicate, not a client-only card"""
+        self.spreadsheet.worksheet("client").append_rows([['1111', '1234', 'John', 'Again', '3']])
+        report = reconcile.reconcile(self.spreadsheet, page_size=2, partitions=3)
+        self.assertEqual(report["counts"]["client_duplicates"], 1)
+        self.assertEqual(report["examples"]["client_duplicates"], [{"card": '1111', "balance": 3.0}])
+        self.assertEqual((report["counts"]["client_only"], report["matched"]), (1, 1))
+
+    def test_spill_files_are_removed_on_errors(self):
+        """Test that the spill directory is closed and removed when a read fails"""
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir, True)
+        with patch.object(reconcile, "iter_rows", side_effect=[iter([(2, ['100', '1', '5'])]), RuntimeError]):
+            with self.assertRaises(RuntimeError):
+                reconcile.reconcile(self.spreadsheet, workdir=workdir)
+        self.assertEqual(os.listdir(workdir), [])
+
+
+# TestCsvTool here:
+
+class TestCsvTool(unittest.TestCase):
+    """Test cases for the bulk CSV import/export tool"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        self.emulator = SheetsEmulator()
+        self.spreadsheet = self.emulator.load("client_database", {
+            "client": [['cardNum', 'pin', 'firstName', 'lastName', 'balance'],
+                       ['4532772818527395', '1234', 'John', 'Doe', '1000']],
+            "account": [['accountID', 'holderID', 'balance'], ['100', '1', '10']],
+            "atmCards": [['accountID', 'cardNum', 'pin', 'failedTries']],
+        })
+
+    def tearDown(self):
+        SheetsConnection.reset()
+
+    def test_import_validates_and_appends_in_chunks(self):
+        """Test that valid rows go in append_rows chunks and bad rows are rejected"""
+        source = StringIO(
+            "firstName,lastName,cardNum,pin,balance\n"
+            "Alice,Tester,4532761841325802,0000,\"1 250,75\"\n"
+            "Bob,Dup,4532772818527395,1111,5\n"
+            "Carol,Short,4532761841325803,12,5\n"
+            "Dan,Neg,4532761841325804,1234,-1\n"
+            "Eve,Ok,4532761841325805,4321,7\n"
+            "Fay,Ok,4532761841325806,4321,8\n")
+        rejects = StringIO()
+        report = csv_tool.import_csv(self.spreadsheet, "client", source, chunk_size=2, rejects=rejects)
+        self.assertEqual((report.rows, report.imported, report.rejected, report.chunks), (6, 3, 3, 2))
+        self.assertEqual([line for line, _ in report.errors], [3, 4, 5])
+        self.assertIn("duplicate cardNum", report.errors[0][1])
+        self.assertEqual(len(rejects.getvalue().splitlines()), 4)
+        rows = self.spreadsheet.worksheet("client").get_all_values()
+        self.assertEqual(rows[2], ['4532761841325802', '0000', 'Alice', 'Tester', '1250.75', '0'])
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(self.emulator.stats()["calls"]["append_rows"], 2)
+
+    def test_import_checks_references_and_header(self):
+        """Test that cards must point at an existing account"""
+        source = StringIO("accountID,cardNum,pin,failedTries\n100,5300000000000001,1234,\n"
+                          "999,5300000000000002,1234,0\n")
+        report = csv_tool.import_csv(self.spreadsheet, "atmCards", source, dry_run=True)
+        self.assertEqual((report.imported, report.rejected, report.chunks), (1, 1, 0))
+        self.assertIn("unknown accountID", report.errors[0][1])
+        with self.assertRaises(ValueError):
+            csv_tool.import_csv(self.spreadsheet, "atmCards", StringIO("accountID,pin\n"))
+
+    def test_import_appends_as_user_entered(self):
+        """Test that chunks are stored like update_cell values, with a blank count as 0"""
+        ws = self.spreadsheet.worksheet("atmCards")
+        with patch.object(ws, "append_rows", wraps=ws.append_rows) as append_rows:
+            report = csv_tool.import_csv(self.spreadsheet, "atmCards",
+                                         StringIO("accountID,cardNum,pin,failedTries\n100,5300000000000001,0123,\n"))
+        self.assertEqual(report.imported, 1)
+        append_rows.assert_called_once_with([[100, '5300000000000001', '0123', 0]], value_input_option="USER_ENTERED")
+
+    def test_export_streams_pages(self):
+        """Test exporting a worksheet page by page"""
+        target = StringIO()
+        self.assertEqual(csv_tool.export_csv(self.spreadsheet, "client", target, page_size=1), 1)
+        self.assertEqual(target.getvalue().splitlines(),
+                         ['cardNum,pin,firstName,lastName,balance,version', '4532772818527395,1234,John,Doe,1000,'])
+        self.assertNotIn("get_all_values", self.emulator.stats()["calls"])
+
+    def test_version_stamps_survive_a_round_trip(self):
+        """Test that exported version stamps are imported into the same column"""
+        ws = self.spreadsheet.worksheet("account")
+        self.assertIsNone(compare_and_set(ws, [(2, 3, 15, 0)]))
+        exported = StringIO()
+        csv_tool.export_csv(self.spreadsheet, "account", exported)
+        restored = self.emulator.load("restored", {
+            "accountHolder": [['id', 'firstname', 'lastname', 'phone'], ['1', 'John', 'Doe', '555']],
+            "account": [['accountID', 'holderID', 'balance', 'version']]})
+        report = csv_tool.import_csv(restored, "account", StringIO(exported.getvalue()))
+        self.assertEqual((report.imported, report.rejected), (1, 0))
+        ws = restored.worksheet("account")
+        self.assertEqual(ws.row_values(2), ['100', '1', '15', '1'])
+        # A writer holding the old stamp is still refused
+        self.assertEqual(compare_and_set(ws, [(2, 3, 20, 0)]), {2: ('15', 1)})
+
+
+# TestMoney here:
+
+class TestMoney(unittest.TestCase):
+    """Test cases for the integer-cents Money type"""
+
+    def test_parse_sheet_formats(self):
+        """Test parsing the balance formats found in the sheet"""
+        self.assertEqual(Money.parse("3 649,30").cents, 364930)
+        self.assertEqual(Money.parse("557,22").cents, 55722)
+        self.assertEqual(Money.parse("1\xa0000.5").cents, 100050)
+        self.assertEqual(Money.parse(12).cents, 1200)
+        self.assertEqual(Money.parse(0.29).cents, 29)
+        for bad in ("abc", "12.34.56", "", "inf"):
+            with self.assertRaises(ValueError):
+                Money.parse(bad)
+
+    def test_arithmetic_has_no_float_drift(self):
+        """Test that repeated additions stay exact"""
+        total = Money(0)
+        for _ in range(10):
+            total += Money.parse("0.10")
+        self.assertEqual(total.cents, 100)
+        self.assertEqual(1000.00 - Money.parse("0.01"), Money(99999))
+        self.assertIsInstance(1000.00 - Money(1), Money)
+
+    def test_mixes_with_floats(self):
+        """Test comparison, hashing and formatting against floats"""
+        amount = Money.parse("1250.75")
+        self.assertEqual(amount, 1250.75)
+        self.assertEqual(hash(amount), hash(1250.75))
+        self.assertTrue(amount > 1000)
+        self.assertEqual(float(amount), 1250.75)
+        self.assertEqual(f"{amount:,.2f}", "1,250.75")
+        self.assertEqual(str(Money(-5)), "-0.05")
+
+    def test_models_share_parsed_balance(self):
+        """Test that ATMCard keeps the parsed balance across withdrawals"""
+        card = ATMCard("123", "456", "1 000,10", "4532772818527395", "1234", "0")
+        with patch.object(card, 'increaseBalance', return_value=True):
+            for _ in range(3):
+                self.assertTrue(card.withdraw("0.10"))
+        self.assertEqual(card.balance, Money(99980))
+        self.assertEqual(card.getAccountBalance(), "999.80")
+
+
+# TestUnitOfWork here:
+
+class TestUnitOfWork(unittest.TestCase):
+    """Test cases for change tracking and batched commits of model writes"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        sheets, _, self.atm_cards = build_dataset(clients=5)
+        self.emulator = SheetsEmulator()
+        self.emulator.load("client_database", sheets)
+        install_emulator(self.emulator)
+        self.card_num, self.pin = self.atm_cards[2]
+
+    def tearDown(self):
+        SheetsConnection.reset()
+
+    def writes(self):
+        calls = self.emulator.stats()["calls"]
+        return {name: calls[name] for name in ("update_cell", "batch_update", "findall", "row_values")
+                if name in calls}
+
+    def test_login_with_no_failed_tries_writes_nothing(self):
+        """Test that a successful login does not reset a counter that is already 0"""
+        card = API().getATMCards(self.card_num)[0]
+        self.assertTrue(UnitOfWork.run(card.verify_pin, self.pin))
+        self.assertTrue(card.resetFailedTries())
+        self.assertEqual(self.writes(), {})
+
+    def test_session_changes_commit_in_one_flush(self):
+        """Test that recorded changes are written per worksheet on commit, without row searches"""
+        card = API().getATMCards(self.card_num)[0]
+        with UnitOfWork() as uow:
+            self.assertTrue(card.withdraw(10))
+            self.assertTrue(card.deposit(4))
+            self.assertTrue(card.setPin('9999'))
+            self.assertTrue(card.increaseFailedTries())
+            self.assertEqual(self.writes(), {})
+            self.assertTrue(uow.commit())
+        # One request for atmCards (adjacent pin and failedTries cells), one
+        # for the account's balance and version stamp
+        self.assertEqual(self.writes(), {"batch_update": 2})
+        reloaded = API().getATMCards(self.card_num)[0]
+        self.assertEqual(reloaded.balance, card.balance)
+        self.assertEqual((reloaded.getPin(), reloaded.getFailedTries()), ('9999', '1'))
+
+    def test_undone_and_failed_changes(self):
+        """Test that reverted changes are skipped and failed commits restore the model"""
+        card = API().getATMCards(self.card_num)[0]
+        balance, pin = card.balance, card.getPin()
+        with UnitOfWork() as uow:
+            card.withdraw(5)
+            card.deposit(5)
+            self.assertEqual(uow.changes(), [])
+            self.assertTrue(uow.commit())
+        self.assertEqual(self.writes(), {})
+        with UnitOfWork() as uow:
+            card.withdraw(5)
+            card.setPin('9999')
+            with patch.object(uow, '_flush', side_effect=Exception("quota")):
+                with patch('sys.stdout', new=StringIO()) as out:
+                    self.assertFalse(uow.commit())
+            self.assertIn("ERROR", out.getvalue())
+        self.assertEqual((card.balance, card.getPin()), (balance, pin))
+        # Leaving the block without committing discards the changes too
+        with UnitOfWork():
+            card.setPin('9999')
+        self.assertEqual(card.getPin(), pin)
+        self.assertIsNone(UnitOfWork.current())
+
+    def test_login_survives_a_failed_counter_reset(self):
+        """Test that a correct PIN logs in even when resetting failedTries cannot be written"""
+        ws = self.emulator.open("client_database").worksheet("atmCards")
+        ws.update_cell(4, 4, 2)
+        card = API().getATMCards(self.card_num)[0]
+        with patch.object(UnitOfWork, '_flush', side_effect=Exception("Quota exceeded")), \
+                patch('builtins.input', return_value=self.card_num), \
+                patch('run.get_pin', return_value=self.pin), \
+                patch('sys.stdout', new=StringIO()) as out:
+            api = Mock(**{"getATMCards.return_value": [card]})
+            self.assertEqual(authenticate(api), ('api', card))
+        self.assertIn("[ERROR] Failed to save changes", out.getvalue())
+        self.assertNotIn("Incorrect PIN", out.getvalue())
+        # The counter keeps its stored value
+        self.assertEqual(card.getFailedTries(), '2')
+        self.assertEqual(ws.row_values(4)[3], '2')
+
+    def test_version_conflict_aborts_before_any_write(self):
+        """Test that a staged PIN change is not written when the balance it goes with no longer fits"""
+        card = API().getATMCards(self.card_num)[0]
+        other = API().getATMCards(self.card_num)[0]
+        pin = card.getPin()
+        with UnitOfWork() as uow:
+            self.assertTrue(card.withdraw(10))
+            self.assertTrue(card.setPin('9999'))
+            # Another session empties the account after the changes were staged
+            session = threading.Thread(target=other.withdraw, args=(other.balance,))
+            session.start()
+            session.join()
+            with patch('sys.stdout', new=StringIO()) as out:
+                self.assertFalse(uow.commit())
+        self.assertIn("insufficient funds", out.getvalue())
+        reloaded = API().getATMCards(self.card_num)[0]
+        self.assertEqual((reloaded.getPin(), reloaded.balance), (pin, 0))
+        self.assertEqual(card.getPin(), pin)
+
+    def test_rows_are_located_on_commit(self):
+        """Test that models not loaded by the API are found with one key column read"""
+        holder = AccountHolder('4', 'First4', 'Last4', '555-0004')
+        start = API().getAccountByID(104)[0].balance
+        account = Account('104', '4', start)
+        with UnitOfWork() as uow:
+            self.assertTrue(holder.updateAccount('First4', 'Changed', '555-0004'))
+            self.assertTrue(account.increaseBalance(1))
+            self.assertTrue(account.increaseBalance(2))
+            self.assertTrue(uow.commit())
+        self.assertEqual(API().getAccountHolders(4)[0].getLastname(), 'Changed')
+        # The account had no stamp: it was read before the first write and bumped
+        stored = API().getAccountByID(104)[0]
+        self.assertEqual((stored.balance, stored.version), (start + 3, 1))
+        self.assertEqual((account.balance, account.version), (start + 3, 1))
+        self.assertNotIn("findall", self.emulator.stats()["calls"])
+
+# TestOptimisticConcurrency here:
+
+class TestOptimisticConcurrency(unittest.TestCase):
+    """Test cases for versioned (compare-and-swap) balance writes"""
+
+    def setUp(self):
+        SheetsConnection.reset()
+        sheets, self.client_cards, self.atm_cards = build_dataset(clients=5)
+        self.emulator = SheetsEmulator()
+        self.emulator.load("client_database", sheets)
+        install_emulator(self.emulator)
+        self.card = self.client_cards[0][0]
+        self.other = self.client_cards[1][0]
+
+    def tearDown(self):
+        SheetsConnection.reset()
+        SqliteDatabase.close_all()
+
+    def test_overwrite_of_a_card_missing_from_the_snapshot(self):
+        """Test that an unversioned write finds a row added after the snapshot loaded"""
+        repo = SimpleClientRepo(snapshot_ttl=60)
+        self.assertIsNotNone(repo.get_record(self.card))
+        ws = self.emulator.open("client_database").worksheet("client")
+        ws.append_rows([['4000000000000001', '1234', 'New', 'Card', '10', '3']])
+        self.emulator.reset_stats()
+        self.assertTrue(repo.update_balance('4000000000000001', 25))
+        # One read of the card column, one of the stamp, one write
+        self.assertEqual(self.emulator.stats()["round_trips"], 3)
+        self.assertEqual(ws.row_values(ws.row_count)[4:], ['25', '4'])
+
+    def test_stale_record_is_reread_and_retried(self):
+        """Test that two sessions on one card both keep their change"""
+        repo = SimpleClientRepo()
+        first, second = repo.get_record(self.card), repo.get_record(self.card)
+        start = first.balance
+        self.assertTrue(repo.update_balance(self.card, first.balance - 10, expected=first))
+        self.assertEqual(first.version, 1)
+        # second was read before the withdrawal: its deposit is applied to the stored balance
+        self.assertTrue(repo.update_balance(self.card, second.balance + 5, expected=second))
+        self.assertEqual((second.balance, second.version), (start - 10, 2))
+        stored = repo.get_record(self.card)
+        self.assertEqual((stored.balance, stored.version), (start - 5, 2))
+
+    def test_debit_that_no_longer_fits_is_refused(self):
+        """Test that a re-read balance too small for a withdrawal fails it"""
+        repo = SimpleClientRepo()
+        first, second = repo.get_record(self.card), repo.get_record(self.card)
+        self.assertTrue(repo.update_balance(self.card, Money(0), expected=first))
+        with patch('sys.stdout', new=StringIO()) as out:
+            self.assertFalse(repo.update_balance(self.card, second.balance - 1, expected=second))
+        self.assertIn("Insufficient funds", out.getvalue())
+        self.assertEqual(repo.get_record(self.card).balance, 0)
+
+    def test_transfer_retries_when_a_side_changed(self):
+        """Test that a transfer uses the current balance of a card changed meanwhile"""
+        repo = SimpleClientRepo()
+        source, dest = repo.get_record(self.card), repo.get_record(self.other)
+        start = dest.balance
+        concurrent = repo.get_record(self.other)
+        self.assertTrue(repo.update_balance(self.other, concurrent.balance + 7, expected=concurrent))
+        self.assertTrue(repo.transfer(source, dest, 3))
+        self.assertEqual(repo.get_record(self.other).balance, start + 10)
+        self.assertEqual(dest.version, 2)
+
+    def test_compare_and_set_reports_current_cells(self):
+        """Test that nothing is written when a version stamp differs"""
+        ws = self.emulator.open("client_database").worksheet("account")
+        self.assertIsNone(compare_and_set(ws, [(2, 3, 1, 0)]))
+        self.assertEqual(compare_and_set(ws, [(2, 3, 2, 0), (3, 3, 2, 0)], [(2, 2, '9')]),
+                         {2: ('1', 1), 3: (ws.row_values(3)[2], 0)})
+        self.assertEqual(ws.row_values(2)[1:], ['1', '1', '1'])
+        self.assertIsNone(compare_and_set(ws, [(2, 3, 2, 1)], [(2, 2, '9')]))
+        self.assertEqual(ws.row_values(2)[1:], ['9', '2', '2'])
+
+    def test_account_writes_are_versioned(self):
+        """Test that ATM cards loaded before another write do not overwrite it"""
+        card_num = self.atm_cards[0][0]
+        first, second = API().getATMCards(card_num)[0], API().getATMCards(card_num)[0]
+        start = first.balance
+        self.assertTrue(first.withdraw(10))
+        self.assertTrue(second.deposit(5))
+        self.assertEqual(second.balance, start - 5)
+        # The same check when the write is part of a unit of work
+        third = API().getATMCards(card_num)[0]
+        self.assertTrue(UnitOfWork.run(first.withdraw, 1))
+        self.assertTrue(UnitOfWork.run(third.deposit, 2))
+        self.assertEqual(third.balance, start - 4)
+        reloaded = API().getATMCards(card_num)[0]
+        self.assertEqual((reloaded.balance, reloaded.version), (start - 4, 4))
+
+    def test_sqlite_versions_are_checked_in_the_update(self):
+        """Test versioned writes on SQLite, including databases without the column"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, True)
+        path = os.path.join(tmpdir, "atm.db")
+        old = sqlite3.connect(path)
+        old.execute("CREATE TABLE client (cardNum TEXT PRIMARY KEY, pin TEXT, firstName TEXT, "
+                    "lastName TEXT, balance REAL)")
+        old.execute("INSERT INTO client VALUES ('4532772818527395', '1234', 'John', 'Doe', 100)")
+        old.commit()
+        old.close()
+        repo = SqliteClientRepo(path)
+        first, second = repo.get_record('4532772818527395'), repo.get_record('4532772818527395')
+        self.assertTrue(repo.update_balance(first.cardNum, first.balance - 30, expected=first))
+        self.assertTrue(repo.update_balance(second.cardNum, second.balance + 5, expected=second))
+        stored = repo.get_record('4532772818527395')
+        self.assertEqual((stored.balance, stored.version), (75, 2))
+        ws = SqliteWorksheet(repo.db, "client")
+        self.assertEqual(compare_and_set(ws, [(2, 5, 1, 0)], [(2, 2, '4321')]), {2: ('75.00', 2)})
+        self.assertEqual(repo.get_record('4532772818527395').pin, '1234')
+        self.assertIsNone(compare_and_set(ws, [(2, 5, 80, 2)], [(2, 2, '4321')]))
+        stored = repo.get_record('4532772818527395')
+        self.assertEqual((stored.balance, stored.pin), (80, '4321'))
+        # Unversioned writes still bump the stamp
+        self.assertTrue(repo.update_balance('4532772818527395', 90))
+        self.assertEqual(repo.get_record('4532772818527395').version, 4)
+        self.assertIsNone(compare_and_set(ws, [(2, 5, 95, None)]))
+        self.assertEqual(repo.get_record('4532772818527395').version, 5)
+
+# TestLockManager here:
+
+class TestLockManager(unittest.TestCase):
+    """Test cases for the striped per-card/account locks"""
+
+    def setUp(self):
+        self.locks = LockManager(stripes=64, timeout=5.0)
+        # Two keys on different stripes
+        self.a = "client:1"
+        self.b = next(f"client:{i}" for i in range(2, 100)
+                      if self.locks.stripe(f"client:{i}") != self.locks.stripe(self.a))
+
+    def _hold_in_thread(self, locks, *keys):
+        held, release = threading.Event(), threading.Event()
+
+        def worker():
+            with locks.hold(*keys):
+                held.set()
+                release.wait(5)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        held.wait(5)
+        return release, thread
+
+    def test_other_keys_do_not_block(self):
+        """Test that a held card does not delay an operation on another card"""
+        release, thread = self._hold_in_thread(self.locks, self.a)
+        try:
+            with self.locks.hold(self.b, timeout=0.1):
+                pass
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(self.locks.stats()["contended"], 0)
+
+    def test_same_key_times_out_and_is_counted(self):
+        """Test that a held card makes a second operation wait, then give up"""
+        release, thread = self._hold_in_thread(self.locks, self.a)
+        try:
+            with self.assertRaises(LockTimeout):
+                with self.locks.hold(self.a, timeout=0.05):
+                    pass
+        finally:
+            release.set()
+            thread.join()
+        stats = self.locks.stats()
+        self.assertEqual((stats["acquisitions"], stats["contended"], stats["timeouts"]), (1, 1, 1))
+        self.assertGreaterEqual(stats["max_wait_ms"], 40)
+
+    def test_opposite_transfers_do_not_deadlock(self):
+        """Test that locks taken for a->b and b->a transfers are ordered"""
+        errors = []
+
+        def transfers(*keys):
+            try:
+                for _ in range(200):
+                    with self.locks.hold(*keys, timeout=2.0):
+                        time.sleep(0)
+            except LockTimeout as e:
+                errors.append(e)
+        threads = [threading.Thread(target=transfers, args=keys) for keys in ((self.a, self.b), (self.b, self.a))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.locks.stats()["acquisitions"], 800)
+
+    def test_nested_hold_reenters(self):
+        """Test that a transfer holding both cards can call update_balance"""
+        with self.locks.hold(self.a, self.b):
+            with self.locks.hold(self.a, timeout=0.05):
+                pass
+        self.assertEqual(self.locks.stats()["acquisitions"], 2)
+
+    def test_lock_dir_is_shared_between_managers(self):
+        """Test that managers using one lock directory exclude each other"""
+        directory = tempfile.mkdtemp()
+        try:
+            first, second = LockManager(lock_dir=directory), LockManager(lock_dir=directory)
+            release, thread = self._hold_in_thread(first, self.a)
+            try:
+                with self.assertRaises(LockTimeout):
+                    with second.hold(self.a, timeout=0.05):
+                        pass
+                with second.hold(self.b, timeout=0.05):
+                    pass
+            finally:
+                release.set()
+                thread.join()
+            with second.hold(self.a, timeout=0.05):
+                pass
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_concurrent_withdrawals_on_one_account_are_serialized(self):
+        """Test that unversioned read-modify-write withdrawals do not lose updates"""
+        SheetsConnection.reset()
+        try:
+            sheets, _, atm_cards = build_dataset(clients=2)
+            # Latency opens a window between each session's read and write
+            emulator = SheetsEmulator(latency=0.002)
+            emulator.load("client_database", sheets)
+            install_emulator(emulator)
+            card_num = atm_cards[0][0]
+            start = API().getATMCards(card_num)[0].balance
+            cards = [API().getATMCards(card_num)[0] for _ in range(8)]
+            for card in cards:
+                card.version = None  # no stamp loaded: read the row, then write it
+            threads = [threading.Thread(target=card.withdraw, args=(1,)) for card in cards]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(API().getATMCards(card_num)[0].balance, start - 8)
+        finally:
+            SheetsConnection.reset()
+
+    def test_unit_of_work_commit_holds_the_account_lock(self):
+        """Test that a withdrawal recorded in a unit of work is written under its account lock"""
+        SheetsConnection.reset()
+        try:
+            sheets, _, atm_cards = build_dataset(clients=2)
+            emulator = SheetsEmulator()
+            emulator.load("client_database", sheets)
+            install_emulator(emulator)
+            card = API().getATMCards(atm_cards[0][0])[0]
+            locked = []
+
+            def probe(*args):
+                def other_session():
+                    try:
+                        with LOCKS.hold(f"account:{card.accountID}", timeout=0):
+                            locked.append(False)
+                    except LockTimeout:
+                        locked.append(True)
+                thread = threading.Thread(target=other_session)
+                thread.start()
+                thread.join()
+                return compare_and_set(*args)
+
+            with patch('cardHolder.compare_and_set', side_effect=probe):
+                self.assertTrue(UnitOfWork.run(card.withdraw, 5))
+            self.assertEqual(locked, [True])
+        finally:
+            SheetsConnection.reset()
+
+    def test_mutation_fails_when_lock_times_out(self):
+        """Test that a deposit gives up when its account stays locked"""
+        card = ATMCard(100, 1, "50.00", "5300000000000000", "1234", 0)
+        card.increaseBalance = Mock(return_value=True)
+        release, thread = self._hold_in_thread(LOCKS, "account:100")
+        try:
+            with patch.object(LOCKS, "timeout", 0.05), patch('sys.stdout', new=StringIO()) as out:
+                self.assertFalse(card.deposit(5))
+        finally:
+            release.set()
+            thread.join()
+        self.assertIn("Timed out", out.getvalue())
+        card.increaseBalance.assert_not_called()
+        self.assertEqual(card.balance, Money.parse("50.00"))
+
+
 # TestDataIntegrity here:
 
 class TestDataIntegrity(unittest.TestCase):
@@ -1417,15 +3515,34 @@ def run_tests():
     
     # Add all test classes
     suite.addTests(loader.loadTestsFromTestCase(TestRunModule))
+    suite.addTests(loader.loadTestsFromTestCase(TestCardPrefetch))
     suite.addTests(loader.loadTestsFromTestCase(TestCardHolderModule))
     suite.addTests(loader.loadTestsFromTestCase(TestCardHolderFunctions))
     suite.addTests(loader.loadTestsFromTestCase(TestAPIClass))
     suite.addTests(loader.loadTestsFromTestCase(TestAccountHolderClass))
     suite.addTests(loader.loadTestsFromTestCase(TestSimpleClientRepo))
+    suite.addTests(loader.loadTestsFromTestCase(TestSimpleClientRepoTransfer))
+    suite.addTests(loader.loadTestsFromTestCase(TestWriteBehind))
+    suite.addTests(loader.loadTestsFromTestCase(TestSheetsEmulator))
+    suite.addTests(loader.loadTestsFromTestCase(TestRequestScheduler))
+    suite.addTests(loader.loadTestsFromTestCase(TestInstrumentation))
+    suite.addTests(loader.loadTestsFromTestCase(TestLazyStartup))
+    suite.addTests(loader.loadTestsFromTestCase(TestBenchmark))
+    suite.addTests(loader.loadTestsFromTestCase(TestATMServer))
+    suite.addTests(loader.loadTestsFromTestCase(TestSqliteBackend))
     suite.addTests(loader.loadTestsFromTestCase(TestAccountIncreaseBalance))
     suite.addTests(loader.loadTestsFromTestCase(TestATMCardDatabaseMethods))
+    suite.addTests(loader.loadTestsFromTestCase(TestCellBatch))
     suite.addTests(loader.loadTestsFromTestCase(TestInputValidation))
     suite.addTests(loader.loadTestsFromTestCase(TestErrorHandling))
+    suite.addTests(loader.loadTestsFromTestCase(TestPagedReads))
+    suite.addTests(loader.loadTestsFromTestCase(TestAnalytics))
+    suite.addTests(loader.loadTestsFromTestCase(TestReconcile))
+    suite.addTests(loader.loadTestsFromTestCase(TestCsvTool))
+    suite.addTests(loader.loadTestsFromTestCase(TestMoney))
+    suite.addTests(loader.loadTestsFromTestCase(TestUnitOfWork))
+    suite.addTests(loader.loadTestsFromTestCase(TestOptimisticConcurrency))
+    suite.addTests(loader.loadTestsFromTestCase(TestLockManager))
     suite.addTests(loader.loadTestsFromTestCase(TestDataIntegrity))
     
     # Run tests with detailed output